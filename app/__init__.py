@@ -1,6 +1,5 @@
 import os
 import jinja2
-from redis import Redis
 from pyelasticsearch import ElasticSearch
 from flask import Flask, g, request, send_from_directory
 from flask_login import LoginManager, current_user
@@ -9,6 +8,7 @@ from raven.contrib.flask import Sentry
 import stripe
 
 from app.session import RedisSessionInterface
+from app.redis_client import TimedRedis
 
 
 db = SQLAlchemy()
@@ -48,17 +48,11 @@ app.template_folder = app.config['CUSTOM_TEMPLATE_FOLDER']
 
 # Initialise redis and elasticsearch
 
-redis = Redis()
+redis = TimedRedis()
 
 es = ElasticSearch(app.config['ELASTICSEARCH_URI'])
 import search
 
-try:
-    search.create_index()
-except:
-    # This almost always means that index already exists
-    pass
-
 # Set up sessions
 
 app.session_interface = RedisSessionInterface(redis=redis)
@@ -119,7 +113,7 @@ from models import User
 
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return User.load_identity(int(id))
 
 
 # Before/After request hooks go here
@@ -138,9 +132,8 @@ def before_request():
         g.user.action('online')
 
         if g.user.seller_fee_paid:
-            # For seller, update ES index with last logged on date (not every request, only if cache item is expired)
-            if not cache.is_user_online(g.user.id):
-                cache.set_user_online(g.user.id)
+            # For seller, update ES index with last seen date (not every request, only if cache item is expired)
+            if cache.should_index_seller_online(g.user.id):
                 search.seller_online.send(seller=g.user)
 
     if app.config['DEVELOPMENT']:
@@ -186,12 +179,9 @@ def after_request(response):
             # Invitation has higher priority over affiliate cookie
             response.set_cookie(User.INVITATION_COOKIE, invitation, User.INVITATION_COOKIE_MAXAGE)
         elif referer and not referer_set:
-            referer_user = User.query.filter(
-                User.username == referer,
-                User.is_deleted != True
-            ).first()
+            referer_id = User.get_referer_id(referer)
 
-            if referer_user:
-                response.set_cookie(User.REFERER_COOKIE, str(referer_user.id), User.REFERER_COOKIE_MAXAGE)
+            if referer_id:
+                response.set_cookie(User.REFERER_COOKIE, str(referer_id), User.REFERER_COOKIE_MAXAGE)
 
     return response
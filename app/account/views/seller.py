@@ -9,6 +9,7 @@ from datetime import date, datetime, timedelta
 from app import db, search, app, messaging
 from app.decorators import xhr_required, seller_required
 from app.models import User, Order, OrderOffer, Product, Discount, ProductOffer, Feedback, Tag, Dispute, Deliverable, Enquiry, EnquiryOffer, calculate_order_fee, isoformat
+from app.statistic import ProductViews
 from app.helpers import APIError, timedelta_pretty_print
 from app.utils.storage import Storage
 from app.utils.tz import get_local_datetime
@@ -331,11 +332,16 @@ def api_services():
     services_count = services_query.count()
     services_query = services_query.limit(incoming_limit).offset(incoming_offset)
 
+    services = services_query.all()
+    services_views = ProductViews.get_views(service.id for service in services)
+    services_unique_visitors = ProductViews.get_unique_visitors(service.id for service in services)
+
     services_prepared = list()
 
-    for service in services_query.all():
+    for service in services:
         service_prepared = service.to_json()
-        service_prepared['views'] = service.get_views()
+        service_prepared['views'] = services_views[service.id]
+        service_prepared['unique_visitors'] = services_unique_visitors[service.id]
         service_prepared['is_deleted'] = service.is_deleted
         service_prepared['published_on'] = isoformat(service.published_on) if service.published_on else None
         service_prepared['_is_paused'] = False if service.published_on else True
@@ -335,6 +335,8 @@ def user_deactivate(user_id):
 
     db.session.commit()
 
+    search.seller_updated.send(seller=user)
+
     return redirect(url_for('admin.user', user_id=user.id))
 
 
@@ -347,6 +349,8 @@ def user_activate(user_id):
     db.session.add(user)
     db.session.commit()
 
+    search.seller_updated.send(seller=user)
+
     return redirect(url_for('admin.user', user_id=user.id))
 
 
@@ -473,6 +477,8 @@ def user_verify_email(user_id):
     db.session.add(user)
     db.session.commit()
 
+    search.seller_updated.send(seller=user)
+
     flash('Verify email account has been successfull')
     return redirect(url_for('admin.user', user_id=user_id))
 
@@ -1,6 +1,14 @@
-import cPickle as pickle
+import os
+import math
+import time
+import uuid
+import random
+import threading
+import collections
+from datetime import datetime
 
-from app import redis
+from app import app, redis
+from app.serializer import serializer
 
 
 class TokenType:
@@ -11,74 +19,547 @@ class TokenType:
 
 class SharedCache:
     FRONTEND_CATEGORY_TREE = 'frontend_category_tree'
-    FRONTEND_MAX_PRICE = 'frontend_max_price'
-    FRONTEND_CATEGORY_STATISTICS = 'frontend_category_statistics:%d'
-    FRONTEND_CATEGORY_STATISTICS_INCL_PRIVATE = 'frontend_category_statistics_incl_private:%d'
     FRONTEND_SERVICE_STATISTICS = 'frontend_service_statistics:%d'
-    STATISTIC_SERVICE_IMPRESSION = 'stat_service_impression:%d'
     AFFILIATE_STATISTIC = 'affiliate_statistic:%d:%s:%s'
+    USER_IDENTITY = 'user_identity:%d'
+    REFERER = 'referer:%s'
+    VARIABLES = 'variables'
 
 
 USER_ONLINE_EXPIRE = 15*60
 
 
+# Returns the value and deletes the key atomically, so a token can be used only once
+_pop_script = redis.register_script("""
+local value = redis.call('get', KEYS[1])
+if value then
+    redis.call('del', KEYS[1])
+end
+return value
+""")
+
+
 def add_token(token, token_type, data, expire=3600):
     key = 'token:%s:%s' % (token_type, token)
-    redis.set(key, data)
-    redis.expire(key, expire)
+    redis.set(key, data, ex=expire)
 
 
 def search_token(token, token_type, destroy_token=True):
     key = 'token:%s:%s' % (token_type, token)
-    value = redis.get(key)
 
     if destroy_token:
-        redis.delete(key)
+        return _pop_script(keys=[key])
+
+    return redis.get(key)
+
+
+# Presence
+#
+# Last seen timestamps of users are kept in the PRESENCE_KEY sorted set (user id -> unix time)
+# and written to users.last_logged_on in bulk by flush_user_presence (see scripts/periodic.py).
+# Timestamps up to PRESENCE_FLUSHED_KEY are already in the database
 
-    return value
+PRESENCE_KEY = 'presence'
+PRESENCE_FLUSHED_KEY = 'presence:flushed'
 
 
 def set_user_online(user_id):
-    key = 'user_online:%d' % user_id
-    redis.setex(key, 1, USER_ONLINE_EXPIRE)
+    redis.zadd(PRESENCE_KEY, **{str(user_id): time.time()})
+
+
+def get_users_last_seen(user_ids):
+    """
+    Returns dict user id -> last seen datetime (UTC) for users present in the presence store
+    """
+    pipe = redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zscore(PRESENCE_KEY, user_id)
+
+    return dict((user_id, datetime.utcfromtimestamp(score)) for user_id, score in zip(user_ids, pipe.execute()) if score is not None)
+
 
+def get_user_last_seen(user_id):
+    score = redis.zscore(PRESENCE_KEY, user_id)
+    return datetime.utcfromtimestamp(score) if score is not None else None
 
-def is_user_online(user_id, ttl_threshold=USER_ONLINE_EXPIRE / 2):
-    # Check if user_online key is present and have ttl > 1/2
-    key = 'user_online:%d' % user_id
-    ttl = redis.ttl(key)
-    return ttl > ttl_threshold
+
+def is_user_online(user_id):
+    score = redis.zscore(PRESENCE_KEY, user_id)
+    return score is not None and time.time() - score < USER_ONLINE_EXPIRE
 
 
 def is_user_online_multiple(user_ids):
-    keys = redis.mget(map(lambda user_id: 'user_online:%d' % user_id, user_ids))
+    pipe = redis.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zscore(PRESENCE_KEY, user_id)
 
+    now = time.time()
     result = dict()
 
-    for idx, user_id in enumerate(user_ids):
-        result[user_id] = int(bool(keys[idx]))
-    
+    for user_id, score in zip(user_ids, pipe.execute()):
+        result[user_id] = int(score is not None and now - score < USER_ONLINE_EXPIRE)
+
     return result
 
 
-def get_cached_object(key):
-    serialized = redis.get('cache:%s' % key)
-    if not serialized:
-        return None
+def should_index_seller_online(user_id):
+    """
+    Returns True at most once per half of USER_ONLINE_EXPIRE for a seller, so the search
+    index gets fresh last seen date while the seller is online
+    """
+    return bool(redis.set('seller_online_indexed:%d' % user_id, 1, nx=True, ex=USER_ONLINE_EXPIRE / 2))
+
+
+def get_presence_to_flush(delay=5):
+    """
+    Returns (watermark, dict user id -> timestamp) of presence not written to database yet.
+    Recent timestamps (within delay seconds) are left for the next flush, since they may still be arriving
+    """
+    flushed = float(redis.get(PRESENCE_FLUSHED_KEY) or 0)
+    watermark = time.time() - delay
+
+    items = redis.zrangebyscore(PRESENCE_KEY, '(%f' % flushed, watermark, withscores=True)
+
+    return watermark, dict((int(user_id), score) for user_id, score in items)
+
+
+def set_presence_flushed(watermark):
+    pipe = redis.pipeline(transaction=False)
+    pipe.set(PRESENCE_FLUSHED_KEY, watermark)
+    # Older entries are in database and don't mean users are online anymore
+    pipe.zremrangebyscore(PRESENCE_KEY, '-inf', '(%f' % min(watermark, time.time() - USER_ONLINE_EXPIRE))
+    pipe.execute()
+
+
+# Shared objects cache
+#
+# Objects are stored in redis, and recently used ones are also kept in a bounded
+# per-process LRU (L1) for at most CACHE_LOCAL_TTL seconds (and never longer than
+# the redis key lives). Writes publish the key to CACHE_INVALIDATION_CHANNEL, so
+# every process evicts it from its L1. L1 keeps serialized values, so callers get
+# their own copies just like from redis.
+
+CACHE_INVALIDATION_CHANNEL = 'cache:invalidate'
+CACHE_STATS_KEY = 'cache:stats'
+
+
+class LocalCache(object):
+    """
+    Thread-safe LRU with per-key expiration
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                return None
+
+            value, expires_on = item
+            if expires_on <= time.time():
+                return None
+
+            # Move to the end as the most recently used
+            self.items[key] = item
+            return value
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time() + ttl)
+
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def evict(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+local_cache = LocalCache(app.config.get('CACHE_LOCAL_SIZE', 1000))
+
+# Hits/misses counted by this process and not sent to redis yet
+cache_stats = dict(local_hits=0, redis_hits=0, misses=0)
+
+# Process which listens to invalidations (processes are forked by the server)
+_listener = dict(pid=None)
 
+# Invalidations are tagged with a random token of the publishing process, so the process
+# doesn't evict its own writes. Pids are not unique across hosts, and forked processes
+# get a new token
+_process = dict(pid=os.getpid(), token=uuid.uuid4().hex)
+
+# Callbacks of process-local data built outside of the cache: key -> list of functions
+invalidation_callbacks = dict()
+
+
+def _local_ttl(redis_ttl):
+    if not app.config.get('CACHE_LOCAL_ENABLED', True):
+        return 0
+
+    ttl = app.config.get('CACHE_LOCAL_TTL', 60)
+    if redis_ttl is not None and redis_ttl >= 0:
+        ttl = min(ttl, redis_ttl)
+
+    return ttl
+
+
+def _get_process_token():
+    if _process['pid'] != os.getpid():
+        _process['pid'] = os.getpid()
+        _process['token'] = uuid.uuid4().hex
+
+    return _process['token']
+
+
+def _listen_invalidations():
+    while True:
+        try:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+
+            # Anything could have changed while not subscribed
+            _invalidate_all()
+
+            for message in pubsub.listen():
+                if message['type'] != 'message':
+                    continue
+
+                token, key = message['data'].split(':', 1)
+                if token != _get_process_token():
+                    _invalidate(key)
+        except Exception:
+            _invalidate_all()
+            time.sleep(1)
+
+
+def _invalidate(key):
+    local_cache.evict(key)
+
+    for callback in invalidation_callbacks.get(key, ()):
+        callback()
+
+
+def _invalidate_all():
+    local_cache.clear()
+
+    for callbacks in invalidation_callbacks.values():
+        for callback in callbacks:
+            callback()
+
+
+def ensure_invalidation_listener():
+    if _listener['pid'] == os.getpid():
+        return
+
+    _listener['pid'] = os.getpid()
+    local_cache.clear()
+
+    thread = threading.Thread(target=_listen_invalidations, name='cache-invalidation')
+    thread.daemon = True
+    thread.start()
+
+
+def _flush_cache_stats(pipe):
+    # Piggyback hit/miss counters on a pipeline which is executed anyway
+    for key in ('local_hits', 'redis_hits', 'misses'):
+        if cache_stats[key]:
+            pipe.hincrby(CACHE_STATS_KEY, key, cache_stats[key])
+            cache_stats[key] = 0
+
+
+def _publish_invalidations(pipe, keys):
+    for key in keys:
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, '%s:%s' % (_get_process_token(), key))
+
+
+def _loads(serialized):
     try:
-        object = pickle.loads(serialized)
+        return serializer.loads(serialized)
     except:
         return None
 
-    return object
+
+def get_cached_object(key):
+    return get_cached_objects([key]).get(key)
 
 
 def put_cached_object(key, object, expire=600):
+    put_cached_objects({key: object}, expire=expire)
+
+
+def get_cached_objects(keys):
+    """
+    Returns dict with objects found. Objects missing in L1 are fetched from redis
+    (with their TTLs) within a single round trip
+    """
+    if not keys:
+        return dict()
+
+    ensure_invalidation_listener()
+
+    result = dict()
+    missing_keys = list()
+
+    for key in keys:
+        serialized = local_cache.get(key)
+        if serialized is None:
+            missing_keys.append(key)
+            continue
+
+        cache_stats['local_hits'] += 1
+        object = _loads(serialized)
+        if object is not None:
+            result[key] = object
+
+    if not missing_keys:
+        return result
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.mget(['cache:%s' % key for key in missing_keys])
+    for key in missing_keys:
+        pipe.ttl('cache:%s' % key)
+    _flush_cache_stats(pipe)
+
+    responses = pipe.execute()
+    values, ttls = responses[0], responses[1:1 + len(missing_keys)]
+
+    for key, serialized, ttl in zip(missing_keys, values, ttls):
+        if not serialized:
+            cache_stats['misses'] += 1
+            continue
+
+        cache_stats['redis_hits'] += 1
+
+        local_ttl = _local_ttl(ttl)
+        if local_ttl > 0:
+            local_cache.put(key, serialized, local_ttl)
+
+        object = _loads(serialized)
+        if object is not None:
+            result[key] = object
+
+    return result
+
+
+def put_cached_objects(objects, expire=600):
+    """
+    Store dict of objects with a single pipeline and evict them from L1 of other processes
+    """
+    ensure_invalidation_listener()
+
+    pipe = redis.pipeline(transaction=False)
+    stored_keys = list()
+
+    for key, object in objects.items():
+        try:
+            serialized = serializer.dumps(object)
+        except:
+            continue
+
+        pipe.setex('cache:%s' % key, serialized, expire)
+        stored_keys.append(key)
+
+        local_ttl = _local_ttl(expire)
+        if local_ttl > 0:
+            local_cache.put(key, serialized, local_ttl)
+
+    _publish_invalidations(pipe, stored_keys)
+    pipe.execute()
+
+
+def delete_cached_object(key):
+    delete_cached_objects([key])
+
+
+def delete_cached_objects(keys):
+    keys = list(keys)
+    for key in keys:
+        local_cache.evict(key)
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(*['cache:%s' % key for key in keys])
+    _publish_invalidations(pipe, keys)
+    pipe.execute()
+
+
+def on_invalidate(key, callback):
+    """
+    Call callback (in a background thread) when the key is invalidated by another process
+    """
+    invalidation_callbacks.setdefault(key, []).append(callback)
+    ensure_invalidation_listener()
+
+
+def publish_invalidation(key):
+    """
+    Notify other processes that data of the key has changed
+    """
+    pipe = redis.pipeline(transaction=False)
+    _publish_invalidations(pipe, [key])
+    pipe.execute()
+
+
+def get_cache_stats():
+    """
+    Hit ratios of both tiers: L1 of all requests, redis of those missed L1
+    """
+    stats = redis.hgetall(CACHE_STATS_KEY)
+
+    local_hits, redis_hits, misses = [int(stats.get(key, 0)) + cache_stats[key] for key in ('local_hits', 'redis_hits', 'misses')]
+
+    requests = local_hits + redis_hits + misses
+    redis_requests = redis_hits + misses
+
+    return dict(
+        local_hits=local_hits,
+        redis_hits=redis_hits,
+        misses=misses,
+        local_hit_ratio=float(local_hits) / requests if requests else None,
+        redis_hit_ratio=float(redis_hits) / redis_requests if redis_requests else None,
+        hit_ratio=float(local_hits + redis_hits) / requests if requests else None
+    )
+
+
+# Computed values
+#
+# cached() keeps the value together with its logical expiration and the time it took to compute.
+# The redis key lives CACHE_STALE_TTL seconds longer, so the stale value is served while a single
+# process (holding a redis lock) recomputes it. Before the expiration the value is refreshed early
+# with a probability growing as the expiration approaches (XFetch), so hot keys usually never expire.
+
+CACHE_LOCK_TTL = 60
+CACHE_LOCK_WAIT = 5
+
+_release_lock_script = redis.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+# Hot keys refreshed by the background refresher: key -> (ttl, recompute)
+hot_keys = dict()
+
+
+def _get_envelope(key):
+    envelope = get_cached_object(key)
+    if not isinstance(envelope, dict) or 'expires_on' not in envelope:
+        return None
+
+    return envelope
+
+
+def _should_refresh(envelope, beta=1.0):
+    # XFetch: -delta * beta * log(rand) is an exponentially distributed head start
+    head_start = -envelope['delta'] * beta * math.log(max(random.random(), 1e-10))
+    return time.time() + head_start >= envelope['expires_on']
+
+
+def _recompute(key, ttl, recompute, stale_ttl):
+    """
+    Recompute the value if no other process does it now. Returns (recomputed, envelope)
+    """
+    lock_key = 'lock:cache:%s' % key
+    lock_token = uuid.uuid4().hex
+
+    if not redis.set(lock_key, lock_token, nx=True, ex=CACHE_LOCK_TTL):
+        return False, None
+
     try:
-        serialized = pickle.dumps(object)
-    except:
+        started_on = time.time()
+        value = recompute()
+        finished_on = time.time()
+
+        envelope = dict(value=value, expires_on=finished_on + ttl, delta=finished_on - started_on)
+        put_cached_object(key, envelope, expire=ttl + stale_ttl)
+    finally:
+        _release_lock_script(keys=[lock_key], args=[lock_token])
+
+    return True, envelope
+
+
+def cached(key, ttl, recompute, stale_ttl=None, beta=1.0):
+    """
+    Returns value of the key, calling recompute() to get it when missing or expired. Only one process
+    recomputes a value at a time, others serve the stale value meanwhile or wait for the fresh one
+    """
+    if stale_ttl is None:
+        stale_ttl = app.config.get('CACHE_STALE_TTL', 300)
+
+    envelope = _get_envelope(key)
+
+    if envelope is not None and not _should_refresh(envelope, beta):
+        return envelope['value']
+
+    recomputed, new_envelope = _recompute(key, ttl, recompute, stale_ttl)
+    if recomputed:
+        return new_envelope['value']
+
+    # Somebody else recomputes the value: serve the stale one if there is one
+    if envelope is not None:
+        return envelope['value']
+
+    # Nothing to serve, wait for the value a bit and compute it ourselves if it doesn't appear
+    waited_until = time.time() + CACHE_LOCK_WAIT
+    while time.time() < waited_until:
+        time.sleep(0.05)
+
+        envelope = _get_envelope(key)
+        if envelope is not None:
+            return envelope['value']
+
+    return recompute()
+
+
+def invalidate_cached(key):
+    """
+    Expire the value computed with cached(), keeping it available as the stale one
+    """
+    envelope = _get_envelope(key)
+    if envelope is None:
         return
 
-    redis.set('cache:%s' % key, serialized)
-    redis.expire('cache:%s' % key, expire)
+    stale_ttl = app.config.get('CACHE_STALE_TTL', 300)
+
+    envelope['expires_on'] = 0
+    put_cached_object(key, envelope, expire=stale_ttl)
+
+
+def register_hot_key(key, ttl, recompute):
+    """
+    Register the key to be kept fresh by refresh_hot_keys() (see manage.py cache_refresher)
+    """
+    hot_keys[key] = (ttl, recompute)
+
+
+def get_hot_key(key):
+    ttl, recompute = hot_keys[key]
+    return cached(key, ttl, recompute)
+
+
+def refresh_hot_keys(threshold=0.2):
+    """
+    Recompute registered hot keys which expire within threshold part of their TTL
+    """
+    stale_ttl = app.config.get('CACHE_STALE_TTL', 300)
+    refreshed = list()
+
+    for key, (ttl, recompute) in hot_keys.items():
+        envelope = _get_envelope(key)
+        if envelope is not None and envelope['expires_on'] - time.time() > ttl * threshold:
+            continue
+
+        recomputed, _ = _recompute(key, ttl, recompute, stale_ttl)
+        if recomputed:
+            refreshed.append(key)
+
+    return refreshed
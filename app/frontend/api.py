@@ -14,7 +14,7 @@ from app.utils.storage import ImagePresets
 from app.decorators import xhr_required, login_required
 from app.helpers import APIError
 from datetime import datetime, timedelta
-from .helpers import prepare_product
+from .helpers import prepare_products, prepare_product_cards
 from .forms import ReportAPIForm
 
 
@@ -51,6 +51,7 @@ def api_search():
     incoming_online = request.args.get('online', False)
     incoming_min_rating = request.args.get('min_rating', 0, type=int)
     incoming_search_id = request.args.get('search_id')
+    incoming_facets = request.args.get('facets', '').lower() in ('1', 'true')
 
     query_args = dict(
         q=incoming_query,
@@ -59,7 +60,8 @@ def api_search():
         price=incoming_prices,
         online=incoming_online,
         start=incoming_offset,
-        limit=incoming_limit
+        limit=incoming_limit,
+        facets=incoming_facets
     )
 
     if incoming_min_rating:
@@ -77,18 +79,21 @@ def api_search():
     if incoming_search_id:
         query_args['random_seed'] = incoming_search_id
 
+    # Render products from the cards stored in the search index, without loading them from the database
+    query_args['cards'] = app.config.get('SEARCH_CARDS_ENABLED', True)
+
     # import time
     # millis = int(round(time.time() * 1000))
 
-    ids, total, tags = search.search_products(**query_args)
+    result = search.search_products(**query_args)
+    results, total, tags = result[:3]
 
     # print 'after ES search', int(round(time.time() * 1000)) - millis
 
-    products = Product.get_multiple(ids)
-
-    # print 'after SQL search', int(round(time.time() * 1000)) - millis
-
-    products_prepared = map(prepare_product, products)
+    if query_args['cards']:
+        products_prepared = prepare_product_cards(results)
+    else:
+        products_prepared = prepare_products(Product.get_multiple(results), g.user)
 
     # print 'after preparation', int(round(time.time() * 1000)) - millis
 
@@ -102,13 +107,19 @@ def api_search():
             db.session.commit()
     # print 'before sending JSON', int(round(time.time() * 1000)) - millis
 
+    meta = dict(
+        total=total,
+        tags=tags,
+        favorite=favorite
+    )
+
+    if incoming_facets:
+        # Counts for the filter sidebar, calculated within the same search request
+        meta['facets'] = result[3]
+
     return json.jsonify(dict(
         data=products_prepared,
-        meta=dict(
-            total=total,
-            tags=tags,
-            favorite=favorite
-        )
+        meta=meta
     ))
 
 
@@ -270,7 +281,7 @@ def api_search_extra(product_id):
         products = Product.get_multiple(similar_products)
         products_type = 'similar'
 
-    products_prepared = map(prepare_product, products)
+    products_prepared = prepare_products(products, g.user)
 
     return json.jsonify(dict(
         data=products_prepared,
@@ -291,7 +302,7 @@ def api_search_user(user_id):
     best_products, best_products_total = search.search_best(seller=user, limit=incoming_limit, start=incoming_offset)
 
     products = Product.get_multiple(best_products)
-    products_prepared = map(prepare_product, products)
+    products_prepared = prepare_products(products, g.user)
 
     return json.jsonify(dict(
         data=products_prepared,
@@ -310,7 +321,7 @@ def api_search_multiple():
 
     products = Product.query.filter(Product.unique_id.in_(ids.split(','))).limit(6)
 
-    products_prepared = map(prepare_product, products)
+    products_prepared = prepare_products(products, g.user)
 
     return json.jsonify(products_prepared)
 
@@ -1,47 +1,136 @@
 from flask import g, url_for
 from datetime import datetime
 
-from app import app, cache
-from app.models import Category
+from app import app, db, cache, search
+from app.models import Category, User, Product, FavoriteProduct, Tag
 from app.messaging import NotificationTypes
 from app.utils.storage import Storage, ImagePresets
 
 
 def prepare_product(product):
-    product_prepared = product.to_json()
-    product_prepared['is_highlighted'] = bool(product.is_highlighted)
-    product_prepared['_is_pro'] = bool(product.seller.premium_member)
-    product_prepared['_is_new'] = (datetime.utcnow() - product.published_on).days < app.config['NEW_SERVICE_DAYS'] if product.published_on else False
-    product_prepared['_url'] = url_for('product', product_title=product.get_title_seofied(), product_id=product.unique_id)
-    product_prepared['_seller'] = product.seller.profile_display_name
-    product_prepared['_seller_url'] = url_for('user', username=product.seller.username)
-    product_prepared['_seller_is_online'] = product.seller.is_online
-    product_prepared['_seller_level'] = product.seller.level.code
-    product_prepared['_seller_rating'] = product.seller.rating
-    product_prepared['_seller_photo_url'] = product.seller.get_photo_url(ImagePresets.USER_ICON)
-    product_prepared['_tags'] = [tag.tag for tag in product.get_tags()]
-    product_prepared['_primary_photo_url'] = product.get_primary_photo(ImagePresets.SERVICE_THUMB_PRIMARY)
-    product_prepared['_primary_photo_url_smaller'] = product.get_primary_photo(ImagePresets.SERVICE_THUMB_SECONDARY)
-
-    if product.primary_photo_key and product.primary_photo_key.startswith('video:'):
-        product_prepared['_primary_video_key'] = product.primary_photo_key[6:]
-        product_prepared['_primary_video_poster_url'] = Storage.get_product_video_poster_url(product.primary_photo_key[6:])
-        product_prepared['_primary_video_urls'] = { format: Storage.get_product_video_url(product.primary_photo_key[6:], format) for format in ['mp4', 'webm'] }
-
-    cache_key = cache.SharedCache.FRONTEND_SERVICE_STATISTICS % product.id
-    product_statistics = cache.get_cached_object(cache_key)
-
-    if not product_statistics:
-        product_statistics = product.get_statistics()
-        cache.put_cached_object(cache_key, product_statistics, expire=3600)
-
-    product_prepared['_feedbacks_rating'] = product_statistics['feedbacks_rating']
-    product_prepared['_completed_count'] = product_statistics['completed']
-
-    # TODO: maybe do a JOIN on FavoriteProduct table?
-    product_prepared['_is_favorite'] = product.is_favorite(g.user) if g.user.is_authenticated else False
-
-    return product_prepared
+    return prepare_products([product], g.user)[0]
+
+
+def prepare_products(products, user):
+    """
+    Prepare products for the frontend with a constant number of queries: sellers, tags and favorites
+    are loaded with one query each, statistics are fetched from cache with a single MGET and calculated
+    for cache misses with grouped queries
+    """
+    products = list(products)
+    if not products:
+        return list()
+
+    # product.seller takes loaded sellers from the identity map (which holds weak references,
+    # so the list is kept until products are prepared)
+    seller_ids = set(product.seller_id for product in products)
+    sellers = User.query.filter(User.id.in_(seller_ids)).all()
+
+    product_tags = dict((product.id, product.get_data('tags') or []) for product in products)
+    all_tags = set(tag for tags in product_tags.values() for tag in tags)
+    existing_tags = set(tag for tag, in db.session.query(Tag.tag).filter(Tag.tag.in_(all_tags))) if all_tags else set()
+
+    favorite_ids = set()
+    if user.is_authenticated:
+        favorite_ids = set(product_id for product_id, in db.session.query(FavoriteProduct.product_id).filter(
+            FavoriteProduct.user_id == user.id,
+            FavoriteProduct.product_id.in_([product.id for product in products])
+        ))
+
+    cache_keys = dict((product.id, cache.SharedCache.FRONTEND_SERVICE_STATISTICS % product.id) for product in products)
+    cached_statistics = cache.get_cached_objects(cache_keys.values())
+
+    statistics = dict((product_id, cached_statistics[key]) for product_id, key in cache_keys.items() if key in cached_statistics)
+    missing_ids = [product.id for product in products if product.id not in statistics]
+
+    if missing_ids:
+        missing_statistics = Product.get_statistics_multiple(missing_ids)
+        cache.put_cached_objects(dict((cache_keys[product_id], missing_statistics[product_id]) for product_id in missing_ids), expire=3600)
+        statistics.update(missing_statistics)
+
+    # Same as seller.is_online with a single presence lookup for all sellers
+    sellers_last_seen = cache.get_users_last_seen(list(seller_ids))
+    sellers_online = dict((seller.id, User.is_seen_recently(User.get_last_seen_on(sellers_last_seen.get(seller.id), seller.last_logged_on))) for seller in sellers)
+
+    products_prepared = list()
+
+    for product in products:
+        product_prepared = product.to_json()
+        product_prepared['is_highlighted'] = bool(product.is_highlighted)
+        product_prepared['_is_pro'] = bool(product.seller.premium_member)
+        product_prepared['_is_new'] = (datetime.utcnow() - product.published_on).days < app.config['NEW_SERVICE_DAYS'] if product.published_on else False
+        product_prepared['_url'] = url_for('product', product_title=product.get_title_seofied(), product_id=product.unique_id)
+        product_prepared['_seller'] = product.seller.profile_display_name
+        product_prepared['_seller_url'] = url_for('user', username=product.seller.username)
+        product_prepared['_seller_is_online'] = sellers_online[product.seller_id]
+        product_prepared['_seller_level'] = product.seller.level.code
+        product_prepared['_seller_rating'] = product.seller.rating
+        product_prepared['_seller_photo_url'] = product.seller.get_photo_url(ImagePresets.USER_ICON)
+        product_prepared['_tags'] = [tag for tag in product_tags[product.id] if tag in existing_tags]
+        product_prepared['_primary_photo_url'] = product.get_primary_photo(ImagePresets.SERVICE_THUMB_PRIMARY)
+        product_prepared['_primary_photo_url_smaller'] = product.get_primary_photo(ImagePresets.SERVICE_THUMB_SECONDARY)
+
+        if product.primary_photo_key and product.primary_photo_key.startswith('video:'):
+            product_prepared['_primary_video_key'] = product.primary_photo_key[6:]
+            product_prepared['_primary_video_poster_url'] = Storage.get_product_video_poster_url(product.primary_photo_key[6:])
+            product_prepared['_primary_video_urls'] = { format: Storage.get_product_video_url(product.primary_photo_key[6:], format) for format in ['mp4', 'webm'] }
+
+        product_prepared['_feedbacks_rating'] = statistics[product.id]['feedbacks_rating']
+        product_prepared['_completed_count'] = statistics[product.id]['completed']
+
+        product_prepared['_is_favorite'] = product.id in favorite_ids
+
+        products_prepared.append(product_prepared)
+
+    return products_prepared
+
+
+def prepare_product_cards(results):
+    """
+    Prepare products found by search.search_products(cards=True) from the cards stored in the index.
+    Only online status of the sellers and favorites are looked up, products indexed without cards
+    are prepared from the database
+    """
+    missing_ids = [product_id for product_id, card in results if card is None]
+    missing_products = Product.get_multiple(missing_ids)
+    missing_prepared = dict((product.id, product_prepared) for product, product_prepared in zip(missing_products, prepare_products(missing_products, g.user)))
+
+    cards = [card for _, card in results if card is not None]
+
+    sellers_online = cache.is_user_online_multiple(list(set(card['_seller_id'] for card in cards))) if cards else dict()
+
+    favorite_ids = set()
+    if cards and g.user.is_authenticated:
+        favorite_ids = set(product_id for product_id, in db.session.query(FavoriteProduct.product_id).filter(
+            FavoriteProduct.user_id == g.user.id,
+            FavoriteProduct.product_id.in_([product_id for product_id, card in results if card is not None])
+        ))
+
+    products_prepared = list()
+
+    for product_id, card in results:
+        if card is None:
+            if long(product_id) in missing_prepared:
+                products_prepared.append(missing_prepared[long(product_id)])
+            continue
+
+        product_prepared = dict(card)
+
+        seller_id = product_prepared.pop('_seller_id')
+        unique_id = product_prepared.pop('_unique_id')
+        title_seofied = product_prepared.pop('_title_seofied')
+        published_on = product_prepared.pop('_published_on')
+        seller_username = product_prepared.pop('_seller_username')
+
+        product_prepared['_is_new'] = (datetime.utcnow() - datetime.utcfromtimestamp(published_on)).days < app.config['NEW_SERVICE_DAYS'] if published_on else False
+        product_prepared['_url'] = url_for('product', product_title=title_seofied, product_id=unique_id)
+        product_prepared['_seller_url'] = url_for('user', username=seller_username)
+        product_prepared['_seller_is_online'] = bool(sellers_online.get(seller_id))
+        product_prepared['_is_favorite'] = long(product_id) in favorite_ids
+
+        products_prepared.append(product_prepared)
+
+    return products_prepared
 
 
 def prepare_application_data(module=None):
@@ -81,30 +170,36 @@ def prepare_application_data(module=None):
 
     ## Building category tree
 
-    categories_top = cache.get_cached_object(cache.SharedCache.FRONTEND_CATEGORY_TREE)
+    application_data['categories'] = cache.get_hot_key(cache.SharedCache.FRONTEND_CATEGORY_TREE)
 
-    if not categories_top:
-        categories_all = Category.query_active().all()
-        categories_top = list()
-        categories_top_dict = dict()
+    return application_data
 
-        for category in categories_all:
-            if category.parent_id is None:
-                categories_top.append(dict(id=category.id, title=category.title, _title_seofied=category.get_title_seofied(), _url=url_for('category', category_title=category.get_title_seofied(), category_id=category.id)))
-                continue
 
-            categories_top_dict.setdefault(category.parent_id, []).append(dict(
-                id=category.id,
-                title=category.title,
-                _title_seofied=category.get_title_seofied(),
-                count=category.get_active_products_count()
-            ))
+def build_category_tree():
+    categories_all = Category.query_active().all()
+    categories_top = list()
+    categories_top_dict = dict()
 
-        for category in categories_top:
-            category['subcategories'] = categories_top_dict.get(category['id'], [])
+    # Counted like Category.get_active_products_count: private products included, inactive sellers excluded
+    _, facets = search.search_facets(include_private=True, active_sellers=True)
+    categories_counts = dict((item['id'], item['count']) for item in facets['categories']) if facets else dict()
 
-        cache.put_cached_object(cache.SharedCache.FRONTEND_CATEGORY_TREE, categories_top)
-        
-    application_data['categories'] = categories_top
+    for category in categories_all:
+        if category.parent_id is None:
+            categories_top.append(dict(id=category.id, title=category.title, _title_seofied=category.get_title_seofied(), _url=url_for('category', category_title=category.get_title_seofied(), category_id=category.id)))
+            continue
 
-    return application_data
+        categories_top_dict.setdefault(category.parent_id, []).append(dict(
+            id=category.id,
+            title=category.title,
+            _title_seofied=category.get_title_seofied(),
+            count=categories_counts.get(category.id, 0)
+        ))
+
+    for category in categories_top:
+        category['subcategories'] = categories_top_dict.get(category['id'], [])
+
+    return categories_top
+
+
+cache.register_hot_key(cache.SharedCache.FRONTEND_CATEGORY_TREE, 600, build_category_tree)
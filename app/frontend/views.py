@@ -3,8 +3,9 @@ from flask import request, abort, render_template, g, redirect, url_for, json, m
 from werkzeug.contrib.atom import AtomFeed
 from datetime import datetime, timedelta
 
-from app import app, search, cache
+from app import app, search, page_cache
 from app.models import Category, Product, User, Tag, Variable, UserSocialAccount, Order, Discount, AffiliateLink, EnquiryOffer, UserEndorsement
+from app.statistic import ProductViews
 from app.helpers import SearchPagination
 from app.utils import static_file_url, render_markdown
 from app.utils.storage import ImagePresets
@@ -67,11 +68,9 @@ def index():
 
     ## Price bounds
 
-    max_price = cache.get_cached_object(cache.SharedCache.FRONTEND_MAX_PRICE)
-
-    if max_price is None:
-        max_price = Product.get_max_price()
-        cache.put_cached_object(cache.SharedCache.FRONTEND_MAX_PRICE, max_price)
+    # The same for all users, like Product.get_max_price: public products of active sellers
+    _, facets = search.search_facets(active_sellers=True)
+    max_price = facets['price_max'] if facets else None
 
     application_data['extra']['price_bounds']=(0, max_price,)
 
@@ -90,11 +89,8 @@ def explore():
 
     ## Price bounds
 
-    max_price = cache.get_cached_object(cache.SharedCache.FRONTEND_MAX_PRICE)
-
-    if max_price is None:
-        max_price = Product.get_max_price()
-        cache.put_cached_object(cache.SharedCache.FRONTEND_MAX_PRICE, max_price)
+    _, facets = search.search_facets(active_sellers=True)
+    max_price = facets['price_max'] if facets else None
 
     application_data['extra'] = dict(
         price_bounds=(0, max_price,)
@@ -105,11 +101,14 @@ def explore():
 
 
 @app.route('/explore/<category_title>-<int:category_id>.html')
+@page_cache.cached_page(ttl=300)
 def category(category_title, category_id):
     category = Category.query.get(category_id)
     if not category:
         return redirect(url_for('index'))
 
+    page_cache.add_surrogate_keys('category:%d' % category.id)
+
     application_data = prepare_application_data()
     extra = dict()
 
@@ -124,12 +123,16 @@ def category(category_title, category_id):
 
     include_private = g.user.is_authenticated and g.user.premium_member
 
-    cache_key = (cache.SharedCache.FRONTEND_CATEGORY_STATISTICS if not include_private else cache.SharedCache.FRONTEND_CATEGORY_STATISTICS_INCL_PRIVATE) % displayed_category.id
-    displayed_category_statistics = cache.get_cached_object(cache_key)
+    if category:
+        total, facets = search.search_facets(include_private=include_private, active_sellers=True, category_id=category.id)
+    else:
+        category_ids = [subcategory.id for subcategory in top_category.query_subcategories()]
+        total, facets = search.search_facets(include_private=include_private, active_sellers=True, category_ids=category_ids)
 
-    if not displayed_category_statistics:
-        displayed_category_statistics = displayed_category.get_statistics(include_private=include_private)
-        cache.put_cached_object(cache_key, displayed_category_statistics)
+    displayed_category_statistics = dict(
+        products_count=total,
+        sellers_count=facets['sellers_count'] if facets else 0
+    )
 
     application_data['extra'] = dict(
         category_id=category.id if category else None,
@@ -144,7 +147,13 @@ def category(category_title, category_id):
                            displayed_category_statistics=displayed_category_statistics)
 
 
+def record_cached_product_view(context):
+    # Cached pages are served to anonymous users only
+    ProductViews.record(context['product_id'], ip=g.ip)
+
+
 @app.route('/service/<product_title>-<product_id>.html')
+@page_cache.cached_page(on_hit=record_cached_product_view)
 def product(product_title, product_id):
     product = Product.get_by_custom_id(product_id)
     if not product:
@@ -174,6 +183,9 @@ def product(product_title, product_id):
         ip=g.ip
     )
 
+    page_cache.add_surrogate_keys(*page_cache.get_product_surrogate_keys(product))
+    page_cache.set_page_context(product_id=product.id)
+
     product_categories = list()
     product_categories.append(Category.query.get(product.category_id))
     if product_categories[0].parent_id is not None:
@@ -437,11 +449,14 @@ def product_share(product_id, platform):
 
 
 @app.route('/freelancer/<username>.html')
+@page_cache.cached_page()
 def user(username):
     user = User.get_active_by_username(username)
     if not user:
         abort(404)
 
+    page_cache.add_surrogate_keys('seller:%d' % user.id, 'seller_products:%d' % user.id)
+
     application_data = prepare_application_data()
 
     application_data['extra'] = dict(
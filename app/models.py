@@ -3,21 +3,24 @@ import string
 import uuid
 import random
 import base64
+import time
 from datetime import datetime, timedelta, date
 from urllib import quote
 
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import or_, not_, UniqueConstraint
-from sqlalchemy.orm import validates
+from sqlalchemy import or_, not_, UniqueConstraint, event, inspect
+from sqlalchemy.orm import validates, load_only, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import func, text
 from sqlalchemy.sql.functions import coalesce
 from sqlalchemy_utils.types.choice import ChoiceType
 from sqlalchemy_utils.types.json import JSONType
 from flask_login import UserMixin
+from flask_sqlalchemy import SignallingSession
 from flask import url_for
 
-from app import app, db, messaging, email, cache, statistic
-from app.statistic import StatisticRecord
+from app import app, db, messaging, email, cache, page_cache
+from app.statistic import StatisticRecord, ProductViews
 from app.utils import seofy_title, generate_password_rsa
 from app.utils.country import COUNTRIES
 from app.utils.storage import Storage
@@ -53,6 +56,16 @@ class User(db.Model, UserMixin):
         ('top_rated', 'Top Rated Seller')
     ]
 
+    # Columns cached for the request path (see User.load_identity)
+    IDENTITY_FIELDS = ('id', 'username', 'email', 'tz', 'credit', 'bonus_credit', 'is_verified', 'is_deleted',
+                       'is_disabled', 'is_admin', 'seller_fee_paid', 'premium_member', 'is_affiliate_panel_enabled',
+                       'profile_first_name', 'profile_last_name', 'referer_id', 'level')
+    IDENTITY_EXPIRE = 600
+
+    # Cached referer lookups (see User.get_referer_id), missing users are cached for a shorter time
+    REFERER_EXPIRE = 86400
+    REFERER_MISSING_EXPIRE = 600
+
     __tablename__ = 'users'
 
     id = db.Column('user_id', db.Integer, primary_key=True)
@@ -221,9 +234,25 @@ class User(db.Model, UserMixin):
 
     # End of LoginManager-related methods
 
+    @property
+    def last_seen_on(self):
+        return User.get_last_seen_on(cache.get_user_last_seen(self.id), self.last_logged_on)
+
     @property
     def is_online(self):
-        return (datetime.utcnow() - self.last_logged_on).total_seconds() < 15 * 60
+        return User.is_seen_recently(self.last_seen_on)
+
+    @staticmethod
+    def get_last_seen_on(presence_last_seen_on, last_logged_on):
+        # last_logged_on is updated from the presence store periodically, either of them may be missing
+        if presence_last_seen_on is None or (last_logged_on and last_logged_on > presence_last_seen_on):
+            return last_logged_on
+
+        return presence_last_seen_on
+
+    @staticmethod
+    def is_seen_recently(last_seen_on):
+        return last_seen_on is not None and (datetime.utcnow() - last_seen_on).total_seconds() < cache.USER_ONLINE_EXPIRE
 
     @property
     def profile_name(self):
@@ -294,6 +323,73 @@ class User(db.Model, UserMixin):
             User.username==username
         ).first()
 
+    @staticmethod
+    def load_identity(user_id):
+        """
+        Returns user with only IDENTITY_FIELDS loaded, from cache if possible. Other columns are loaded
+        with a single query once any of them is accessed
+        """
+        cache_key = cache.SharedCache.USER_IDENTITY % user_id
+        identity = cache.get_cached_object(cache_key)
+
+        if identity is None:
+            user = User.query.options(load_only(*User.IDENTITY_FIELDS)).get(user_id)
+            if user is not None:
+                cache.put_cached_object(cache_key, dict((field, getattr(user, field)) for field in User.IDENTITY_FIELDS), expire=User.IDENTITY_EXPIRE)
+
+            return user
+
+        # Build detached user without firing attribute events and attach it to the session
+        # without a query. Columns which are not set are expired, so they are loaded on access
+        user = User.__mapper__.class_manager.new_instance()
+        for field, value in identity.items():
+            set_committed_value(user, field, value)
+
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def get_referer_id(username):
+        """
+        Returns id of the not deleted user with the username, or None. Lookups are cached,
+        including the ones of missing users
+        """
+        if not username or len(username) > 20:
+            return None
+
+        cache_key = cache.SharedCache.REFERER % username.lower().encode('utf-8')
+        referer_id = cache.get_cached_object(cache_key)
+
+        if referer_id is None:
+            referer = User.query.options(load_only('id')).filter(
+                User.username == username,
+                User.is_deleted != True
+            ).first()
+
+            referer_id = referer.id if referer else 0
+            cache.put_cached_object(cache_key, referer_id, expire=User.REFERER_EXPIRE if referer_id else User.REFERER_MISSING_EXPIRE)
+
+        return referer_id or None
+
+    @staticmethod
+    def warm_referer_cache(batch_size=1000):
+        """
+        Cache ids of users with affiliate panel enabled, so their links never hit the database
+        """
+        count = 0
+        query = db.session.query(User.id, User.username).filter(
+            User.is_affiliate_panel_enabled == True,
+            User.is_deleted != True
+        )
+
+        for idx in range(0, query.count(), batch_size):
+            rows = query.order_by(User.id).slice(idx, idx + batch_size).all()
+            cache.put_cached_objects(dict((cache.SharedCache.REFERER % username.lower().encode('utf-8'), user_id) for user_id, username in rows if username), expire=User.REFERER_EXPIRE)
+            count += len(rows)
+
+        return count
+
     @staticmethod
     def generate_token():
         return ''.join(random.choice(string.digits + string.ascii_letters) for _ in range(72))
@@ -790,7 +886,9 @@ class User(db.Model, UserMixin):
                 ip=ip
             )
         elif action == 'online':
-            self.last_logged_on = datetime.utcnow()
+            # Written to the database by periodic.flush_user_presence
+            cache.set_user_online(self.id)
+            return
         else:
             return
 
@@ -988,6 +1086,49 @@ class User(db.Model, UserMixin):
         return '<User %r>' % self.username
 
 
+# Cached identities, referer lookups and pages of users and products changed within a transaction
+# are invalidated after commit
+
+@event.listens_for(SignallingSession, 'after_flush')
+def collect_changed_users(session, flush_context):
+    user_ids = session.info.setdefault('changed_user_ids', set())
+    usernames = session.info.setdefault('changed_usernames', set())
+    page_surrogate_keys = session.info.setdefault('changed_page_surrogate_keys', set())
+
+    for instance in session.new.union(session.dirty, session.deleted):
+        if isinstance(instance, Product) and instance.id is not None:
+            page_surrogate_keys.add('product:%d' % instance.id)
+
+        if not isinstance(instance, User):
+            continue
+
+        if instance.id is not None:
+            user_ids.add(instance.id)
+            page_surrogate_keys.add('seller:%d' % instance.id)
+
+        # Previous username is still in the history here
+        history = inspect(instance).attrs.username.history
+        usernames.update(username for username in history.sum() if username)
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_changed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        cache.delete_cached_object(cache.SharedCache.USER_IDENTITY % user_id)
+
+    for username in session.info.pop('changed_usernames', ()):
+        cache.delete_cached_object(cache.SharedCache.REFERER % username.lower().encode('utf-8'))
+
+    page_cache.invalidate_surrogate_keys(session.info.pop('changed_page_surrogate_keys', ()))
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
+    session.info.pop('changed_usernames', None)
+    session.info.pop('changed_page_surrogate_keys', None)
+
+
 class UserSearchHistory(db.Model):
     __tablename__ = 'user_search_history'
 
@@ -2159,22 +2300,10 @@ class Product(db.Model):
             # Do not record view if viewed by the seller
             return
 
-        StatisticRecord.record_silent(
-            StatisticRecord.Types.SERVICE_IMPRESSION,
-            self.id,
-            user_id=user_id,
-            ip=ip
-        )
+        ProductViews.record(self.id, user_id=user_id, ip=ip)
 
     def get_views(self):
-        cache_key = cache.SharedCache.STATISTIC_SERVICE_IMPRESSION % self.id
-        cached = cache.get_cached_object(cache_key)
-        if cached:
-            return cached
-
-        views = statistic.StatisticRecord.count(statistic.StatisticRecord.Types.SERVICE_IMPRESSION, self.id)
-        cache.put_cached_object(cache_key, views)
-        return views
+        return ProductViews.get_views([self.id])[self.id]
 
     def query_feedbacks(self, rating=None):
         query = Feedback.query.filter(Feedback.type==Feedback.ON_SELLER, Feedback.order_id==Order.id, Order.product_id == self.id)
@@ -2270,6 +2399,63 @@ class Product(db.Model):
 
         return statistics
 
+    @staticmethod
+    def get_statistics_multiple(ids):
+        """
+        The same as get_statistics() but for multiple products, calculated with grouped queries.
+        Returns dict with product ID as a key
+        """
+        if not ids:
+            return dict()
+
+        queued = dict()
+        completed = dict()
+        feedback_counts = dict()
+
+        orders = db.session \
+            .query(Order.product_id, Order.state, coalesce(Order.is_pending, False), func.count(Order.id)) \
+            .filter(
+                Order.product_id.in_(ids),
+                Order.state.in_((Order.ACCEPTED, Order.SENT, Order.NEW, Order.CLOSED_COMPLETED))
+            ) \
+            .group_by(Order.product_id, Order.state, coalesce(Order.is_pending, False))
+
+        for product_id, state, is_pending, count in orders:
+            if state == Order.CLOSED_COMPLETED:
+                completed[product_id] = completed.get(product_id, 0) + count
+            elif not is_pending:
+                queued[product_id] = queued.get(product_id, 0) + count
+
+        feedbacks = db.session \
+            .query(Order.product_id, Feedback.rating, func.count(Feedback.id)) \
+            .filter(
+                Feedback.type == Feedback.ON_SELLER,
+                Feedback.order_id == Order.id,
+                Order.product_id.in_(ids)
+            ) \
+            .group_by(Order.product_id, Feedback.rating)
+
+        for product_id, rating, count in feedbacks:
+            feedback_counts.setdefault(product_id, dict())[rating] = count
+
+        result = dict()
+
+        for id in ids:
+            id = long(id)
+            counts = map(lambda rating: feedback_counts.get(id, {}).get(rating, 0), (Feedback.POSITIVE, Feedback.NEUTRAL, Feedback.NEGATIVE,))
+
+            statistics = dict()
+            statistics['queued'] = queued.get(id, 0)
+            statistics['completed'] = completed.get(id, 0)
+            statistics['feedbacks_count'] = sum(counts)
+            statistics['feedbacks_rating'] = (counts[0] * 5.0 + counts[1] * 3.0 + counts[2] * 1.0) / statistics['feedbacks_count'] if statistics['feedbacks_count'] > 0 else 0
+            statistics['feedbacks_rating'] = round(statistics['feedbacks_rating'] * 10) / 10.0  # Truncate to X.X form
+            statistics['feedbacks_rating_int'] = int(round(statistics['feedbacks_rating']))
+
+            result[id] = statistics
+
+        return result
+
     def get_approved_tags(self):
         tags = self.get_data('tags')
         if not tags:
@@ -4171,6 +4357,16 @@ class Discount(db.Model):
         )
 
 
+# All variables are kept in memory of every process and reloaded when one of them is set
+# (see Variable.set) or once in VARIABLES_MAX_AGE seconds in case a notification is lost
+VARIABLES_MAX_AGE = 300
+variables_registry = dict(values=None, set_on=None, loaded_on=0)
+
+
+def reset_variables_registry():
+    variables_registry['values'] = None
+
+
 class Variable(db.Model):
     __tablename__ = 'variables'
     id = db.Column('variable_id', db.String(50), primary_key=True)
@@ -4183,41 +4379,61 @@ class Variable(db.Model):
         db.session.merge(var)
         db.session.commit()
 
+        reset_variables_registry()
+        cache.publish_invalidation(cache.SharedCache.VARIABLES)
+
+    @staticmethod
+    def get_all():
+        values = variables_registry['values']
+
+        if values is None or time.time() - variables_registry['loaded_on'] > VARIABLES_MAX_AGE:
+            cache.ensure_invalidation_listener()
+
+            rows = db.session.query(Variable.id, Variable.value, Variable.set_on).all()
+
+            values = dict((key, value) for key, value, _ in rows)
+            variables_registry['values'] = values
+            variables_registry['set_on'] = dict((key, set_on) for key, _, set_on in rows)
+            variables_registry['loaded_on'] = time.time()
+
+        return values
+
+    @staticmethod
+    def get_set_on(key):
+        Variable.get_all()
+        return variables_registry['set_on'].get(key)
+
     @staticmethod
     def get(key, default=None):
-        value = default
-        var = Variable.query.get(key)
+        value = Variable.get_all().get(key)
+        return value if value else default
 
-        if var and var.value:
-            value = var.value
+    @staticmethod
+    def get_float(key, default=None):
+        try:
+            return float(Variable.get(key, default))
+        except (TypeError, ValueError):
+            return default
 
-        return value
+    @staticmethod
+    def get_int(key, default=None):
+        try:
+            return int(Variable.get(key, default))
+        except (TypeError, ValueError):
+            return default
 
     @staticmethod
-    def get_exchange_rate():
-        # TODO: cache
-        exchange_rate = None
-        var = Variable.query.get('exchange_rate')
-        if var and var.value:
-            try:
-                exchange_rate = float(var.value)
-            except:
-                pass
+    def get_bool(key, default=None):
+        value = Variable.get_int(key)
+        return bool(value) if value is not None else default
 
-        return exchange_rate
+    @staticmethod
+    def get_exchange_rate():
+        return Variable.get_float('exchange_rate')
 
     @staticmethod
     def get_wu_enabled():
-        # TODO: cache
-        wu_enabled = True
-        var = Variable.query.get('wu_enabled')
-        if var and var.value:
-            try:
-                wu_enabled = bool(int(var.value))
-            except:
-                pass
-
-        return wu_enabled
+        return Variable.get_bool('wu_enabled', True)
 
     @staticmethod
     def set_wu_enabled(wu_enabled):
@@ -4248,6 +4464,9 @@ class Variable(db.Model):
         return u'{0:.2f} USD'.format(fee / 100.0)
 
 
+cache.on_invalidate(cache.SharedCache.VARIABLES, reset_variables_registry)
+
+
 class FavoriteProduct(db.Model):
     __tablename__ = 'favorite_products'
     id = db.Column('favorite_product_id', db.Integer, primary_key=True)
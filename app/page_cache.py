@@ -0,0 +1,166 @@
+import time
+import hashlib
+from functools import wraps
+
+from flask import g, request, session, make_response
+
+from app import app, app_versions, cache, redis, search
+
+
+# Rendered pages for anonymous users
+#
+# Pages are cached by URL and frontend version in the shared objects cache. While rendering,
+# views tag the page with surrogate keys of what it shows: product pages with product:<id> and
+# seller:<id>, freelancer pages with seller:<id> and seller_products:<id>, category pages with
+# category:<id>. Changes of sellers delete all pages tagged with seller:<id>, changes of products
+# delete the product page and the pages listing the product. Cached pages are served
+# with ETag and Last-Modified, so browsers revalidate them with conditional requests
+
+PAGE_CACHE_TTL = 600
+
+# Pages rendered for these arguments differ (affiliate script etc), so they are not cached
+PAGE_CACHE_SKIP_ARGS = ('referer', 'agent', 'invitation')
+
+
+def is_cacheable_request():
+    return app.config.get('PAGE_CACHE_ENABLED', True) \
+        and request.method == 'GET' \
+        and not request.is_xhr \
+        and not g.user.is_authenticated \
+        and not any(arg in request.args for arg in PAGE_CACHE_SKIP_ARGS)
+
+
+def get_page_key():
+    args = sorted(request.args.items(multi=True))
+    url = '%s?%s' % (request.path, '&'.join('%s=%s' % (key, value) for key, value in args))
+
+    return 'page:%s:%s' % (app_versions.get('frontend', ''), hashlib.md5(url.encode('utf-8')).hexdigest())
+
+
+def get_surrogate_set_key(surrogate_key):
+    return 'page_keys:%s' % surrogate_key
+
+
+def add_surrogate_keys(*surrogate_keys):
+    """
+    Tag the page being rendered, so it is invalidated by invalidate_surrogate_keys()
+    """
+    g.page_surrogate_keys = getattr(g, 'page_surrogate_keys', set()).union(surrogate_keys)
+
+
+def set_page_context(**kwargs):
+    """
+    Data to be passed to on_hit callback of cached_page, when the page is served from cache
+    """
+    g.page_context = dict(getattr(g, 'page_context', dict()), **kwargs)
+
+
+def invalidate_surrogate_keys(surrogate_keys):
+    set_keys = [get_surrogate_set_key(surrogate_key) for surrogate_key in surrogate_keys]
+    if not set_keys:
+        return
+
+    pipe = redis.pipeline(transaction=False)
+    for set_key in set_keys:
+        pipe.smembers(set_key)
+        pipe.delete(set_key)
+
+    page_keys = set()
+    for members in pipe.execute()[::2]:
+        page_keys.update(members)
+
+    if page_keys:
+        cache.delete_cached_objects(page_keys)
+
+
+def _make_page_response(page):
+    response = make_response(page['body'])
+    response.content_type = page['content_type']
+    response.set_etag(page['etag'])
+    response.last_modified = page['last_modified']
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request)
+
+
+def cached_page(ttl=PAGE_CACHE_TTL, on_hit=None):
+    """
+    Cache the view response for anonymous users. on_hit(context) is called for pages served
+    from cache to do what the view does besides rendering (recording views etc)
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_view(*args, **kwargs):
+            if not is_cacheable_request():
+                return func(*args, **kwargs)
+
+            page_key = get_page_key()
+            page = cache.get_cached_object(page_key)
+
+            if page is not None:
+                if on_hit:
+                    on_hit(page['context'])
+
+                return _make_page_response(page)
+
+            response = make_response(func(*args, **kwargs))
+
+            # Do not cache errors, redirects and responses which depend on the session
+            if response.status_code != 200 or session or 'Set-Cookie' in response.headers:
+                return response
+
+            body = response.get_data()
+            page = dict(
+                body=body,
+                content_type=response.content_type,
+                etag=hashlib.md5(body).hexdigest(),
+                last_modified=int(time.time()),
+                context=getattr(g, 'page_context', dict())
+            )
+
+            cache.put_cached_object(page_key, page, expire=ttl)
+
+            surrogate_keys = getattr(g, 'page_surrogate_keys', ())
+            if surrogate_keys:
+                pipe = redis.pipeline(transaction=False)
+                for surrogate_key in surrogate_keys:
+                    pipe.sadd(get_surrogate_set_key(surrogate_key), page_key)
+                    # The set may already tag pages which live longer than this one
+                    pipe.expire(get_surrogate_set_key(surrogate_key), max(ttl, PAGE_CACHE_TTL))
+                pipe.execute()
+
+            return _make_page_response(page)
+
+        return decorated_view
+    return decorator
+
+
+def get_product_surrogate_keys(product):
+    """
+    Keys to tag the product page with
+    """
+    return ['product:%d' % product.id, 'seller:%d' % product.seller_id]
+
+
+def get_product_listing_surrogate_keys(product):
+    """
+    Keys of the pages listing the product
+    """
+    surrogate_keys = ['seller_products:%d' % product.seller_id]
+    if product.category_id:
+        surrogate_keys.append('category:%d' % product.category_id)
+
+        category = product.category
+        if category and category.parent_id:
+            surrogate_keys.append('category:%d' % category.parent_id)
+
+    return surrogate_keys
+
+
+def invalidate_product_pages_handler(sender, product):
+    invalidate_surrogate_keys(['product:%d' % product.id] + get_product_listing_surrogate_keys(product))
+
+
+search.product_created.connect(invalidate_product_pages_handler)
+search.product_updated.connect(invalidate_product_pages_handler)
+search.product_deleted.connect(invalidate_product_pages_handler)
@@ -0,0 +1,101 @@
+import time
+import threading
+from redis import Redis
+from redis.client import BasePipeline
+
+
+LATENCY_STATS_KEY = 'redis:latency'
+LATENCY_FLUSH_INTERVAL = 10
+
+
+class LatencyStats(object):
+    """
+    Per-command call counters and total time (ms) collected in this process and
+    periodically added to the LATENCY_STATS_KEY hash in redis
+    """
+
+    def __init__(self):
+        self.counters = dict()
+        self.lock = threading.Lock()
+        self.flushed_on = time.time()
+
+    def record(self, command, elapsed):
+        with self.lock:
+            count, total = self.counters.get(command, (0, 0.0))
+            self.counters[command] = (count + 1, total + elapsed * 1000)
+
+    def pop(self):
+        with self.lock:
+            counters, self.counters = self.counters, dict()
+            self.flushed_on = time.time()
+
+        return counters
+
+    def should_flush(self):
+        return self.counters and time.time() - self.flushed_on > LATENCY_FLUSH_INTERVAL
+
+
+class TimedPipeline(BasePipeline, Redis):
+    def execute(self, raise_on_error=True):
+        started_on = time.time()
+        try:
+            return super(TimedPipeline, self).execute(raise_on_error)
+        finally:
+            self.latency_stats.record('PIPELINE', time.time() - started_on)
+
+
+class TimedRedis(Redis):
+    """
+    Redis client recording latency of every command. Pipelines are recorded
+    as PIPELINE, scripts as EVALSHA
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimedRedis, self).__init__(*args, **kwargs)
+        self.latency_stats = LatencyStats()
+
+    def execute_command(self, *args, **options):
+        started_on = time.time()
+        try:
+            return super(TimedRedis, self).execute_command(*args, **options)
+        finally:
+            self.latency_stats.record(args[0], time.time() - started_on)
+
+            if self.latency_stats.should_flush():
+                self.flush_latency_stats()
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.latency_stats = self.latency_stats
+        return pipe
+
+    def flush_latency_stats(self):
+        counters = self.latency_stats.pop()
+
+        # Plain pipeline, so flushing isn't recorded itself
+        pipe = super(TimedRedis, self).pipeline(transaction=False)
+        for command, (count, total) in counters.items():
+            pipe.hincrby(LATENCY_STATS_KEY, '%s:count' % command, count)
+            pipe.hincrbyfloat(LATENCY_STATS_KEY, '%s:time' % command, total)
+
+        try:
+            pipe.execute()
+        except Exception:
+            pass
+
+    def get_latency_stats(self):
+        """
+        Returns dict command -> dict(count, avg_ms) collected by all processes
+        """
+        self.flush_latency_stats()
+
+        stats = dict()
+        for field, value in self.hgetall(LATENCY_STATS_KEY).items():
+            command, metric = field.rsplit(':', 1)
+            stats.setdefault(command, dict(count=0, time=0.0))[metric] = float(value)
+
+        for command, item in stats.items():
+            item['count'] = int(item['count'])
+            item['avg_ms'] = item['time'] / item['count'] if item['count'] else None
+
+        return stats
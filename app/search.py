@@ -1,10 +1,18 @@
-import copy
+import json
+import time
+import calendar
 import random
+import hashlib
+import threading
+import collections
+import cPickle as pickle
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
 from blinker import Namespace
 from math import ceil
 
-from app import app, es
+from app import app, db, redis
+from app.search_backends import create_backend
 
 
 signals = Namespace()
@@ -12,6 +20,7 @@ product_created = signals.signal('product_created')
 product_updated = signals.signal('product_updated')
 product_deleted = signals.signal('product_deleted')
 seller_online = signals.signal('seller_online')
+seller_updated = signals.signal('seller_updated')
 
 
 class DocumentTypes:
@@ -29,607 +38,1521 @@ class ProductSorting:
     RANDOM = 6
 
 
-def create_index():
+# Backend
+#
+# Elasticsearch by default. SEARCH_BACKEND = 'memory' keeps the index in the memory of
+# every process (see search_backends), it is filled from the database on first use and
+# updated immediately by the index signals
+
+backend = create_backend(app.config.get('SEARCH_BACKEND', 'elasticsearch'))
+
+_local_index_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Backend for searches and live updates, local index is loaded before the first use
+    """
+    if backend.is_local and not getattr(backend, 'loaded', False):
+        with _local_index_lock:
+            if not getattr(backend, 'loaded', False):
+                load_local_index()
+                backend.loaded = True
+
+    return backend
+
+
+def load_local_index():
+    index = init_index() or get_aliased_index(get_write_alias())
+
+    # Loading may happen within a request, objects of its session are kept
+    reindex_sellers(index, workers=1, expunge=False)
+    reindex_products(index, workers=1, expunge=False)
+
+
+# Index versions
+#
+# Documents are stored in versioned physical indices (<name>_v<N>). Searches use
+# the read alias (<name>) and live updates use the write alias (<name>_write).
+# Rebuild fills a new version while live updates are written to both indices,
+# then both aliases are swapped at once. Previous version stays available for
+# rollback under <name>_previous alias.
+
+SEARCH_INDEX_BUILDING_KEY = 'search_index:building'
+SEARCH_INDEX_BUILDING_DIRTY_KEY = 'search_index:building:dirty'
+
+
+def get_read_alias():
+    return app.config['ELASTICSEARCH_INDEX']
+
+
+def get_write_alias():
+    return '%s_write' % app.config['ELASTICSEARCH_INDEX']
+
+
+def get_previous_alias():
+    return '%s_previous' % app.config['ELASTICSEARCH_INDEX']
+
+
+def create_index(index):
     settings = {
         "mappings": {
             DocumentTypes.USER: {},
             DocumentTypes.PRODUCT: {
                 "_parent": {
                     "type": DocumentTypes.USER
+                },
+                "properties": {
+                    # Product card is only stored, see get_product_card()
+                    "_card": {
+                        "type": "object",
+                        "enabled": False
+                    }
                 }
             }
         }
     }
 
-    es.create_index(app.config['ELASTICSEARCH_INDEX'], settings)
+    backend.create_index(index, settings)
+
+
+def delete_index(index):
+    backend.delete_index(index)
+
+
+def get_index_versions():
+    """
+    Returns sorted list of existing versions as (version, index name) tuples
+    """
+    prefix = '%s_v' % app.config['ELASTICSEARCH_INDEX']
+    indices = backend.get_indices(prefix)
+
+    return sorted((int(index[len(prefix):]), index) for index in indices if index[len(prefix):].isdigit())
+
+
+def get_aliased_index(alias):
+    indices = backend.get_aliased_indices(alias)
+    return indices[0] if indices else None
+
+
+def get_building_index():
+    return redis.get(SEARCH_INDEX_BUILDING_KEY)
+
+
+def get_write_indices():
+    """
+    Live updates go to the current version and to the one being built (if any)
+    """
+    indices = [get_write_alias()]
+
+    building_index = get_building_index()
+    if building_index:
+        indices.append(building_index)
+
+    return indices
+
+
+def _update_aliases(actions):
+    backend.update_aliases(actions)
+
+
+def _index_exists(index):
+    return backend.index_exists(index)
+
+
+def init_index():
+    """
+    Create the first version of the index, unless write alias already exists.
+    Index created before versioning was introduced gets the write alias instead
+    """
+    if get_aliased_index(get_write_alias()):
+        return None
+
+    if _index_exists(get_read_alias()):
+        _update_aliases([dict(add=dict(index=get_read_alias(), alias=get_write_alias()))])
+        return get_read_alias()
+
+    versions = get_index_versions()
+    index = '%s_v%d' % (app.config['ELASTICSEARCH_INDEX'], versions[-1][0] + 1 if versions else 1)
+
+    create_index(index)
+    swap_index(index)
+
+    return index
+
+
+def start_index_build():
+    """
+    Create new version of the index and start writing live updates to it
+    """
+    versions = get_index_versions()
+    index = '%s_v%d' % (app.config['ELASTICSEARCH_INDEX'], versions[-1][0] + 1 if versions else 1)
+
+    create_index(index)
+
+    pipe = redis.pipeline()
+    pipe.set(SEARCH_INDEX_BUILDING_KEY, index)
+    pipe.delete(SEARCH_INDEX_BUILDING_DIRTY_KEY)
+    pipe.execute()
+
+    return index
+
+
+def catch_up_index_build(index):
+    """
+    Reindex products changed while the index was being built.
+    Bulk reindex could have loaded them before the change and overwritten live update
+    """
+    ids = map(int, redis.smembers(SEARCH_INDEX_BUILDING_DIRTY_KEY))
+
+    for i in range(0, len(ids), 500):
+        _bulk(_get_product_actions(ids[i:i + 500], delete_missing=True), index=index)
 
+    return len(ids)
 
-def delete_index():
-    es.delete_index(app.config['ELASTICSEARCH_INDEX'])
+
+def finish_index_build(index):
+    swap_index(index)
+
+    pipe = redis.pipeline()
+    pipe.delete(SEARCH_INDEX_BUILDING_KEY)
+    pipe.delete(SEARCH_INDEX_BUILDING_DIRTY_KEY)
+    pipe.execute()
+
+
+def swap_index(index):
+    """
+    Atomically point read and write aliases to the index.
+    Index they pointed to before is kept as the previous version, the one
+    that was previous before is deleted
+    """
+    read_alias, write_alias, previous_alias = get_read_alias(), get_write_alias(), get_previous_alias()
+
+    current_index = get_aliased_index(write_alias)
+    previous_index = get_aliased_index(previous_alias)
+
+    actions = list()
+
+    if current_index == read_alias:
+        # Index created before versioning was introduced, it has to be deleted
+        # to free its name for the alias
+        print "WARNING: deleting unversioned index %s" % read_alias
+        delete_index(read_alias)
+    elif current_index:
+        actions.append(dict(remove=dict(index=current_index, alias=read_alias)))
+        actions.append(dict(remove=dict(index=current_index, alias=write_alias)))
+        actions.append(dict(add=dict(index=current_index, alias=previous_alias)))
+
+    if previous_index:
+        actions.append(dict(remove=dict(index=previous_index, alias=previous_alias)))
+
+    actions.append(dict(add=dict(index=index, alias=read_alias)))
+    actions.append(dict(add=dict(index=index, alias=write_alias)))
+
+    _update_aliases(actions)
+
+    # Cached search results come from the previous index
+    redis.incr('search_generation:index')
+
+    if previous_index and previous_index != index:
+        delete_index(previous_index)
+
+
+def rollback_index():
+    """
+    Point aliases back to the previous version
+    """
+    previous_index = get_aliased_index(get_previous_alias())
+    if not previous_index:
+        return None
+
+    swap_index(previous_index)
+
+    return previous_index
+
+
+def is_seller_indexable(seller):
+    # Do not add deleted users or users who are not sellers
+    return not seller.is_deleted and seller.seller_fee_paid
+
+
+def is_seller_active(seller):
+    # Products of inactive sellers are searchable, but they are not counted in facets of listings
+    return not seller.is_deleted and not seller.is_disabled and bool(seller.is_verified)
+
+
+def get_seller_document(seller):
+    return {
+        'last_logged_on': seller.last_seen_on,
+        '_seller': True
+    }
 
 
 def add_seller_to_index(seller):
-    if seller.is_deleted or not seller.seller_fee_paid:
-        # Do not add deleted users or users who are not sellers
+    if not is_seller_indexable(seller):
         return
 
-    es.index(app.config['ELASTICSEARCH_INDEX'], DocumentTypes.USER, {
-        'last_logged_on': seller.last_logged_on,
-        '_seller': True
-    }, seller.id)
+    for index in get_write_indices():
+        get_backend().index(index, DocumentTypes.USER, get_seller_document(seller), seller.id)
 
 def add_seller_to_index_handler(sender, seller):
-    add_seller_to_index(seller)
+    queue_seller_update(seller)
 
 
-def add_product_to_index(product):
-    if not product.is_approved or product.is_deleted or product.published_on is None:
-        # Do not add not approved and deleted products
-        return
+def is_product_indexable(product):
+    # Do not add not approved and deleted products
+    return product.is_approved and not product.is_deleted and product.published_on is not None
 
-    rating = product.get_statistics()['feedbacks_rating']
 
-    es.index(app.config['ELASTICSEARCH_INDEX'], DocumentTypes.PRODUCT, {
+def get_seller_card(seller):
+    """
+    Seller fields of the product cards
+    """
+    from app.utils.storage import ImagePresets
+
+    return {
+        '_is_pro': bool(seller.premium_member),
+        '_seller': seller.profile_display_name,
+        '_seller_username': seller.username,
+        '_seller_level': seller.level.code,
+        '_seller_rating': float(seller.rating or 0),
+        '_seller_photo_url': seller.get_photo_url(ImagePresets.USER_ICON)
+    }
+
+
+def get_product_card(product, statistics, tags):
+    """
+    Everything search result card needs, except request-dependent fields (URLs, online status,
+    favorites and novelty), which are added by frontend.helpers.prepare_product_cards
+    """
+    from app.utils.storage import Storage, ImagePresets
+
+    card = product.to_json()
+    card.update(get_seller_card(product.seller))
+    card.update({
+        'is_highlighted': bool(product.is_highlighted),
+        '_seller_id': product.seller_id,
+        '_unique_id': product.unique_id,
+        '_title_seofied': product.get_title_seofied(),
+        '_published_on': calendar.timegm(product.published_on.utctimetuple()) if product.published_on else None,
+        '_tags': tags,
+        '_primary_photo_url': product.get_primary_photo(ImagePresets.SERVICE_THUMB_PRIMARY),
+        '_primary_photo_url_smaller': product.get_primary_photo(ImagePresets.SERVICE_THUMB_SECONDARY),
+        '_feedbacks_rating': statistics['feedbacks_rating'],
+        '_completed_count': statistics['completed']
+    })
+
+    if product.primary_photo_key and product.primary_photo_key.startswith('video:'):
+        video_key = product.primary_photo_key[6:]
+        card['_primary_video_key'] = video_key
+        card['_primary_video_poster_url'] = Storage.get_product_video_poster_url(video_key)
+        card['_primary_video_urls'] = { format: Storage.get_product_video_url(video_key, format) for format in ['mp4', 'webm'] }
+
+    return card
+
+
+def get_product_document(product, statistics=None, tags=None):
+    """
+    Build search document of the product.
+    Statistics (as returned by Product.get_statistics) and existing tags are queried in case they are not provided
+    """
+    if statistics is None:
+        statistics = product.get_statistics()
+
+    if tags is None:
+        tags = [tag.tag for tag in product.get_tags()]
+
+    rating = statistics['feedbacks_rating']
+
+    return {
         'title': product.title,
         'description': product.description,
         'category_id': product.category_id,
+        'top_category_id': (product.category.parent_id or product.category_id) if product.category else None,
         'seller_id': product.seller_id,
         'is_private': product.is_private,
+        'seller_active': is_seller_active(product.seller),
         'is_highlighted': product.is_highlighted,
         'published_on': product.published_on,
         'price': product.price_offer if product.active_offer_id else product.price,
         'price_base': product.price,
         'tags': product.get_data('tags') or [],
-        '_orders_count': product.get_completed_orders_count(),
+        '_orders_count': statistics['completed'],
         '_feedbacks_rating': rating,
-        '_feedbacks_rating_int': int(round(rating))
-    }, product.id, parent=product.seller_id)
+        '_feedbacks_rating_int': int(round(rating)),
+        '_card': get_product_card(product, statistics, tags)
+    }
+
+
+def _mark_building_dirty(product):
+    if get_building_index():
+        redis.sadd(SEARCH_INDEX_BUILDING_DIRTY_KEY, product.id)
+
+
+def add_product_to_index(product):
+    if not is_product_indexable(product):
+        return
+
+    _mark_building_dirty(product)
+
+    for index in get_write_indices():
+        get_backend().index(index, DocumentTypes.PRODUCT, get_product_document(product), product.id, parent=product.seller_id)
 
 def add_product_to_index_handler(sender, product):
-    add_product_to_index(product)
+    queue_product_update(product)
 
 
 def delete_product_from_index(product):
-    try:
-        es.delete(app.config['ELASTICSEARCH_INDEX'], DocumentTypes.PRODUCT, product.id, routing=product.seller.id)
-    except:
-        # Do not do anything in case there is no such document
-        pass
+    _mark_building_dirty(product)
+
+    for index in get_write_indices():
+        try:
+            get_backend().delete(index, DocumentTypes.PRODUCT, product.id, routing=product.seller.id)
+        except:
+            # Do not do anything in case there is no such document
+            pass
 
 def delete_product_from_index_handler(sender, product):
+    # Deleted, paused, rejected and private products are removed right away, the queued
+    # update is dropped as it would index products which are still approved again
+    redis.zrem(SEARCH_QUEUE_KEY, '%s:%d' % (DocumentTypes.PRODUCT, product.id))
+
     delete_product_from_index(product)
+    invalidate_search_cache(product)
 
 
-def search_products(q='', sorting=ProductSorting.RECOMMENDED, include_private=False, since=None, start=0, limit=20, **kwargs):
-    query = {
-        'query': {
+def _bulk(actions, index=None):
+    """
+    Send index/delete actions with a single _bulk request (to the write alias by default).
+    Actions are tuples of (operation, metadata, document), document is None for deletes
+    """
+    backend.bulk(index or get_write_alias(), actions)
+
+
+# Full reindex
+#
+# IDs are streamed with a server-side cursor on a dedicated connection, documents
+# are built in batches (with grouped statistics queries) and sent with _bulk
+# requests from a pool of workers. Last ID of each batch completed in order is
+# saved as a checkpoint, so interrupted reindex can be resumed.
+
+REINDEX_CHECKPOINT_KEY = 'search_reindex:checkpoint:%s'
+
+
+def _stream_ids(query, batch_size):
+    """
+    Yield lists of IDs selected by the query (single column, ordered by ID)
+    """
+    connection = db.engine.connect()
+
+    try:
+        result = connection.execution_options(stream_results=True).execute(query.statement)
+
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+
+            yield [row[0] for row in rows]
+    finally:
+        connection.close()
+
+
+def _get_seller_actions(ids):
+    from app.models import User
+
+    sellers = User.query.filter(User.id.in_(ids)).all()
+
+    return [
+        ('index', {'_type': DocumentTypes.USER, '_id': seller.id}, get_seller_document(seller))
+        for seller in sellers if is_seller_indexable(seller)
+    ]
+
+
+def _get_product_actions(ids, delete_missing=False, seed_seller_cards=False):
+    """
+    Seeding remembers seller card hashes of the indexed documents, which is correct only
+    when all the products of the sellers are indexed (full reindex)
+    """
+    from sqlalchemy.orm import joinedload
+    from app.models import Product, Tag
+
+    products = Product.query.filter(Product.id.in_(ids)).options(joinedload('seller'), joinedload('category')).all()
+    statistics = Product.get_statistics_multiple(ids)
+
+    # Existing tags of all the products with a single query
+    product_tags = dict((product.id, product.get_data('tags') or []) for product in products)
+    all_tags = set(tag for tags in product_tags.values() for tag in tags)
+    existing_tags = set(tag for tag, in db.session.query(Tag.tag).filter(Tag.tag.in_(all_tags))) if all_tags else set()
+
+    actions = list()
+    seller_cards = dict()
+
+    for product in products:
+        meta = {'_type': DocumentTypes.PRODUCT, '_id': product.id, '_parent': product.seller_id}
+
+        if is_product_indexable(product):
+            tags = [tag for tag in product_tags[product.id] if tag in existing_tags]
+            actions.append(('index', meta, get_product_document(product, statistics[product.id], tags)))
+
+            if seed_seller_cards and product.seller_id not in seller_cards:
+                seller_cards[product.seller_id] = get_seller_card_hash(product.seller)
+        elif delete_missing:
+            actions.append(('delete', meta, None))
+
+    if seller_cards:
+        redis.hmset(SEARCH_SELLER_CARDS_KEY, seller_cards)
+
+    return actions
+
+
+def _get_reindex_product_actions(ids):
+    return _get_product_actions(ids, seed_seller_cards=True)
+
+
+def _reindex(name, index, ids_query, id_column, get_actions, batch_size=500, workers=4, resume=False, expunge=True):
+    checkpoint_key = REINDEX_CHECKPOINT_KEY % name
+
+    last_id = int(redis.get(checkpoint_key) or 0) if resume else 0
+    if last_id:
+        print "Resuming %s reindex after ID %d" % (name, last_id)
+
+    ids_query = ids_query.filter(id_column > last_id).order_by(id_column.asc())
+
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    progress = dict(indexed=0, started=time.time())
+
+    def complete_oldest():
+        batch_last_id, count, async_result = pending.popleft()
+        async_result.get()
+
+        # All the batches up to this one are indexed
+        redis.set(checkpoint_key, batch_last_id)
+
+        progress['indexed'] += count
+        elapsed = time.time() - progress['started']
+        print "Indexed %d %s, last ID %d (%.1f docs/sec)" % (progress['indexed'], name, batch_last_id, progress['indexed'] / elapsed if elapsed else 0)
+
+    try:
+        for ids in _stream_ids(ids_query, batch_size):
+            actions = get_actions(ids)
+
+            if expunge:
+                # Do not keep loaded objects in the session
+                db.session.expunge_all()
+
+            pending.append((ids[-1], len(actions), pool.apply_async(_bulk, (actions, index))))
+
+            while len(pending) > workers:
+                complete_oldest()
+
+        while pending:
+            complete_oldest()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    redis.delete(checkpoint_key)
+
+    return progress['indexed']
+
+
+def reindex_sellers(index, batch_size=500, workers=4, resume=False, expunge=True):
+    from app.models import User
+
+    query = db.session.query(User.id).filter(User.is_deleted != True, User.seller_fee_paid == True)
+    return _reindex('sellers', index, query, User.id, _get_seller_actions, batch_size=batch_size, workers=workers, resume=resume, expunge=expunge)
+
+
+def reindex_products(index, batch_size=500, workers=4, resume=False, expunge=True):
+    from app.models import Product
+
+    query = Product.query_active(include_private=True).with_entities(Product.id)
+    return _reindex('products', index, query, Product.id, _get_reindex_product_actions, batch_size=batch_size, workers=workers, resume=resume, expunge=expunge)
+
+
+# Index update queue
+#
+# Signal handlers only put document keys into a sorted set scored by the time of
+# the last update, so repeated updates of the same document are coalesced into one
+# entry. Worker (manage.py search_queue_worker) takes the oldest entries, builds
+# documents from the current database state and sends them with _bulk. Entries are
+# removed only if their score is unchanged, so updates queued during the flush are
+# processed once more.
+
+SEARCH_QUEUE_KEY = 'search_queue'
+
+# Hashes of the seller fields of product cards, per seller ID
+SEARCH_SELLER_CARDS_KEY = 'search_seller_cards'
+
+# Seconds to wait before indexing, to coalesce bursts of updates
+SEARCH_QUEUE_DELAY = 1
+
+_dequeue_script = redis.register_script("""
+local removed = 0
+for i = 1, #ARGV, 2 do
+    if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[i])) == tonumber(ARGV[i + 1]) then
+        removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+""")
+
+
+def _queue_update(doc_type, doc_id):
+    redis.zadd(SEARCH_QUEUE_KEY, **{'%s:%d' % (doc_type, doc_id): time.time()})
+
+
+def queue_seller_update(seller):
+    if get_backend().is_local:
+        # There is no worker which would update the index of this process
+        add_seller_to_index(seller)
+
+        changed_seller_cards, product_ids = _get_changed_seller_products([seller.id])
+        if product_ids:
+            actions = _get_product_actions(product_ids, delete_missing=True)
+            for index in get_write_indices():
+                _bulk(actions, index)
+
+            redis.hmset(SEARCH_SELLER_CARDS_KEY, changed_seller_cards)
+            _invalidate_products_search_cache(product_ids)
+        return
+
+    _queue_update(DocumentTypes.USER, seller.id)
+
+
+def queue_product_update(product):
+    if get_backend().is_local:
+        actions = _get_product_actions([product.id], delete_missing=True)
+        for index in get_write_indices():
+            _bulk(actions, index)
+
+        invalidate_search_cache(product)
+        return
+
+    _mark_building_dirty(product)
+    _queue_update(DocumentTypes.PRODUCT, product.id)
+
+
+def _invalidate_products_search_cache(product_ids):
+    from app.models import Product
+
+    products = db.session.query(Product.id, Product.seller_id, Product.category_id) \
+                         .filter(Product.id.in_(product_ids))
+
+    for product in products:
+        invalidate_search_cache(product)
+
+
+def get_search_queue_length():
+    return redis.zcard(SEARCH_QUEUE_KEY)
+
+
+def get_seller_card_hash(seller):
+    """
+    Hash of the seller fields of product documents
+    """
+    return hashlib.md5(json.dumps(dict(get_seller_card(seller), seller_active=is_seller_active(seller)), sort_keys=True)).hexdigest()
+
+
+def _get_changed_seller_products(seller_ids):
+    """
+    Returns (changed seller card hashes, IDs of the products of these sellers)
+    """
+    from app.models import Product
+
+    changed_seller_cards = _get_changed_seller_cards(seller_ids)
+    if not changed_seller_cards:
+        return changed_seller_cards, []
+
+    query = Product.query_active(include_private=True) \
+                   .filter(Product.seller_id.in_(changed_seller_cards.keys())) \
+                   .with_entities(Product.id)
+
+    return changed_seller_cards, [product_id for product_id, in query]
+
+
+def _get_changed_seller_cards(seller_ids):
+    """
+    Returns hashes of seller cards which differ from the ones products were indexed with
+    """
+    from app.models import User
+
+    sellers = User.query.filter(User.id.in_(seller_ids)).all()
+
+    hashes = [(seller.id, get_seller_card_hash(seller)) for seller in sellers if is_seller_indexable(seller)]
+
+    if not hashes:
+        return dict()
+
+    previous_hashes = redis.hmget(SEARCH_SELLER_CARDS_KEY, [seller_id for seller_id, _ in hashes])
+
+    return dict(
+        (seller_id, card_hash)
+        for (seller_id, card_hash), previous_hash in zip(hashes, previous_hashes) if card_hash != previous_hash
+    )
+
+
+def process_search_queue(batch_size=500):
+    """
+    Index up to batch_size oldest queued documents (or delete products which are not indexable anymore).
+    Returns count of processed entries
+    """
+    entries = redis.zrangebyscore(SEARCH_QUEUE_KEY, '-inf', time.time() - SEARCH_QUEUE_DELAY,
+                                  start=0, num=batch_size, withscores=True)
+    if not entries:
+        return 0
+
+    ids = collections.defaultdict(list)
+
+    for member, score in entries:
+        doc_type, doc_id = member.split(':')
+        ids[doc_type].append(int(doc_id))
+
+    seller_ids, product_ids = ids[DocumentTypes.USER], ids[DocumentTypes.PRODUCT]
+
+    actions = list()
+    changed_seller_cards = dict()
+
+    if seller_ids:
+        actions.extend(_get_seller_actions(seller_ids))
+
+        # Products of the sellers who have changed their name, photo, level, etc. carry
+        # outdated cards. Sellers are queued whenever they come online, which is when
+        # such changes are made or noticed, and when admins change their status
+        changed_seller_cards, seller_product_ids = _get_changed_seller_products(seller_ids)
+        product_ids = list(set(product_ids) | set(seller_product_ids))
+
+    if product_ids:
+        actions.extend(_get_product_actions(product_ids, delete_missing=True))
+
+    for index in get_write_indices():
+        _bulk(actions, index)
+
+    args = list()
+    for member, score in entries:
+        args.extend((member, repr(score)))
+
+    _dequeue_script(keys=[SEARCH_QUEUE_KEY], args=args)
+
+    if changed_seller_cards:
+        redis.hmset(SEARCH_SELLER_CARDS_KEY, changed_seller_cards)
+
+    # Cached results are invalidated once the documents are searchable
+    if product_ids:
+        _invalidate_products_search_cache(product_ids)
+
+    db.session.expunge_all()
+
+    return len(entries)
+
+
+class ProductQuery(object):
+    """
+    Immutable product search specification.
+    Filters are built once and shared by search, count and aggregation bodies.
+    Instances are hashable and provide a stable cache key
+    """
+
+    # Filter arguments in the order they are applied
+    FILTER_KEYS = ('online', 'active_sellers', 'seller_id', 'category_id', 'category_ids', 'top_category_id', 'min_rating_int', 'rating_int', 'price', 'tags')
+
+    # Online sellers are those who logged on during this interval
+    ONLINE_INTERVAL = 15 * 60
+
+    def __init__(self, q=None, include_private=False, since=None, **kwargs):
+        params = dict(
+            q=q or None,
+            include_private=bool(include_private),
+            # Truncate to minutes, otherwise dates like "N days ago" would never produce the same key
+            since=since.replace(second=0, microsecond=0) if since else None
+        )
+
+        for key in self.FILTER_KEYS:
+            if key in kwargs:
+                value = kwargs[key]
+                params[key] = tuple(value) if isinstance(value, (list, tuple)) else value
+
+        object.__setattr__(self, '_params', tuple(sorted(params.items())))
+        object.__setattr__(self, '_filters', None)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('ProductQuery is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, ProductQuery) and self._params == other._params
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._params)
+
+    def __repr__(self):
+        return '<ProductQuery %r>' % (self._params,)
+
+    def get(self, key, default=None):
+        return dict(self._params).get(key, default)
+
+    def replace(self, **changes):
+        """
+        Return a new query with some of the parameters changed
+        """
+        params = dict(self._params)
+        params.update(changes)
+        return ProductQuery(**params)
+
+    def cache_key(self):
+        """
+        Stable key of the query, the same for equal queries across processes
+        """
+        params = [(key, value.isoformat() if isinstance(value, datetime) else value) for key, value in self._params]
+        return hashlib.md5(json.dumps(params)).hexdigest()
+
+    def get_filters(self):
+        if self._filters is None:
+            object.__setattr__(self, '_filters', tuple(self._build_filters()))
+
+        return list(self._filters)
+
+    def _build_filters(self):
+        params = dict(self._params)
+        filters = list()
+
+        if params.get('online'):
+            filters.append(self.online_filter())
+
+        if params['since']:
+            filters.append({
+                'range': {
+                    'published_on': {
+                        'gte': params['since']
+                    }
+                }
+            })
+
+        if params.get('active_sellers'):
+            # Documents indexed before seller_active was added are treated as active
+            filters.append({
+                'bool': {
+                    'must_not': {
+                        'term': {
+                            'seller_active': False
+                        }
+                    }
+                }
+            })
+
+        if 'seller_id' in params:
+            # Filter by seller ID
+            filters.append({
+                'term': {
+                    'seller_id': params['seller_id']
+                }
+            })
+
+        if 'category_id' in params:
+            # Filter by category ID
+            filters.append({
+                'term': {
+                    'category_id': params['category_id']
+                }
+            })
+
+        if 'category_ids' in params:
+            # Filter by multiple category IDs
+            filters.append({
+                'terms': {
+                    'category_id': params['category_ids']
+                }
+            })
+
+        if 'top_category_id' in params:
+            # Filter by top-level category, including all its subcategories
+            filters.append({
+                'term': {
+                    'top_category_id': params['top_category_id']
+                }
+            })
+
+        if 'min_rating_int' in params:
+            filters.append({
+                'range': {
+                    '_feedbacks_rating_int': {
+                        'gte': params['min_rating_int']
+                    }
+                }
+            })
+
+        if 'rating_int' in params:
+            rating = params['rating_int']
+
+            # Convert rating from INT form to FLOAT, like 4 stars rating is actually range (3.5 - 4.5)
+
+            filters.append({
+                'range': {
+                    '_feedbacks_rating': {
+                        'gte': rating - 0.5,
+                        'lt': rating + 0.5
+                    }
+                }
+            })
+
+        if 'price' in params:
+            # Filter by min/max price
+            price_range = dict()
+            if params['price'][0]:
+                price_range['gte'] = params['price'][0]
+
+            if params['price'][1]:
+                price_range['lte'] = params['price'][1]
+
+            if price_range:
+                filters.append({
+                    'range': {
+                        'price': price_range
+                    }
+                })
+
+        if params.get('tags'):
+            # Filter by tags
+            for tag in params['tags']:
+                filters.append({
+                    'term': {
+                        'tags': tag
+                    }
+                })
+
+        if not params['include_private']:
+            # Do not include private products
+            filters.append({
+                'term': {
+                    'is_private': False
+                }
+            })
+
+        return filters
+
+    def get_query(self):
+        """
+        Filtered query (without scoring or sorting)
+        """
+        query = {
             'filtered': {
                 'filter': {
                     'bool': {
-                        'must': []
+                        'must': self.get_filters()
                     }
                 }
             }
-        },
-        'sort': [],
-        'fields': ['_feedbacks_rating_int'],
-        'aggs': {
-            'tags': {
-                'terms': { 'field': 'tags' }
-            }
         }
-    }
 
-    def push_filter(f):
-        # Shortcut for adding filters to the query
-        query['query']['filtered']['filter']['bool']['must'].append(f)
+        q = self.get('q')
+
+        if q:
+            # Include full-text match by query
+            query['filtered']['query'] = {
+                'multi_match': {
+                    'query': q,
+                    'fields': ['title^10', 'description']
+                }
+            }
+
+        return query
+
+    def count_body(self):
+        return {
+            'query': self.get_query()
+        }
 
-    if 'online' in kwargs and kwargs['online']:
-        push_filter({
+    def online_filter(self):
+        return {
             'has_parent': {
                 'type': DocumentTypes.USER,
                 'query': {
                     'range': {
                         'last_logged_on': {
-                            'gte': (datetime.utcnow() - timedelta(seconds=15 * 60))
+                            'gte': (datetime.utcnow() - timedelta(seconds=self.ONLINE_INTERVAL))
                         }
                     }
                 }
             }
-        })
+        }
 
-    if since:
-        push_filter({
-            'range': {
-                'published_on': {
-                    'gte': since
+    def aggregation_body(self, aggs):
+        return {
+            'query': self.get_query(),
+            'size': 0,
+            'aggs': aggs
+        }
+
+    def search_body(self, sorting, random_seed=None, cards=False):
+        body = {
+            'query': self.get_query(),
+            'sort': [],
+            'fields': ['_feedbacks_rating_int'],
+            'aggs': {
+                'tags': {
+                    'terms': { 'field': 'tags' }
                 }
             }
-        })
+        }
 
-    if 'seller_id' in kwargs:
-        # Filter by seller ID
-        push_filter({
-            'term': {
-                'seller_id': kwargs['seller_id']
+        if cards:
+            body['_source'] = ['_card']
+
+        if random_seed is None:
+            random_seed = random.randint(0, 10000000000)
+
+        sorting_key, sorting_order = None, None
+
+        if sorting == ProductSorting.PRICE_ASC:
+            sorting_key, sorting_order = 'price', 'asc'
+        elif sorting == ProductSorting.PRICE_DESC:
+            sorting_key, sorting_order = 'price', 'desc'
+        elif sorting == ProductSorting.ORDERS_DESC:
+            sorting_key, sorting_order = '_orders_count', 'desc'
+        elif sorting == ProductSorting.DATE_DESC:
+            sorting_key, sorting_order = 'published_on', 'desc'
+        elif sorting in (ProductSorting.RATING_DESC, ProductSorting.RECOMMENDED):
+            # This is used by recommended search to return random results, grouped by rating value (integer)
+
+            body['query'] = {
+                'function_score': {
+                    'query': body['query'],
+                    'functions': [{
+                        'random_score': {
+                            'seed': random_seed,
+                        },
+                        'weight': 1
+                    }, {
+                        'field_value_factor': {
+                            'field': '_feedbacks_rating_int',
+                            'factor': 1,
+                            'missing': 0
+                        },
+                        'weight': 10
+                    }, {
+                        'field_value_factor': {
+                            'field': 'is_highlighted',
+                            'factor': 1,
+                            'missing': 0
+                        },
+                        'weight': 100
+                    }],
+                    'score_mode': 'sum'
+                }
             }
-        })
 
-    if 'category_id' in kwargs:
-        # Filter by category ID
-        push_filter({
-            'term': {
-                'category_id': kwargs['category_id']
-            }
-        })
+            del body['sort']
 
-    if 'category_ids' in kwargs:
-        # Filter by multiple category IDs
-        push_filter({
-            'terms': {
-                'category_id': kwargs['category_ids']
-            }
-        })
+            if sorting == ProductSorting.RECOMMENDED:
+                # Include _feedbacks_rating to the fields so we will have an access to them later
+                body['fields'].append('_feedbacks_rating')
 
-    if 'min_rating_int' in kwargs:
-        push_filter({
-            'range': {
-                '_feedbacks_rating_int': {
-                    'gte': kwargs['min_rating_int']
+                # Include MAX aggregation on _feedback_rating
+                body['aggs']['_max_feedbacks_rating'] = { 'max': { 'field' : '_feedbacks_rating' } }
+
+                # Include counts per rating value (the same ranges as rating_int filter uses),
+                # so count of top rated products doesn't require a separate request
+                body['aggs']['_feedbacks_rating_ranges'] = {
+                    'range': {
+                        'field': '_feedbacks_rating',
+                        'ranges': [dict(key=str(rating), **{'from': rating - 0.5, 'to': rating + 0.5}) for rating in range(0, 6)]
+                    }
+                }
+        else:
+            # Random sorting
+            body['query'] = {
+                'function_score': {
+                    'query': body['query'],
+                    'functions': [{
+                        'random_score': {
+                            'seed': random_seed
+                        }
+                    }]
                 }
             }
-        })
 
-    if 'rating_int' in kwargs:
-        rating = kwargs['rating_int']
+            del body['sort']
 
-        # Convert rating from INT form to FLOAT, like 4 stars rating is actually range (3.5 - 4.5)
+        if sorting_key and sorting_order:
+            body['sort'].append({ sorting_key: { 'order': sorting_order } })
 
-        push_filter({
-            'range': {
-                '_feedbacks_rating': {
-                    'gte': rating - 0.5,
-                    'lt': rating + 0.5
-                }
-            }
-        })
+        return body
 
-    if 'price' in kwargs:
-        # Filter by min/max price
-        price_range = dict()
-        if kwargs['price'][0]:
-            price_range['gte'] = kwargs['price'][0]
 
-        if kwargs['price'][1]:
-            price_range['lte'] = kwargs['price'][1]
+def _multi_search(queries):
+    """
+    Send several product search bodies in a single _msearch request.
+    Bodies should contain from/size themselves. Returns responses in the same order
+    """
+    return get_backend().multi_search(get_read_alias(), DocumentTypes.PRODUCT, queries)
 
-        if price_range:
-            push_filter({
-                'range': {
-                    'price': price_range
-                }
-            })
 
-    if 'tags' in kwargs and kwargs['tags']:
-        # Filter by tags
-        for tag in kwargs['tags']:
-            push_filter({
-                'term': {
-                    'tags': tag
-                }
-            })
+# Facets
+#
+# Counts for filter sidebars, calculated by aggregations of the search request itself,
+# so they honour all the current filters
+
+# Price histogram bucket, in USD cents
+FACETS_PRICE_INTERVAL = 1000
+
 
-    if not include_private:
-        # Do not include private products
-        push_filter({
-            'term': {
-                'is_private': False
+def get_facet_aggregations(product_query):
+    return {
+        '_facet_categories': {
+            'terms': { 'field': 'category_id', 'size': 0 }
+        },
+        '_facet_top_categories': {
+            'terms': { 'field': 'top_category_id', 'size': 0 }
+        },
+        '_facet_ratings': {
+            'histogram': {
+                'field': '_feedbacks_rating_int',
+                'interval': 1,
+                'min_doc_count': 0,
+                'extended_bounds': { 'min': 0, 'max': 5 }
             }
-        })
-
-    if q:
-        # Include full-text match by query
-        query['query']['filtered']['query'] = {
-            'multi_match': {
-                'query': q,
-                'fields': ['title^10', 'description']
+        },
+        '_facet_prices': {
+            'histogram': {
+                'field': 'price',
+                'interval': app.config.get('SEARCH_FACETS_PRICE_INTERVAL', FACETS_PRICE_INTERVAL)
             }
-        }
-
-    sorting_key, sorting_order = None, None
-
-    if sorting == ProductSorting.PRICE_ASC:
-        sorting_key, sorting_order = 'price', 'asc'
-    elif sorting == ProductSorting.PRICE_DESC:
-        sorting_key, sorting_order = 'price', 'desc'
-    elif sorting == ProductSorting.ORDERS_DESC:
-        sorting_key, sorting_order = '_orders_count', 'desc'
-    elif sorting == ProductSorting.DATE_DESC:
-        sorting_key, sorting_order = 'published_on', 'desc'
-    elif sorting in (ProductSorting.RATING_DESC, ProductSorting.RECOMMENDED):
-        # This is used by recommended search to return random results, grouped by rating value (integer)
-
-        query_part = query['query']
-
-        query['query'] = {
-            'function_score': {
-                'query': query_part,
-                'functions': [{
-                    'random_score': {
-                        'seed': kwargs['random_seed'] if 'random_seed' in kwargs else random.randint(0, 10000000000),
-                    },
-                    'weight': 1
-                }, {
-                    'field_value_factor': {
-                        'field': '_feedbacks_rating_int',
-                        'factor': 1,
-                        'missing': 0
-                    },
-                    'weight': 10
-                }, {
-                    'field_value_factor': {
-                        'field': 'is_highlighted',
-                        'factor': 1,
-                        'missing': 0
-                    },
-                    'weight': 100
-                }],
-                'score_mode': 'sum'
+        },
+        '_facet_price_stats': {
+            'stats': { 'field': 'price' }
+        },
+        '_facet_sellers': {
+            'cardinality': { 'field': 'seller_id' }
+        },
+        '_facet_online': {
+            'filter': product_query.online_filter(),
+            'aggs': {
+                'sellers': {
+                    'cardinality': { 'field': 'seller_id' }
+                }
             }
         }
+    }
 
-        del query['sort']
-        
-        if sorting == ProductSorting.RECOMMENDED:
-            # Include _feedbacks_rating to the fields so we will have an access to them later
-            query['fields'].append('_feedbacks_rating')
 
-            # Include MAX aggregation on _feedback_rating
-            query['aggs']['_max_feedbacks_rating'] = { 'max': { 'field' : '_feedbacks_rating' } }
-    else:
-        # Random sorting
-        query_part = query['query']
-
-        query['query'] = {
-            'function_score': {
-                'query': query_part,
-                'functions': [{
-                    'random_score': {
-                        'seed': kwargs['random_seed'] if 'random_seed' in kwargs else random.randint(0, 10000000000)
-                    }
-                }]
-            }
-        }
+def get_facets(aggregations):
+    """
+    Convert facet aggregations of the search response
+    """
+    def buckets(name, key):
+        return [{key: int(bucket['key']), 'count': bucket['doc_count']} for bucket in aggregations[name]['buckets']]
+
+    price_stats = aggregations['_facet_price_stats']
+
+    return dict(
+        categories=buckets('_facet_categories', 'id'),
+        top_categories=buckets('_facet_top_categories', 'id'),
+        ratings=buckets('_facet_ratings', 'rating'),
+        prices=buckets('_facet_prices', 'price'),
+        price_min=int(price_stats['min']) if price_stats['min'] is not None else None,
+        price_max=int(price_stats['max']) if price_stats['max'] is not None else None,
+        sellers_count=aggregations['_facet_sellers']['value'],
+        online_sellers_count=aggregations['_facet_online']['sellers']['value']
+    )
+
+
+# Search result cache
+#
+# Results are cached per query, sorting, page and random seed. Every cached item
+# depends on generation counters: of the seller (if query is filtered by seller),
+# of the categories (if filtered by categories) or the global one. Counters are
+# bumped whenever a product is created, updated or deleted, so items that were
+# cached for older generations are ignored. Changes that become searchable only
+# after index refresh may still be cached, TTL limits how long such items live.
+
+SEARCH_CACHE_TTL = {
+    ProductSorting.RECOMMENDED: 300,
+    ProductSorting.RATING_DESC: 300,
+    ProductSorting.RANDOM: 300,
+    ProductSorting.DATE_DESC: 60,
+    ProductSorting.PRICE_ASC: 600,
+    ProductSorting.PRICE_DESC: 600,
+    ProductSorting.ORDERS_DESC: 600,
+    # Facets without products, see search_facets()
+    'facets': 300
+}
+
+SEARCH_CACHE_STATS_KEY = 'search_cache:stats'
+
+# Hits/misses counted by this process and not sent to redis yet
+search_cache_stats = dict(hits=0, misses=0)
+
+
+def _get_search_cache_ttl(sorting):
+    ttl = dict(SEARCH_CACHE_TTL)
+    ttl.update(app.config.get('SEARCH_CACHE_TTL', {}))
+    return ttl.get(sorting)
+
+
+def _get_search_generation_keys(product_query):
+    """
+    Generation counters the results of the query depend on.
+    Index generation is bumped when aliases are swapped to another version
+    """
+    if product_query.get('seller_id') is not None:
+        return ['search_generation:index', 'search_generation:seller:%d' % int(product_query.get('seller_id'))]
 
-        del query['sort']
+    category_ids = list(product_query.get('category_ids') or ())
+    if product_query.get('category_id') is not None:
+        category_ids.append(product_query.get('category_id'))
 
-    if sorting_key and sorting_order:
-        query['sort'].append({ sorting_key: { 'order': sorting_order } })
+    if category_ids:
+        return ['search_generation:index'] + ['search_generation:category:%d' % int(category_id) for category_id in sorted(set(category_ids))]
 
-    try:
-        products = es.search(query,
-                             index=app.config['ELASTICSEARCH_INDEX'],
-                             doc_type=DocumentTypes.PRODUCT,
-                             size=limit,
-                             es_from=start)
+    return ['search_generation:index', 'search_generation:all']
 
-        total = products['hits']['total']
-        tags = products['aggregations']['tags']['buckets']
-        ids = [product['_id'] for product in products['hits']['hits']]
+
+def get_search_cache_key(product_query, sorting, start, limit, random_seed=None, cards=False, facets=False):
+    """
+    Returns cache key for the search or None if result shouldn't be cached
+    """
+    if not app.config.get('SEARCH_CACHE_ENABLED', True):
+        return None
+
+    if not _get_search_cache_ttl(sorting):
+        return None
+
+    if random_seed is None and sorting in (ProductSorting.RECOMMENDED, ProductSorting.RATING_DESC, ProductSorting.RANDOM):
+        # Every search without a seed produces a different ordering
+        return None
+
+    key = '%s:%s:%s:%s:%s:%s:%s' % (product_query.cache_key(), sorting, start, limit, random_seed, int(cards), int(facets))
+    return 'cache:search:%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def _flush_search_cache_stats(pipe):
+    # Piggyback hit/miss counters on a pipeline which is executed anyway
+    for key in ('hits', 'misses'):
+        if search_cache_stats[key]:
+            pipe.hincrby(SEARCH_CACHE_STATS_KEY, key, search_cache_stats[key])
+            search_cache_stats[key] = 0
+
+
+def get_cached_search(cache_key, product_query):
+    """
+    Returns (cached search result or None, current generations).
+    Cached value and current generations are fetched within one round trip. In case of a miss
+    the generations are passed to put_cached_search(), so results of a search which was running
+    while the generations were bumped are stored for the older ones and ignored
+    """
+    generation_keys = _get_search_generation_keys(product_query)
+
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.get(cache_key)
+        pipe.mget(generation_keys)
+        _flush_search_cache_stats(pipe)
+        serialized, generations = pipe.execute()[:2]
     except:
-        return ([], 0, [])
+        return None, None
 
-    # print '------------'
-    # for product in products['hits']['hits']:
-    #     print '[%s] %d - %d' % ('X' if product['fields'].get('is_highlighted') else ' ', product['fields']['_feedbacks_rating_int'][0], product['_score'])
+    cached = None
 
-    # print '------------'
+    if serialized:
+        try:
+            cached_generations, result = pickle.loads(serialized)
+            if cached_generations == generations:
+                cached = result
+        except:
+            pass
+
+    search_cache_stats['hits' if cached is not None else 'misses'] += 1
+
+    return cached, generations
+
+
+def put_cached_search(cache_key, generations, sorting, result):
+    """
+    Stores search result for the generations returned by get_cached_search() before the search
+    """
+    if generations is None:
+        return
+
+    try:
+        redis.setex(cache_key, pickle.dumps((generations, result), pickle.HIGHEST_PROTOCOL), _get_search_cache_ttl(sorting))
+    except:
+        pass
 
-    tags = map(lambda item: dict(tag=item['key'], count=item['doc_count']), tags)
 
-    if sorting == ProductSorting.RECOMMENDED:
-        rating = round(products['aggregations']['_max_feedbacks_rating']['value']) if type(products['aggregations']['_max_feedbacks_rating']['value']) is float else 0
-        if rating:
-            search_kwargs = copy.deepcopy(kwargs)
-            search_kwargs['rating_int'] = rating
-            count_top_products = count_search_products(q, include_private=include_private, since=since, **search_kwargs)
-            
-            # print "Top products count: ", count_top_products
+def get_search_cache_stats():
+    stats = redis.hgetall(SEARCH_CACHE_STATS_KEY)
 
-            since_new = datetime.now() - timedelta(days=app.config['NEW_SERVICE_DAYS'])
-            count_new_products = count_search_products(q, include_private=include_private, since=since_new, **kwargs)
+    hits = int(stats.get('hits', 0)) + search_cache_stats['hits']
+    misses = int(stats.get('misses', 0)) + search_cache_stats['misses']
 
-            # print "New products count: ", count_new_products
+    return dict(
+        hits=hits,
+        misses=misses,
+        hit_ratio=float(hits) / (hits + misses) if hits + misses else None
+    )
 
-            max_new_products = min((count_top_products + 1) / 3, count_new_products)
 
-            # print "Max new. products: ", max_new_products
+def invalidate_search_cache(product):
+    """
+    Bump generations of everything the product could be found by
+    """
+    category_key = 'search_product_category:%d' % product.id
+
+    try:
+        # Remember indexed category of the product, so moving the product to another
+        # category invalidates searches in the previous one as well
+        previous_category_id = redis.getset(category_key, product.category_id or 0)
 
-            total += max_new_products
+        pipe = redis.pipeline(transaction=False)
+        pipe.incr('search_generation:all')
+        pipe.incr('search_generation:seller:%d' % product.seller_id)
 
-            # print "New total:", total
+        if product.category_id:
+            pipe.incr('search_generation:category:%d' % product.category_id)
 
-            new_products_injected = min(start / limit * (limit / 3), max_new_products)
+        if previous_category_id and int(previous_category_id) not in (0, product.category_id):
+            pipe.incr('search_generation:category:%d' % int(previous_category_id))
 
-            # print "New products already injected in previous pages: ", new_products_injected
+        pipe.execute()
+    except:
+        pass
 
-            new_product_ids = []
-            new_products_this_page = 0
 
-            if new_products_injected < max_new_products:
-                # Perform search on new products
+def search_products(q='', sorting=ProductSorting.RECOMMENDED, include_private=False, since=None, start=0, limit=20, cards=False, facets=False, **kwargs):
+    """
+    Returns (ids, total, tags). With cards=True (id, card) pairs are returned instead of ids,
+    card is None for products indexed without it. With facets=True facets (see get_facets)
+    are returned as the fourth item
+    """
+    product_query = ProductQuery(q, include_private=include_private, since=since, **kwargs)
+    random_seed = kwargs.get('random_seed')
 
-                top_products_this_page = 0
-                for product in products['hits']['hits']:
-                    if product['fields']['_feedbacks_rating'] >= (rating - 0.5):
-                        top_products_this_page += 1
+    cache_key = get_search_cache_key(product_query, sorting, start, limit, random_seed, cards, facets)
+    if cache_key:
+        cached, generations = get_cached_search(cache_key, product_query)
+        if cached is not None:
+            return cached
 
-                new_products_this_page = min((top_products_this_page + 1) / 3, max_new_products - new_products_injected)
+    try:
+        if sorting == ProductSorting.RECOMMENDED:
+            result = search_recommended_products(product_query, start=start, limit=limit, random_seed=random_seed, cards=cards, facets=facets)
+        else:
+            result = _search_products(product_query, sorting, start=start, limit=limit, random_seed=random_seed, cards=cards, facets=facets)
+    except:
+        # Do not cache failures
+        return ([], 0, [], None) if facets else ([], 0, [])
 
-                # print "Requesting new products to inject into current page: ", new_products_this_page
-                new_product_ids, _, _ = search_products(q, sorting=ProductSorting.RANDOM, include_private=include_private, since=since_new, start=new_products_injected, limit=new_products_this_page, **kwargs)
+    if cache_key:
+        put_cached_search(cache_key, generations, sorting, result)
 
-                # print "New product IDs: ", new_product_ids
+    return result
 
-            corrected_products_limit = limit - new_products_this_page
 
-            # print "Corrected products limit: ", corrected_products_limit
+def _get_hit_results(hits, cards=False):
+    if not cards:
+        return [hit['_id'] for hit in hits]
 
-            corrected_products_start = start - new_products_injected
+    return [(hit['_id'], hit.get('_source', {}).get('_card')) for hit in hits]
 
-            # print "Corrected products start: ", corrected_products_start
 
-            corrected_product_ids, _, _ = search_products(q, sorting=ProductSorting.RATING_DESC, include_private=include_private, since=since, start=corrected_products_start, limit=corrected_products_limit, **kwargs)
+def _search_products(product_query, sorting, start=0, limit=20, random_seed=None, cards=False, facets=False):
+    query = product_query.search_body(sorting, random_seed=random_seed, cards=cards)
 
-            # print "Corrected product IDs: ", corrected_product_ids
+    if facets:
+        query['aggs'].update(get_facet_aggregations(product_query))
 
-            ids = []
-            new_idx = 0
-            corrected_idx = 0
+    products = get_backend().search(get_read_alias(), DocumentTypes.PRODUCT, query, size=limit, start=start)
 
-            for i in range(start, start + limit):
-                if i % 3 == 2 and len(new_product_ids) > new_idx:
-                    ids.append(new_product_ids[new_idx])
-                    new_idx += 1
-                elif len(corrected_product_ids) > corrected_idx:
-                    ids.append(corrected_product_ids[corrected_idx])
-                    corrected_idx += 1
+    total = products['hits']['total']
+    tags = products['aggregations']['tags']['buckets']
+    ids = _get_hit_results(products['hits']['hits'], cards)
 
-            # print "Resulting IDs: ", ids
+    tags = map(lambda item: dict(tag=item['key'], count=item['doc_count']), tags)
 
-            return (ids, total, tags)
+    if facets:
+        return (ids, total, tags, get_facets(products['aggregations']))
 
     return (ids, total, tags)
 
 
-def count_search_products(q, include_private=False, since=None, **kwargs):
-    query = {
-        'query': {
-            'filtered': {
-                'filter': {
-                    'bool': {
-                        'must': []
-                    }
-                }
-            }
-        },
-        'sort': [],
-        'fields': []
-    }
+def search_recommended_products(product_query, start=0, limit=20, random_seed=None, cards=False, facets=False):
+    """
+    Recommended search: random results grouped by rating, with new products injected
+    into every third position while there are enough top rated products.
 
-    def push_filter(f):
-        # Shortcut for adding filters to the query
-        query['query']['filtered']['filter']['bool']['must'].append(f)
+    The sub-queries are planned ahead and sent as a single multi-search request, every
+    window is at most a page long:
+     - page window: top rated results of the page itself. Max rating and count of top
+       rated products are calculated by aggregations of the same request
+     - shifted window: the page shifted by all the new products which could have been
+       injected into previous pages (on pages after the first one)
+     - new products window: new products of this page, its total is the count of new products
 
-    if 'online' in kwargs and kwargs['online']:
-        push_filter({
-            'has_parent': {
-                'type': DocumentTypes.USER,
-                'query': {
-                    'range': {
-                        'last_logged_on': {
-                            'gte': (datetime.utcnow() - timedelta(seconds=15 * 60))
-                        }
-                    }
-                }
-            }
-        })
+    Only when there are fewer new products than could have been injected, the page
+    shifted by their actual count is requested separately.
 
-    if since:
-        push_filter({
-            'range': {
-                'published_on': {
-                    'gte': since
-                }
-            }
-        })
+    Raises an exception in case search request fails
+    """
+    if random_seed is None:
+        # All the windows have to be sliced from the same ordering
+        random_seed = random.randint(0, 10000000000)
 
-    if 'seller_id' in kwargs:
-        # Filter by seller ID
-        push_filter({
-            'term': {
-                'seller_id': kwargs['seller_id']
-            }
-        })
+    since_new = datetime.now() - timedelta(days=app.config['NEW_SERVICE_DAYS'])
 
-    if 'category_id' in kwargs:
-        # Filter by category ID
-        push_filter({
-            'term': {
-                'category_id': kwargs['category_id']
-            }
-        })
+    # At most a third of each previous page is taken by new products, and at most
+    # a third (of top rated products, rounded up) of the current one
+    max_new_products_injected = start / limit * (limit / 3) if limit else 0
+    max_new_products_this_page = (limit + 1) / 3
 
-    if 'category_ids' in kwargs:
-        # Filter by multiple category IDs
-        push_filter({
-            'terms': {
-                'category_id': kwargs['category_ids']
-            }
-        })
+    def get_top_window(offset, aggregations=False):
+        query = product_query.search_body(ProductSorting.RECOMMENDED, random_seed=random_seed, cards=cards)
+        query['from'] = offset
+        query['size'] = limit
 
-    if 'min_rating_int' in kwargs:
-        push_filter({
-            'range': {
-                '_feedbacks_rating_int': {
-                    'gte': kwargs['min_rating_int']
-                }
-            }
-        })
+        if not aggregations:
+            del query['aggs']
+        elif facets:
+            query['aggs'].update(get_facet_aggregations(product_query))
 
-    if 'rating_int' in kwargs:
-        rating = kwargs['rating_int']
+        return query
 
-        # Convert rating from INT form to FLOAT, like 4 stars rating is actually range (3.5 - 4.5)
+    query_new = product_query.replace(since=since_new).search_body(ProductSorting.RANDOM, random_seed=random_seed, cards=cards)
+    query_new['from'] = max_new_products_injected
+    query_new['size'] = max_new_products_this_page
+    query_new['fields'] = []
+    del query_new['aggs']
 
-        push_filter({
-            'range': {
-                '_feedbacks_rating': {
-                    'gte': rating - 0.5,
-                    'lt': rating + 0.5
-                }
-            }
-        })
+    queries = [get_top_window(start, aggregations=True), query_new]
+    if max_new_products_injected:
+        queries.append(get_top_window(start - max_new_products_injected))
 
-    if 'price' in kwargs:
-        # Filter by min/max price
-        price_range = dict()
-        if kwargs['price'][0]:
-            price_range['gte'] = kwargs['price'][0]
+    responses = _multi_search(queries)
+    products, new_products = responses[0], responses[1]
 
-        if kwargs['price'][1]:
-            price_range['lte'] = kwargs['price'][1]
+    total = products['hits']['total']
+    tags = products['aggregations']['tags']['buckets']
 
-        if price_range:
-            push_filter({
-                'range': {
-                    'price': price_range
-                }
-            })
+    tags = map(lambda item: dict(tag=item['key'], count=item['doc_count']), tags)
 
-    if 'tags' in kwargs and kwargs['tags']:
-        # Filter by tags
-        for tag in kwargs['tags']:
-            push_filter({
-                    'term': {
-                        'tags': tag
-                    }
-                })
+    # Facets describe the matching products, they are not affected by injection of the new ones
+    result_facets = (get_facets(products['aggregations']),) if facets else ()
 
-    if not include_private:
-        # Do not include private products
-        push_filter({
-            'term': {
-                'is_private': False
-            }
-        })
-
-    if q:
-        # Include full-text match by query
-        query['query']['filtered']['query'] = {
-            'multi_match': {
-                'query': q,
-                'fields': ['title^10', 'description']
-            }
-        }
+    # Hits of the requested page
+    page_hits = products['hits']['hits']
+    ids = _get_hit_results(page_hits, cards)
 
-    count = 0
+    max_rating = products['aggregations']['_max_feedbacks_rating']['value']
+    rating = round(max_rating) if type(max_rating) is float else 0
 
-    try:
-        es_count = es.count(query,
-                            index=app.config['ELASTICSEARCH_INDEX'],
-                            doc_type=DocumentTypes.PRODUCT)
+    if not rating:
+        return (ids, total, tags) + result_facets
 
-        count = es_count['count']
+    rating_buckets = products['aggregations']['_feedbacks_rating_ranges']['buckets']
+    count_top_products = next((bucket['doc_count'] for bucket in rating_buckets if bucket['key'] == str(int(rating))), 0)
+    count_new_products = new_products['hits']['total']
+
+    max_new_products = min((count_top_products + 1) / 3, count_new_products)
+
+    total += max_new_products
+
+    new_products_injected = min(max_new_products_injected, max_new_products)
+
+    new_product_ids = []
+    new_products_this_page = 0
+
+    if new_products_injected < max_new_products:
+        # All the possible new products were injected into previous pages, so the new
+        # products window starts right after them
+        top_products_this_page = 0
+        for product in page_hits:
+            if product['fields']['_feedbacks_rating'][0] >= (rating - 0.5):
+                top_products_this_page += 1
+
+        new_products_this_page = min((top_products_this_page + 1) / 3, max_new_products - new_products_injected)
+
+        new_product_ids = _get_hit_results(new_products['hits']['hits'][:new_products_this_page], cards)
+
+    # Shift top rated products by the count of the new products injected into previous pages
+    if new_products_injected == 0:
+        shifted_hits = page_hits
+    elif new_products_injected == max_new_products_injected:
+        shifted_hits = responses[2]['hits']['hits']
+    else:
+        shifted_hits = _multi_search((get_top_window(start - new_products_injected),))[0]['hits']['hits']
+
+    corrected_products_limit = limit - new_products_this_page
+    corrected_product_ids = _get_hit_results(shifted_hits[:corrected_products_limit], cards)
+
+    ids = []
+    new_idx = 0
+    corrected_idx = 0
+
+    for i in range(start, start + limit):
+        if i % 3 == 2 and len(new_product_ids) > new_idx:
+            ids.append(new_product_ids[new_idx])
+            new_idx += 1
+        elif len(corrected_product_ids) > corrected_idx:
+            ids.append(corrected_product_ids[corrected_idx])
+            corrected_idx += 1
+
+    return (ids, total, tags) + result_facets
+
+
+def search_facets(q='', include_private=False, since=None, **kwargs):
+    """
+    Facets (see get_facets) of the products matching the query, without the products themselves.
+    Returns (total, facets), facets are None in case search request fails
+    """
+    product_query = ProductQuery(q, include_private=include_private, since=since, **kwargs)
+
+    cache_key = get_search_cache_key(product_query, 'facets', 0, 0)
+    if cache_key:
+        cached, generations = get_cached_search(cache_key, product_query)
+        if cached is not None:
+            return cached
+
+    try:
+        es_result = get_backend().search(get_read_alias(), DocumentTypes.PRODUCT, product_query.aggregation_body(get_facet_aggregations(product_query)))
     except:
-        count = 0
+        return (0, None)
 
-    return count
+    result = (es_result['hits']['total'], get_facets(es_result['aggregations']))
 
+    if cache_key:
+        put_cached_search(cache_key, generations, 'facets', result)
 
-def count_tags(q, include_private=False, **kwargs):
-    query = {
-        'query': {
-            'filtered': {
-                'filter': {
-                    'bool': {
-                        'must': []
-                    }
-                }
-            }
-        },
-        'aggs': {
-            'tags': {
-                'terms': { 'field': 'tags' }
-            }
-        }
-    }
+    return result
 
-    def push_filter(f):
-        # Shortcut for adding filters to the query
-        query['query']['filtered']['filter']['bool']['must'].append(f)
 
-    if 'seller_id' in kwargs:
-        # Filter by seller ID
-        push_filter({
-            'term': {
-                'seller_id': kwargs['seller_id']
-            }
-        })
+def count_search_products(q, include_private=False, since=None, **kwargs):
+    product_query = ProductQuery(q, include_private=include_private, since=since, **kwargs)
 
-    if 'category_id' in kwargs:
-        # Filter by category ID
-        push_filter({
-            'term': {
-                'category_id': kwargs['category_id']
-            }
-        })
+    count = 0
 
-    if 'category_ids' in kwargs:
-        # Filter by multiple category IDs
-        push_filter({
-            'terms': {
-                'category_id': kwargs['category_ids']
-            }
-        })
+    try:
+        es_count = get_backend().count(get_read_alias(), DocumentTypes.PRODUCT, product_query.count_body())
 
-    if 'price' in kwargs:
-        # Filter by min/max price
-        price_range = dict()
-        if kwargs['price'][0]:
-            price_range['gte'] = kwargs['price'][0]
+        count = es_count['count']
+    except:
+        count = 0
 
-        if kwargs['price'][1]:
-            price_range['lte'] = kwargs['price'][1]
+    return count
 
-        if price_range:
-            push_filter({
-                'range': {
-                    'price': price_range
-                }
-            })
 
-    if not include_private:
-        # Do not include private products
-        push_filter({
-            'term': {
-                'is_private': False
-            }
-        })
-
-    if q:
-        # Include full-text match by query
-        query['query']['filtered']['query'] = {
-            'multi_match': {
-                'query': q,
-                'fields': ['title^10', 'description']
-            }
-        }
+def count_tags(q, include_private=False, **kwargs):
+    # Tags are counted regardless of date, rating and tags filters
+    filter_kwargs = dict((key, value) for key, value in kwargs.items() if key in ('seller_id', 'category_id', 'category_ids', 'price'))
+    product_query = ProductQuery(q, include_private=include_private, **filter_kwargs)
 
-    es_result = es.search(query,
-                          size=0,
-                          index=app.config['ELASTICSEARCH_INDEX'],
-                          doc_type=DocumentTypes.PRODUCT)
+    es_result = get_backend().search(get_read_alias(), DocumentTypes.PRODUCT, product_query.aggregation_body({
+        'tags': {
+            'terms': { 'field': 'tags' }
+        }
+    }))
 
     return es_result
 
@@ -664,11 +1587,7 @@ def search_best(product=None, seller=None, limit=3, start=0):
     }
 
     try:
-        products = es.search(query_best,
-                             index=app.config['ELASTICSEARCH_INDEX'],
-                             doc_type=DocumentTypes.PRODUCT,
-                             size=limit + 1,
-                             es_from=start)
+        products = get_backend().search(get_read_alias(), DocumentTypes.PRODUCT, query_best, size=limit + 1, start=start)
 
         total = products['hits']['total']
         products = [hit['_id'] for hit in products['hits']['hits'] if not product or (product and long(hit['_id']) != product.id)][:limit]
@@ -706,10 +1625,7 @@ def search_similar(product, limit=3):
     }
 
     try:
-        products = es.search(query_similar,
-                             index=app.config['ELASTICSEARCH_INDEX'],
-                             doc_type=DocumentTypes.PRODUCT,
-                             size=limit + 1)
+        products = get_backend().search(get_read_alias(), DocumentTypes.PRODUCT, query_similar, size=limit + 1)
 
         products = [hit['_id'] for hit in products['hits']['hits'] if long(hit['_id']) != product.id][:limit]
     except:
@@ -722,3 +1638,4 @@ product_created.connect(add_product_to_index_handler)
 product_updated.connect(add_product_to_index_handler)
 product_deleted.connect(delete_product_from_index_handler)
 seller_online.connect(add_seller_to_index_handler)
+seller_updated.connect(add_seller_to_index_handler)
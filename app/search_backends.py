@@ -0,0 +1,889 @@
+import re
+import abc
+import math
+import zlib
+import time
+import calendar
+import threading
+import collections
+from datetime import datetime, date
+from decimal import Decimal
+from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+
+from app import es
+
+
+class SearchBackend(object):
+    """
+    Storage and execution of search requests built by app.search.
+    Requests are Elasticsearch query DSL bodies, responses have the same format as Elasticsearch ones.
+    Backends must implement every abstract method, otherwise they can't be instantiated
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    # Backend keeps its index in the process memory, so documents are indexed
+    # immediately instead of going through the queue
+    is_local = False
+
+    @abc.abstractmethod
+    def create_index(self, index, settings):
+        pass
+
+    @abc.abstractmethod
+    def delete_index(self, index):
+        pass
+
+    @abc.abstractmethod
+    def index_exists(self, index):
+        pass
+
+    @abc.abstractmethod
+    def get_indices(self, prefix):
+        """
+        Names of the indices starting with prefix
+        """
+
+    @abc.abstractmethod
+    def get_aliased_indices(self, alias):
+        pass
+
+    @abc.abstractmethod
+    def update_aliases(self, actions):
+        """
+        Apply add/remove alias actions at once
+        """
+
+    @abc.abstractmethod
+    def index(self, index, doc_type, document, id, parent=None):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, index, doc_type, id, routing=None):
+        pass
+
+    @abc.abstractmethod
+    def bulk(self, index, actions):
+        """
+        Apply (operation, metadata, document) actions. Deletes of missing documents are ignored
+        """
+
+    @abc.abstractmethod
+    def search(self, index, doc_type, body, size=None, start=None):
+        pass
+
+    @abc.abstractmethod
+    def multi_search(self, index, doc_type, bodies):
+        """
+        Search with several bodies (containing from/size themselves) at once.
+        Raises an exception if any of them fails
+        """
+
+    @abc.abstractmethod
+    def count(self, index, doc_type, body):
+        pass
+
+
+class ElasticSearchBackend(SearchBackend):
+
+    def create_index(self, index, settings):
+        es.create_index(index, settings)
+
+    def delete_index(self, index):
+        es.delete_index(index)
+
+    def index_exists(self, index):
+        try:
+            es.send_request('GET', [index, '_settings'])
+        except ElasticHttpNotFoundError:
+            return False
+
+        return True
+
+    def get_indices(self, prefix):
+        return es.send_request('GET', ['%s*' % prefix, '_settings']).keys()
+
+    def get_aliased_indices(self, alias):
+        try:
+            return es.send_request('GET', ['_alias', alias]).keys()
+        except ElasticHttpNotFoundError:
+            return []
+
+    def update_aliases(self, actions):
+        es.send_request('POST', ['_aliases'], dict(actions=actions))
+
+    def index(self, index, doc_type, document, id, parent=None):
+        es.index(index, doc_type, document, id, parent=parent)
+
+    def delete(self, index, doc_type, id, routing=None):
+        try:
+            es.delete(index, doc_type, id, routing=routing)
+        except ElasticHttpNotFoundError:
+            pass
+
+    def bulk(self, index, actions):
+        lines = list()
+
+        for operation, meta, document in actions:
+            lines.append(es._encode_json({operation: meta}))
+            if document is not None:
+                lines.append(es._encode_json(document))
+
+        if not lines:
+            return
+
+        result = es.send_request('POST', [index, '_bulk'], '\n'.join(lines) + '\n')
+
+        if result.get('errors'):
+            for item in result['items']:
+                operation, item_result = item.items()[0]
+
+                if operation == 'delete' and item_result.get('status') == 404:
+                    # Document is already missing
+                    continue
+
+                if item_result.get('status', 200) >= 300:
+                    raise Exception('Bulk %s of document %s failed: %s' % (operation, item_result.get('_id'), item_result.get('error')))
+
+    def search(self, index, doc_type, body, size=None, start=None):
+        kwargs = dict()
+        if size is not None:
+            kwargs['size'] = size
+        if start is not None:
+            kwargs['es_from'] = start
+
+        return es.search(body, index=index, doc_type=doc_type, **kwargs)
+
+    def multi_search(self, index, doc_type, bodies):
+        lines = list()
+
+        for body in bodies:
+            lines.append(es._encode_json({}))
+            lines.append(es._encode_json(body))
+
+        result = es.send_request('GET', [index, doc_type, '_msearch'], '\n'.join(lines) + '\n')
+
+        responses = result['responses']
+
+        for response in responses:
+            if 'error' in response:
+                raise Exception('Multi-search request failed: %s' % response['error'])
+
+        return responses
+
+    def count(self, index, doc_type, body):
+        return es.count(body, index=index, doc_type=doc_type)
+
+
+# In-memory search engine
+#
+# Executes the subset of the query DSL app.search uses, for development, tests and
+# single-process deployments. Every process keeps its own copy of the index.
+#
+# Each document type is stored in slots: text fields (title, description) go to an
+# inverted index scored with BM25, other fields are kept in columns (a list of
+# values per field, indexed by slot) used for range filters, sorting and
+# aggregations, and in a term index (value -> slots) used for term filters.
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _analyze(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+
+    return TOKEN_RE.findall(text.lower())
+
+
+def _normalize(value):
+    """
+    Convert value to the form it is compared in: dates to epoch milliseconds, decimals to floats
+    """
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple()) * 1000.0 + value.microsecond / 1000
+    if isinstance(value, date):
+        return calendar.timegm(value.timetuple()) * 1000.0
+    if isinstance(value, Decimal):
+        return float(value)
+
+    return value
+
+
+def _as_list(value):
+    if value is None:
+        return []
+
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+class _Documents(object):
+    """
+    Documents of a single type
+    """
+
+    TEXT_FIELDS = ('title', 'description')
+
+    def __init__(self):
+        self.ids = list()
+        self.sources = list()
+        self.parents = list()
+        self.slots = dict()
+        self.free_slots = list()
+
+        self.columns = collections.defaultdict(list)
+        self.terms = collections.defaultdict(lambda: collections.defaultdict(set))
+
+        self.postings = collections.defaultdict(lambda: collections.defaultdict(dict))
+        self.lengths = collections.defaultdict(dict)
+        self.total_lengths = collections.defaultdict(int)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def live_slots(self):
+        return set(self.slots.itervalues())
+
+    def value(self, field, slot):
+        column = self.columns.get(field)
+        if column is None or slot >= len(column):
+            return None
+
+        return column[slot]
+
+    def put(self, id, source, parent=None):
+        id = unicode(id)
+
+        if id in self.slots:
+            self.remove(id)
+
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.ids[slot], self.sources[slot], self.parents[slot] = id, source, parent
+        else:
+            slot = len(self.ids)
+            self.ids.append(id)
+            self.sources.append(source)
+            self.parents.append(parent)
+
+        self.slots[id] = slot
+
+        for field, value in source.iteritems():
+            if value is None or isinstance(value, dict):
+                # Objects are only stored
+                continue
+
+            if field in self.TEXT_FIELDS and isinstance(value, basestring):
+                tokens = _analyze(value)
+
+                for token, frequency in collections.Counter(tokens).iteritems():
+                    self.postings[field][token][slot] = frequency
+
+                self.lengths[field][slot] = len(tokens)
+                self.total_lengths[field] += len(tokens)
+                continue
+
+            if isinstance(value, (list, tuple)):
+                value = tuple(_normalize(item) for item in value)
+                values = value
+            else:
+                value = _normalize(value)
+                values = (value,)
+
+            column = self.columns[field]
+            if len(column) <= slot:
+                column.extend([None] * (slot + 1 - len(column)))
+            column[slot] = value
+
+            for item in values:
+                self.terms[field][item].add(slot)
+
+    def remove(self, id):
+        id = unicode(id)
+
+        slot = self.slots.pop(id, None)
+        if slot is None:
+            return False
+
+        for field, column in self.columns.iteritems():
+            if slot < len(column) and column[slot] is not None:
+                for item in _as_list(column[slot]):
+                    self.terms[field][item].discard(slot)
+                column[slot] = None
+
+        for field, lengths in self.lengths.iteritems():
+            if slot in lengths:
+                self.total_lengths[field] -= lengths.pop(slot)
+
+                for token in set(_analyze(self.sources[slot][field])):
+                    postings = self.postings[field].get(token)
+                    if postings is not None:
+                        postings.pop(slot, None)
+                        if not postings:
+                            del self.postings[field][token]
+
+        self.ids[slot], self.sources[slot], self.parents[slot] = None, None, None
+        self.free_slots.append(slot)
+
+        return True
+
+
+class _MemoryIndex(object):
+
+    def __init__(self):
+        self.types = collections.defaultdict(_Documents)
+
+
+class MemorySearchBackend(SearchBackend):
+
+    is_local = True
+
+    def __init__(self):
+        self.indices = dict()
+        self.aliases = collections.defaultdict(set)
+        self.lock = threading.RLock()
+
+    # Indices and aliases
+
+    def _resolve(self, name):
+        if name in self.indices:
+            return [self.indices[name]]
+
+        if self.aliases.get(name):
+            return [self.indices[index] for index in sorted(self.aliases[name])]
+
+        raise ElasticHttpNotFoundError(404, 'IndexMissingException[[%s] missing]' % name)
+
+    def create_index(self, index, settings):
+        with self.lock:
+            if index in self.indices or index in self.aliases:
+                raise Exception('Index %s already exists' % index)
+
+            self.indices[index] = _MemoryIndex()
+
+    def delete_index(self, index):
+        with self.lock:
+            if index not in self.indices:
+                raise ElasticHttpNotFoundError(404, 'IndexMissingException[[%s] missing]' % index)
+
+            del self.indices[index]
+
+            for indices in self.aliases.itervalues():
+                indices.discard(index)
+
+    def index_exists(self, index):
+        return index in self.indices
+
+    def get_indices(self, prefix):
+        return [index for index in self.indices if index.startswith(prefix)]
+
+    def get_aliased_indices(self, alias):
+        return sorted(self.aliases.get(alias, ()))
+
+    def update_aliases(self, actions):
+        with self.lock:
+            for action in actions:
+                for operation, params in action.items():
+                    if params['index'] not in self.indices:
+                        raise ElasticHttpNotFoundError(404, 'IndexMissingException[[%s] missing]' % params['index'])
+
+                    if operation == 'add':
+                        self.aliases[params['alias']].add(params['index'])
+                    elif operation == 'remove':
+                        self.aliases[params['alias']].discard(params['index'])
+
+    # Documents
+
+    def index(self, index, doc_type, document, id, parent=None):
+        with self.lock:
+            for memory_index in self._resolve(index):
+                memory_index.types[doc_type].put(id, document, parent)
+
+    def delete(self, index, doc_type, id, routing=None):
+        with self.lock:
+            for memory_index in self._resolve(index):
+                memory_index.types[doc_type].remove(id)
+
+    def bulk(self, index, actions):
+        with self.lock:
+            indices = self._resolve(index)
+
+            for operation, meta, document in actions:
+                for memory_index in indices:
+                    documents = memory_index.types[meta['_type']]
+
+                    if operation == 'delete':
+                        documents.remove(meta['_id'])
+                    else:
+                        documents.put(meta['_id'], document, meta.get('_parent'))
+
+    # Search
+
+    def search(self, index, doc_type, body, size=None, start=None):
+        body = dict(body)
+        if size is not None:
+            body['size'] = size
+        if start is not None:
+            body['from'] = start
+
+        with self.lock:
+            return self._search(self._resolve(index)[0], doc_type, body)
+
+    def multi_search(self, index, doc_type, bodies):
+        with self.lock:
+            memory_index = self._resolve(index)[0]
+            return [self._search(memory_index, doc_type, body) for body in bodies]
+
+    def count(self, index, doc_type, body):
+        with self.lock:
+            memory_index = self._resolve(index)[0]
+            scores = self._query(memory_index, memory_index.types[doc_type], body.get('query', {'match_all': {}}))
+            return dict(count=len(scores))
+
+    def _search(self, memory_index, doc_type, body):
+        started = time.time()
+
+        documents = memory_index.types[doc_type]
+        scores = self._query(memory_index, documents, body.get('query', {'match_all': {}}))
+
+        slots = self._sort(documents, scores, body.get('sort'))
+
+        start = body.get('from', 0)
+        size = body.get('size', 10)
+
+        hits = list()
+
+        for slot in slots[start:start + size]:
+            source = documents.sources[slot]
+            hit = {
+                '_type': doc_type,
+                '_id': documents.ids[slot],
+                '_score': scores[slot]
+            }
+
+            if body.get('fields'):
+                hit['fields'] = dict((field, _as_list(source[field])) for field in body['fields'] if source.get(field) is not None)
+
+            source_filter = body.get('_source', 'fields' not in body)
+            if source_filter is True:
+                hit['_source'] = dict(source)
+            elif source_filter:
+                hit['_source'] = dict((field, source[field]) for field in _as_list(source_filter) if field in source)
+
+            hits.append(hit)
+
+        result = {
+            'took': int((time.time() - started) * 1000),
+            'timed_out': False,
+            'hits': {
+                'total': len(slots),
+                'max_score': max(scores.itervalues()) if scores else None,
+                'hits': hits
+            }
+        }
+
+        aggs = body.get('aggs', body.get('aggregations'))
+        if aggs:
+            result['aggregations'] = self._aggregate(memory_index, documents, slots, aggs)
+
+        return result
+
+    # Queries return dict of matching slots with their scores
+
+    def _query(self, memory_index, documents, clause):
+        (clause_type, params), = clause.items()
+
+        if clause_type == 'match_all':
+            return dict.fromkeys(documents.live_slots(), 1.0)
+
+        if clause_type == 'filtered':
+            scores = self._query(memory_index, documents, params.get('query', {'match_all': {}}))
+
+            if 'filter' in params:
+                matching = self._filter(memory_index, documents, params['filter'])
+                scores = dict((slot, score) for slot, score in scores.iteritems() if slot in matching)
+
+            return scores
+
+        if clause_type == 'bool':
+            scores = None
+
+            for subclause in _as_list(params.get('must')):
+                subscores = self._query(memory_index, documents, subclause)
+                if scores is None:
+                    scores = subscores
+                else:
+                    scores = dict((slot, score + subscores[slot]) for slot, score in scores.iteritems() if slot in subscores)
+
+            if scores is None:
+                scores = dict.fromkeys(documents.live_slots(), 1.0)
+
+            matching = self._filter(memory_index, documents, dict(bool=dict((key, value) for key, value in params.items() if key != 'must')))
+            return dict((slot, score) for slot, score in scores.iteritems() if slot in matching)
+
+        if clause_type == 'multi_match':
+            return self._multi_match(documents, params)
+
+        if clause_type == 'function_score':
+            return self._function_score(memory_index, documents, params)
+
+        # Other clauses do not score
+        return dict.fromkeys(self._filter(memory_index, documents, clause), 1.0)
+
+    def _multi_match(self, documents, params):
+        """
+        BM25 score of the best matching field (multiplied by its boost)
+        """
+        tokens = _analyze(params['query'])
+        scores = dict()
+
+        for field in params['fields']:
+            field, _, boost = field.partition('^')
+            boost = float(boost) if boost else 1.0
+
+            lengths = documents.lengths[field]
+            if not lengths:
+                continue
+
+            count = len(lengths)
+            average_length = float(documents.total_lengths[field]) / count or 1.0
+
+            field_scores = collections.defaultdict(float)
+
+            for token in tokens:
+                postings = documents.postings[field].get(token)
+                if not postings:
+                    continue
+
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+
+                for slot, frequency in postings.iteritems():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[slot] / average_length)
+                    field_scores[slot] += boost * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+            for slot, score in field_scores.iteritems():
+                if score > scores.get(slot, 0):
+                    scores[slot] = score
+
+        return scores
+
+    def _function_score(self, memory_index, documents, params):
+        scores = self._query(memory_index, documents, params.get('query', {'match_all': {}}))
+
+        functions = params.get('functions')
+        if functions is None:
+            functions = [dict((key, value) for key, value in params.items() if key not in ('query', 'score_mode', 'boost_mode'))]
+
+        function_filters = [
+            self._filter(memory_index, documents, function['filter']) if 'filter' in function else None
+            for function in functions
+        ]
+
+        score_mode = params.get('score_mode', 'multiply')
+        boost_mode = params.get('boost_mode', 'multiply')
+
+        result = dict()
+
+        for slot, score in scores.iteritems():
+            values = list()
+
+            for function, function_filter in zip(functions, function_filters):
+                if function_filter is not None and slot not in function_filter:
+                    continue
+
+                value = 1.0
+
+                if 'random_score' in function:
+                    seed = function['random_score'].get('seed', 0)
+                    value = (zlib.crc32('%s:%s' % (seed, documents.ids[slot])) & 0xffffffff) / 4294967296.0
+                elif 'field_value_factor' in function:
+                    factor = function['field_value_factor']
+                    field_value = documents.value(factor['field'], slot)
+                    if field_value is None:
+                        field_value = factor.get('missing', 1)
+                    value = float(field_value) * factor.get('factor', 1)
+
+                values.append(value * function.get('weight', 1))
+
+            if not values:
+                function_score = 1.0
+            elif score_mode == 'sum':
+                function_score = sum(values)
+            elif score_mode == 'avg':
+                function_score = sum(values) / len(values)
+            elif score_mode == 'max':
+                function_score = max(values)
+            elif score_mode == 'min':
+                function_score = min(values)
+            elif score_mode == 'first':
+                function_score = values[0]
+            else:
+                function_score = reduce(lambda a, b: a * b, values)
+
+            if boost_mode == 'replace':
+                result[slot] = function_score
+            elif boost_mode == 'sum':
+                result[slot] = score + function_score
+            elif boost_mode == 'avg':
+                result[slot] = (score + function_score) / 2
+            elif boost_mode == 'max':
+                result[slot] = max(score, function_score)
+            elif boost_mode == 'min':
+                result[slot] = min(score, function_score)
+            else:
+                result[slot] = score * function_score
+
+        return result
+
+    # Filters return set of matching slots
+
+    def _filter(self, memory_index, documents, clause):
+        (clause_type, params), = clause.items()
+
+        if clause_type == 'match_all':
+            return documents.live_slots()
+
+        if clause_type == 'bool':
+            matching = None
+
+            for subclause in _as_list(params.get('must')) + _as_list(params.get('filter')):
+                submatching = self._filter(memory_index, documents, subclause)
+                matching = submatching if matching is None else matching & submatching
+
+            should = _as_list(params.get('should'))
+            if should:
+                any_matching = set()
+                for subclause in should:
+                    any_matching |= self._filter(memory_index, documents, subclause)
+                matching = any_matching if matching is None else matching & any_matching
+
+            if matching is None:
+                matching = documents.live_slots()
+
+            for subclause in _as_list(params.get('must_not')):
+                matching = matching - self._filter(memory_index, documents, subclause)
+
+            return matching
+
+        if clause_type == 'term':
+            (field, value), = params.items()
+            if isinstance(value, dict):
+                value = value['value']
+
+            return set(documents.terms[field].get(_normalize(value), ()))
+
+        if clause_type == 'terms':
+            (field, values), = params.items()
+
+            matching = set()
+            for value in values:
+                matching |= documents.terms[field].get(_normalize(value), set())
+
+            return matching
+
+        if clause_type == 'range':
+            (field, bounds), = params.items()
+            bounds = dict((key, _normalize(value)) for key, value in bounds.items() if key in ('gt', 'gte', 'lt', 'lte'))
+
+            matching = set()
+
+            for slot, value in enumerate(documents.columns.get(field, ())):
+                if value is None:
+                    continue
+
+                for item in _as_list(value):
+                    if ('gt' in bounds and not item > bounds['gt']) or ('gte' in bounds and not item >= bounds['gte']) or \
+                            ('lt' in bounds and not item < bounds['lt']) or ('lte' in bounds and not item <= bounds['lte']):
+                        continue
+
+                    matching.add(slot)
+                    break
+
+            return matching
+
+        if clause_type == 'exists':
+            column = documents.columns.get(params['field'], ())
+            return set(slot for slot, value in enumerate(column) if value is not None) | \
+                   set(documents.lengths.get(params['field'], {}).keys())
+
+        if clause_type == 'has_parent':
+            parents = memory_index.types[params['type']]
+            parent_ids = set(parents.ids[slot] for slot in self._query(memory_index, parents, params['query']))
+
+            return set(slot for slot, parent in enumerate(documents.parents) if parent is not None and unicode(parent) in parent_ids)
+
+        if clause_type in ('filtered', 'multi_match', 'function_score'):
+            return set(self._query(memory_index, documents, clause))
+
+        raise Exception('Unsupported clause %s' % clause_type)
+
+    def _sort(self, documents, scores, sort):
+        """
+        Matching slots in the order of sort specification (by score by default).
+        Documents missing sort values go last
+        """
+        if not sort:
+            sort = ['_score']
+
+        keys = list()
+
+        for spec in _as_list(sort):
+            if isinstance(spec, dict):
+                (field, order), = spec.items()
+                if isinstance(order, dict):
+                    order = order.get('order', 'asc')
+            else:
+                field, order = spec, 'desc' if spec == '_score' else 'asc'
+
+            keys.append((field, -1 if order == 'desc' else 1))
+
+        def sort_key(slot):
+            key = list()
+
+            for field, direction in keys:
+                value = scores[slot] if field == '_score' else documents.value(field, slot)
+                if isinstance(value, tuple):
+                    value = min(value) if direction > 0 else max(value)
+
+                if value is None:
+                    key.append((1, 0))
+                else:
+                    key.append((0, direction * value))
+
+            key.append(slot)
+            return key
+
+        return sorted(scores.iterkeys(), key=sort_key)
+
+    def _aggregate(self, memory_index, documents, slots, aggs):
+        result = dict()
+
+        for name, agg in aggs.items():
+            subaggs = agg.get('aggs', agg.get('aggregations'))
+            ((agg_type, params),) = [(key, value) for key, value in agg.items() if key not in ('aggs', 'aggregations')]
+
+            def values_of(field, slots):
+                values = list()
+                for slot in slots:
+                    values.extend(_as_list(documents.value(field, slot)))
+                return values
+
+            def bucket(bucket, bucket_slots):
+                bucket['doc_count'] = len(bucket_slots)
+                if subaggs:
+                    bucket.update(self._aggregate(memory_index, documents, bucket_slots, subaggs))
+                return bucket
+
+            if agg_type == 'terms':
+                grouped = collections.defaultdict(list)
+                for slot in slots:
+                    for value in set(_as_list(documents.value(params['field'], slot))):
+                        grouped[value].append(slot)
+
+                ordered = sorted(grouped.items(), key=lambda item: (-len(item[1]), item[0]))
+                size = params.get('size', 10)
+                if size:
+                    ordered = ordered[:size]
+
+                result[name] = {
+                    'doc_count_error_upper_bound': 0,
+                    'sum_other_doc_count': sum(len(value_slots) for value_slots in grouped.values()) - sum(len(value_slots) for _, value_slots in ordered),
+                    'buckets': [bucket(dict(key=value), value_slots) for value, value_slots in ordered]
+                }
+
+            elif agg_type in ('max', 'min', 'sum', 'avg'):
+                values = values_of(params['field'], slots)
+                if agg_type == 'sum':
+                    value = float(sum(values))
+                elif not values:
+                    value = None
+                elif agg_type == 'avg':
+                    value = float(sum(values)) / len(values)
+                else:
+                    value = float(max(values) if agg_type == 'max' else min(values))
+
+                result[name] = dict(value=value)
+
+            elif agg_type == 'stats':
+                values = values_of(params['field'], slots)
+
+                result[name] = dict(
+                    count=len(values),
+                    min=float(min(values)) if values else None,
+                    max=float(max(values)) if values else None,
+                    avg=float(sum(values)) / len(values) if values else None,
+                    sum=float(sum(values))
+                )
+
+            elif agg_type == 'cardinality':
+                result[name] = dict(value=len(set(values_of(params['field'], slots))))
+
+            elif agg_type == 'range':
+                buckets = list()
+
+                for bounds in params['ranges']:
+                    start, end = bounds.get('from'), bounds.get('to')
+                    bucket_slots = [
+                        slot for slot in slots
+                        if any((start is None or value >= start) and (end is None or value < end) for value in _as_list(documents.value(params['field'], slot)))
+                    ]
+
+                    range_bucket = dict(key=bounds.get('key', '%s-%s' % ('*' if start is None else float(start), '*' if end is None else float(end))))
+                    if start is not None:
+                        range_bucket['from'] = start
+                    if end is not None:
+                        range_bucket['to'] = end
+
+                    buckets.append(bucket(range_bucket, bucket_slots))
+
+                result[name] = dict(buckets=buckets)
+
+            elif agg_type == 'histogram':
+                interval = params['interval']
+
+                grouped = collections.defaultdict(list)
+                for slot in slots:
+                    for key in set(int(math.floor(value / float(interval))) * interval for value in _as_list(documents.value(params['field'], slot))):
+                        grouped[key].append(slot)
+
+                min_doc_count = params.get('min_doc_count', 1)
+
+                if min_doc_count == 0:
+                    keys = grouped.keys()
+                    bounds = params.get('extended_bounds', {})
+                    if 'min' in bounds:
+                        keys.append(int(math.floor(bounds['min'] / float(interval))) * interval)
+                    if 'max' in bounds:
+                        keys.append(int(math.floor(bounds['max'] / float(interval))) * interval)
+
+                    if keys:
+                        bucket_key = min(keys)
+                        while bucket_key <= max(keys):
+                            grouped.setdefault(bucket_key, [])
+                            bucket_key += interval
+
+                result[name] = dict(buckets=[
+                    bucket(dict(key=key), key_slots)
+                    for key, key_slots in sorted(grouped.items()) if len(key_slots) >= min_doc_count
+                ])
+
+            elif agg_type == 'filter':
+                matching = self._filter(memory_index, documents, params)
+                result[name] = bucket(dict(), [slot for slot in slots if slot in matching])
+
+            else:
+                raise Exception('Unsupported aggregation %s' % agg_type)
+
+        return result
+
+
+def create_backend(name):
+    if name == 'memory':
+        return MemorySearchBackend()
+
+    if name == 'elasticsearch':
+        return ElasticSearchBackend()
+
+    raise Exception('Unknown search backend %s' % name)
@@ -0,0 +1,84 @@
+import zlib
+import marshal
+import cPickle as pickle
+
+
+class Serializer(object):
+    """
+    Serializer for values stored in redis. Plain data (dicts, lists, strings, numbers) is encoded
+    with marshal, which is faster and more compact than pickle, anything else is pickled.
+    Only values built from exact builtin types are marshalled: marshal writes subclasses
+    of unicode (like Markup) as raw internal bytes which can't be loaded back.
+    Payloads larger than compress_threshold bytes are compressed with zlib.
+
+    Serialized value starts with a header: zero byte, format version, encoding and compression.
+    Values without the header are legacy pickles and are still loaded
+    """
+
+    MAGIC = '\x00'
+    VERSION = '\x01'
+
+    MARSHAL = 'm'
+    PICKLE = 'p'
+
+    COMPRESSED = 'z'
+    UNCOMPRESSED = '-'
+
+    HEADER_LENGTH = 4
+
+    SCALAR_TYPES = (type(None), bool, int, long, float, str, unicode)
+    SEQUENCE_TYPES = (list, tuple, set, frozenset)
+
+    def __init__(self, compress_threshold=1024, compress_level=1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def is_plain(self, value):
+        value_type = type(value)
+
+        if value_type in self.SCALAR_TYPES:
+            return True
+
+        if value_type in self.SEQUENCE_TYPES:
+            return all(self.is_plain(item) for item in value)
+
+        if value_type is dict:
+            return all(self.is_plain(key) and self.is_plain(item) for key, item in value.iteritems())
+
+        return False
+
+    def dumps(self, value):
+        if self.is_plain(value):
+            encoding, payload = self.MARSHAL, marshal.dumps(value, 2)
+        else:
+            # Objects which marshal doesn't support (datetimes, model instances etc) or
+            # would corrupt (subclasses of builtin types)
+            encoding, payload = self.PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        compression = self.UNCOMPRESSED
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            compressed = zlib.compress(payload, self.compress_level)
+            if len(compressed) < len(payload):
+                compression, payload = self.COMPRESSED, compressed
+
+        return self.MAGIC + self.VERSION + encoding + compression + payload
+
+    def loads(self, data):
+        if not data.startswith(self.MAGIC):
+            return pickle.loads(data)
+
+        version, encoding, compression = data[1:self.HEADER_LENGTH]
+        if version != self.VERSION:
+            raise ValueError('Unknown serializer version %r' % version)
+
+        payload = data[self.HEADER_LENGTH:]
+        if compression == self.COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        if encoding == self.MARSHAL:
+            return marshal.loads(payload)
+
+        return pickle.loads(payload)
+
+
+serializer = Serializer()
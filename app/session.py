@@ -1,23 +1,54 @@
-import pickle
 from datetime import timedelta
 from uuid import uuid4
 from redis import Redis
 from werkzeug.datastructures import CallbackDict
 from flask.sessions import SessionInterface, SessionMixin
 
+from app.serializer import serializer
+
 
 class RedisSession(CallbackDict, SessionMixin):
-    def __init__(self, initial=None, sid=None, new=False):
+    def __init__(self, initial=None, sid=None, new=False, raw=None, ttl=None, skip_save=False):
         def on_update(self):
             self.modified = True
         CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
         self.new = new
         self.modified = False
+        # Serialized value and TTL as loaded from redis, to write only changes
+        self.raw = raw
+        self.ttl = ttl
+        self.skip_save = skip_save
+
+
+# Replace the previous session of the key (if it's not the current one) with the
+# invalidated session, keeping its TTL, and remember the current one. Arguments are:
+# session prefix, current sid, invalidated session payload, single session TTL
+ENSURE_SINGLE_SESSION_SCRIPT = """
+local prev_sid = redis.call('get', KEYS[1])
+
+if prev_sid and prev_sid ~= ARGV[2] then
+    local prev_key = ARGV[1] .. prev_sid
+    local prev_ttl = redis.call('ttl', prev_key)
+
+    if prev_ttl > 0 then
+        redis.call('setex', prev_key, prev_ttl, ARGV[3])
+    elseif prev_ttl == -1 then
+        redis.call('set', prev_key, ARGV[3])
+    end
+end
+
+redis.call('setex', KEYS[1], ARGV[4], ARGV[2])
+"""
 
 
 class RedisSessionInterface(SessionInterface):
-    serializer = pickle
+    """
+    Sessions are written to redis only when their content changes. Unchanged sessions
+    get their TTL (and cookie) refreshed at most every SESSION_REFRESH_INTERVAL seconds.
+    Static files don't touch sessions at all and empty sessions are never stored
+    """
+    serializer = serializer
     session_class = RedisSession
 
     def __init__(self, redis=None, prefix='session:'):
@@ -25,6 +56,7 @@ class RedisSessionInterface(SessionInterface):
             redis = Redis()
         self.redis = redis
         self.prefix = prefix
+        self.ensure_single_session_script = redis.register_script(ENSURE_SINGLE_SESSION_SCRIPT)
 
     def generate_sid(self):
         return str(uuid4())
@@ -34,46 +66,62 @@ class RedisSessionInterface(SessionInterface):
             return app.permanent_session_lifetime
         return timedelta(days=1)
 
+    def dumps(self, data):
+        return self.serializer.dumps(data)
+
     def open_session(self, app, request):
         sid = request.cookies.get(app.session_cookie_name)
+
+        if request.path.startswith(app.static_url_path + '/'):
+            return self.session_class(sid=sid, skip_save=True)
+
         if not sid:
             sid = self.generate_sid()
             return self.session_class(sid=sid, new=True)
-        val = self.redis.get(self.prefix + sid)
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.prefix + sid)
+        pipe.ttl(self.prefix + sid)
+        val, ttl = pipe.execute()
+
         if val is not None:
             data = self.serializer.loads(val)
-            return self.session_class(data, sid=sid)
+            return self.session_class(data, sid=sid, raw=val, ttl=ttl)
         return self.session_class(sid=sid, new=True)
 
     def save_session(self, app, session, response):
+        if session.skip_save:
+            return
+
         domain = self.get_cookie_domain(app)
         if not session:
-            self.redis.delete(self.prefix + session.sid)
+            if session.raw is not None:
+                self.redis.delete(self.prefix + session.sid)
             if session.modified:
                 response.delete_cookie(app.session_cookie_name,
                                        domain=domain)
             return
-        redis_exp = self.get_redis_expiration_time(app, session)
+        redis_exp = int(self.get_redis_expiration_time(app, session).total_seconds())
         cookie_exp = self.get_expiration_time(app, session)
-        val = self.serializer.dumps(dict(session))
-        self.redis.setex(self.prefix + session.sid, val,
-                         int(redis_exp.total_seconds()))
+        val = self.dumps(dict(session))
+
+        # Comparing serialized values catches changes of mutable values too
+        if val != session.raw:
+            self.redis.setex(self.prefix + session.sid, val, redis_exp)
+        elif session.ttl is None or redis_exp - session.ttl >= app.config.get('SESSION_REFRESH_INTERVAL', 600):
+            self.redis.expire(self.prefix + session.sid, redis_exp)
+        else:
+            return
         response.set_cookie(app.session_cookie_name, session.sid,
                             expires=cookie_exp, httponly=True,
                             domain=domain)
 
     def ensure_single_session(self, key, sid):
-        single_session_key = 'single_session:%s' % key
-        prev_sid = self.redis.get(single_session_key)
-
-        if prev_sid is not None and prev_sid != sid:
-            # Invalidate previous session
-            prev_session = self.redis.get(self.prefix + prev_sid)
-            if prev_session is not None:
-                prev_ttl = self.redis.ttl(self.prefix + prev_sid)
-                prev_session = self.serializer.loads(prev_session)
-                prev_session.clear()
-                prev_session['invalidated'] = True
-                self.redis.setex(self.prefix + prev_sid, self.serializer.dumps(prev_session), prev_ttl)
-
-        self.redis.setex(single_session_key, sid, int(timedelta(days=31).total_seconds()))
+        # Invalidated session is a cleared one, so it is serialized here and
+        # swapped within a single round trip
+        invalidated_session = self.dumps(dict(invalidated=True))
+
+        self.ensure_single_session_script(
+            keys=['single_session:%s' % key],
+            args=[self.prefix, sid, invalidated_session, int(timedelta(days=31).total_seconds())]
+        )
@@ -1,10 +1,15 @@
+import os
 import json
+import time
+import gzip
+import uuid
+import hashlib
 import peewee
 from playhouse import db_url
 from playhouse.pool import PooledMySQLDatabase
 from datetime import datetime, timedelta
 
-from app import app
+from app import app, redis
 from app.utils.tz import get_utc_datetime
 
 
@@ -50,7 +55,69 @@ class BaseStatisticRecordModel(peewee.Model):
     data = JSONField(default=None, null=True)
 
 
+class BaseStatisticRollupModel(peewee.Model):
+    key_id = peewee.IntegerField()
+    hour = peewee.DateTimeField(index=True)
+    count = peewee.IntegerField(default=0)
+    value_sum = peewee.BigIntegerField(default=None, null=True)
+
+
+class ProductViewsModel(peewee.Model):
+    product_id = peewee.IntegerField()
+    day = peewee.DateField(index=True)
+    views = peewee.IntegerField(default=0)
+    # Views recorded before the counters were enabled, counted from raw impressions
+    rebuilt_views = peewee.IntegerField(default=0)
+    unique_visitors = peewee.IntegerField(default=None, null=True)
+
+    class Meta:
+        db_table = 'stat_product_views'
+        database = db
+        primary_key = peewee.CompositeKey('product_id', 'day')
+
+
+class ProductViewsFoldModel(peewee.Model):
+    fold_id = peewee.CharField(max_length=32, primary_key=True)
+    folded_on = peewee.DateTimeField(index=True, default=datetime.utcnow)
+
+    class Meta:
+        db_table = 'stat_product_views_fold'
+        database = db
+
+
+class StatisticRollupWatermarkModel(peewee.Model):
+    record_type = peewee.CharField(max_length=50, primary_key=True)
+    rolled_up_to = peewee.DateTimeField()
+
+    class Meta:
+        db_table = 'stat_rollup_watermark'
+        database = db
+
+
+def floor_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(dt):
+    floored = floor_hour(dt)
+    return floored if floored == dt else floored + timedelta(hours=1)
+
+
 class AffiliateImpression:
+    """
+    Impressions are deduplicated in redis: IP addresses recorded in the last 24 hours are kept
+    as keys with TTL, and client IDs are added to a Bloom filter (a bitmap per BLOOM_PERIOD,
+    the current and the previous ones are checked). The database is queried only when the
+    filter says the client ID may have been seen. Client IDs older than the filters are
+    rejected by the primary key on insert
+    """
+
+    IP_EXPIRE = 86400
+
+    BLOOM_PERIOD = 30 * 86400
+    BLOOM_BITS = 2 ** 23
+    BLOOM_HASHES = 7
+
     class NotUniqueException(Exception):
         pass
 
@@ -61,7 +128,46 @@ class AffiliateImpression:
         db.create_tables([AffiliateImpressionModel], safe=True)
 
     @staticmethod
-    @with_database
+    def get_ip_key(ip):
+        return 'affiliate_ip:%s' % ip
+
+    @staticmethod
+    def get_bloom_key(generation):
+        return 'affiliate_clients:%d' % generation
+
+    @staticmethod
+    def get_bloom_generation(dt=None):
+        timestamp = time.time() if dt is None else (dt - datetime(1970, 1, 1)).total_seconds()
+        return int(timestamp / AffiliateImpression.BLOOM_PERIOD)
+
+    @staticmethod
+    def get_bloom_positions(client_id):
+        # Double hashing: position_i = h1 + i * h2
+        h1 = int(hashlib.md5(client_id).hexdigest()[:16], 16)
+        h2 = int(hashlib.sha1(client_id).hexdigest()[:16], 16) | 1
+
+        return [(h1 + i * h2) % AffiliateImpression.BLOOM_BITS for i in range(AffiliateImpression.BLOOM_HASHES)]
+
+    @staticmethod
+    def remember(pipe, client_id, ip, event_date=None):
+        """
+        Add commands to remember the impression to the pipeline
+        """
+        generation = AffiliateImpression.get_bloom_generation(event_date)
+        bloom_key = AffiliateImpression.get_bloom_key(generation)
+
+        for position in AffiliateImpression.get_bloom_positions(client_id):
+            pipe.setbit(bloom_key, position, 1)
+        pipe.expireat(bloom_key, (generation + 2) * AffiliateImpression.BLOOM_PERIOD)
+
+        ip_expire = AffiliateImpression.IP_EXPIRE
+        if event_date:
+            ip_expire -= int((datetime.utcnow() - event_date).total_seconds())
+
+        if ip_expire > 0:
+            pipe.setex(AffiliateImpression.get_ip_key(ip), 1, ip_expire)
+
+    @staticmethod
     def try_save_unique(client_id, ip):
         """
         Try to save unique impression.
@@ -69,37 +175,111 @@ class AffiliateImpression:
         In case clinet IP address has been recorded
             in the last 24 hours - throw error as well
         """
+        client_id = client_id.encode('utf-8') if isinstance(client_id, unicode) else client_id
 
-        # TODO: first check for IP in cache
+        generation = AffiliateImpression.get_bloom_generation()
+        positions = AffiliateImpression.get_bloom_positions(client_id)
 
-        existing_impression = None
+        pipe = redis.pipeline(transaction=False)
+        pipe.exists(AffiliateImpression.get_ip_key(ip))
+        for bloom_generation in (generation, generation - 1):
+            for position in positions:
+                pipe.getbit(AffiliateImpression.get_bloom_key(bloom_generation), position)
+        results = pipe.execute()
 
-        try:
-            existing_impression = AffiliateImpressionModel.get(
-                AffiliateImpressionModel.client_id == client_id
-            )
-        except peewee.DoesNotExist:
-            pass
-
-        if existing_impression:
+        if results[0]:
             raise AffiliateImpression.NotUniqueException()
 
-        try:
-            existing_impression = AffiliateImpressionModel.get(
-                AffiliateImpressionModel.ip == ip,
-                AffiliateImpressionModel.event_date > (datetime.utcnow() - timedelta(days=1))
-            )
-        except peewee.DoesNotExist:
-            pass
+        bits = results[1:]
+        maybe_seen = all(bits[:len(positions)]) or all(bits[len(positions):])
+
+        AffiliateImpression.save(client_id, ip, check_client_id=maybe_seen)
 
-        if existing_impression:
+        pipe = redis.pipeline(transaction=False)
+        AffiliateImpression.remember(pipe, client_id, ip)
+        pipe.execute()
+
+    @staticmethod
+    @with_database
+    def save(client_id, ip, check_client_id=True):
+        if check_client_id:
+            try:
+                AffiliateImpressionModel.get(AffiliateImpressionModel.client_id == client_id)
+                raise AffiliateImpression.NotUniqueException()
+            except peewee.DoesNotExist:
+                pass
+
+        try:
+            AffiliateImpressionModel.create(client_id=client_id, ip=ip)
+        except peewee.IntegrityError:
+            # Client ID is older than Bloom filters
             raise AffiliateImpression.NotUniqueException()
 
-        AffiliateImpressionModel.create(client_id=client_id, ip=ip)
+    @staticmethod
+    @with_database
+    def rebuild(batch_size=1000):
+        """
+        Fill Bloom filters and IP keys from impressions in the database.
+        Returns number of impressions processed
+        """
+        since = datetime(1970, 1, 1) + timedelta(seconds=(AffiliateImpression.get_bloom_generation() - 1) * AffiliateImpression.BLOOM_PERIOD)
+
+        query = AffiliateImpressionModel \
+            .select() \
+            .where(AffiliateImpressionModel.event_date >= since) \
+            .order_by(AffiliateImpressionModel.event_date) \
+            .naive()
+
+        count = 0
+        pipe = redis.pipeline(transaction=False)
+
+        for impression in query.iterator():
+            AffiliateImpression.remember(pipe, impression.client_id.encode('utf-8'), impression.ip, impression.event_date)
+            count += 1
+
+            if count % batch_size == 0:
+                pipe.execute()
+
+        pipe.execute()
+
+        return count
+
+
+# Records are buffered in the STATISTIC_QUEUE_KEY redis list and written by the statistic worker
+# (see StatisticRecord.flush_queue). Records being written are moved to STATISTIC_PROCESSING_KEY
+# first, so they are written again in case the worker dies in the middle of a batch
+
+STATISTIC_QUEUE_KEY = 'stat_queue'
+STATISTIC_PROCESSING_KEY = 'stat_queue:processing'
+STATISTIC_DEAD_LETTER_KEY = 'stat_queue:dead'
+STATISTIC_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Moves up to ARGV[1] records from the queue to the processing list and returns the processing list
+_take_batch_script = redis.register_script("""
+if redis.call('llen', KEYS[2]) == 0 then
+    local items = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #items > 0 then
+        redis.call('rpush', KEYS[2], unpack(items))
+        redis.call('ltrim', KEYS[1], #items, -1)
+    end
+end
+return redis.call('lrange', KEYS[2], 0, -1)
+""")
 
 
 class StatisticRecord:
+    """
+    Raw records are stored in stat_<type> tables. Counts and sums of key_value per key and hour
+    are kept in stat_<type>_hourly tables by rollup(), up to the watermark (stat_rollup_watermark).
+    count(), count_per_day() and sum() read whole hours before the watermark from the rollups
+    and only the rest from the raw records
+    """
+
     model_classes = dict()
+    rollup_model_classes = dict()
+
+    # Hours are rolled up once they are this old, so queued records are written already
+    ROLLUP_DELAY = timedelta(minutes=10)
 
     class Types:
         SERVICE_IMPRESSION = 'service_impression'
@@ -137,10 +317,21 @@ class StatisticRecord:
                 dict(Meta=Meta)
             )
 
-        db.create_tables(cls.model_classes.values(), safe=True)
+            RollupMeta = type(
+                'Meta',
+                (object,),
+                dict(database=db, db_table='stat_%s_hourly' % record_type, primary_key=peewee.CompositeKey('key_id', 'hour'))
+            )
+
+            cls.rollup_model_classes[record_type] = type(
+                'Rollup_%s' % record_type,
+                (BaseStatisticRollupModel,),
+                dict(Meta=RollupMeta)
+            )
+
+        db.create_tables(cls.model_classes.values() + cls.rollup_model_classes.values() + [StatisticRollupWatermarkModel], safe=True)
 
     @classmethod
-    @with_database
     def record(cls, record_type, key_id, key_value=None, **kwargs):
         """
         Record statistic item.
@@ -150,6 +341,23 @@ class StatisticRecord:
         if record_type not in cls.model_classes:
             raise Exception('No such record type')
 
+        if not app.config.get('STATISTIC_QUEUE_ENABLED', True):
+            return cls.save(record_type, key_id, key_value, **kwargs)
+
+        redis.rpush(STATISTIC_QUEUE_KEY, json.dumps(dict(
+            type=record_type,
+            key_id=key_id,
+            key_value=key_value,
+            event_date=datetime.utcnow().strftime(STATISTIC_DATE_FORMAT),
+            data=kwargs if kwargs else None
+        )))
+
+    @classmethod
+    @with_database
+    def save(cls, record_type, key_id, key_value=None, **kwargs):
+        """
+        Write statistic item to the database right away
+        """
         Model = cls.model_classes[record_type]
 
         record = Model(
@@ -160,6 +368,127 @@ class StatisticRecord:
 
         record.save()
 
+    @classmethod
+    @with_database
+    def flush_queue(cls, batch_size=1000):
+        """
+        Write a batch of queued records with one multi-row insert per record type.
+        Records which can not be decoded or are rejected by the database are moved
+        to the dead letter list, so they do not block the queue.
+        Returns number of records processed
+        """
+        items = _take_batch_script(keys=[STATISTIC_QUEUE_KEY, STATISTIC_PROCESSING_KEY], args=[batch_size])
+        if not items:
+            return 0
+
+        rows_per_type = dict()
+        dead_items = list()
+
+        for raw_item in items:
+            try:
+                item = json.loads(raw_item)
+                row = dict(
+                    key_id=item['key_id'],
+                    key_value=item['key_value'],
+                    event_date=datetime.strptime(item['event_date'], STATISTIC_DATE_FORMAT),
+                    data=item['data']
+                )
+            except (TypeError, ValueError, KeyError), e:
+                print "Malformed statistic record %r: %s" % (raw_item, e)
+                dead_items.append(raw_item)
+                continue
+
+            if item.get('type') not in cls.model_classes:
+                print "Unknown statistic record type: %r" % raw_item
+                dead_items.append(raw_item)
+                continue
+
+            rows_per_type.setdefault(item['type'], []).append((raw_item, row))
+
+        with db.atomic():
+            for record_type, entries in rows_per_type.items():
+                dead_items.extend(cls._insert_rows(cls.model_classes[record_type], entries))
+
+        # Connection errors are raised above and leave the batch in the processing list to be retried
+        pipe = redis.pipeline()
+        if dead_items:
+            pipe.rpush(STATISTIC_DEAD_LETTER_KEY, *dead_items)
+        pipe.delete(STATISTIC_PROCESSING_KEY)
+        pipe.execute()
+
+        return len(items)
+
+    @staticmethod
+    def _insert_rows(Model, entries):
+        """
+        Insert (raw item, row) entries with one query, or row by row if the database rejects it.
+        Returns raw items of the rejected rows
+        """
+        try:
+            with db.atomic():
+                Model.insert_many([row for raw_item, row in entries]).execute()
+            return []
+        except peewee.OperationalError:
+            raise
+        except peewee.DatabaseError:
+            pass
+
+        rejected = list()
+
+        for raw_item, row in entries:
+            try:
+                with db.atomic():
+                    Model.insert(**row).execute()
+            except peewee.OperationalError:
+                raise
+            except peewee.DatabaseError, e:
+                print "Statistic record rejected by the database %r: %s" % (raw_item, e)
+                rejected.append(raw_item)
+
+        return rejected
+
+    @staticmethod
+    def _get_first_event_date(*items):
+        for oldest in items:
+            try:
+                return datetime.strptime(json.loads(oldest)['event_date'], STATISTIC_DATE_FORMAT)
+            except (TypeError, ValueError, KeyError):
+                # Empty list or malformed item
+                continue
+
+        return None
+
+    @classmethod
+    def get_oldest_queued_date(cls):
+        """
+        Returns event date of the oldest record not written to the database yet (or None)
+        """
+        pipe = redis.pipeline(transaction=False)
+        pipe.lindex(STATISTIC_PROCESSING_KEY, 0)
+        pipe.lindex(STATISTIC_QUEUE_KEY, 0)
+
+        return cls._get_first_event_date(*pipe.execute())
+
+    @classmethod
+    def get_queue_stats(cls):
+        """
+        Returns number of queued and dead-lettered records and lag (seconds since the oldest queued record)
+        """
+        pipe = redis.pipeline(transaction=False)
+        pipe.llen(STATISTIC_QUEUE_KEY)
+        pipe.llen(STATISTIC_PROCESSING_KEY)
+        pipe.llen(STATISTIC_DEAD_LETTER_KEY)
+        pipe.lindex(STATISTIC_PROCESSING_KEY, 0)
+        pipe.lindex(STATISTIC_QUEUE_KEY, 0)
+        queued, processing, dead, oldest_processing, oldest_queued = pipe.execute()
+
+        lag = 0
+        event_date = cls._get_first_event_date(oldest_processing, oldest_queued)
+        if event_date:
+            lag = (datetime.utcnow() - event_date).total_seconds()
+
+        return dict(queued=queued, processing=processing, dead=dead, lag=lag)
+
     @classmethod
     def record_silent(cls, *args, **kwargs):
         """
@@ -170,6 +499,112 @@ class StatisticRecord:
         except Exception, e:
             print "Exception while saving statistic record (%s): %s" % (args[0], e.message)
 
+    @classmethod
+    @with_database
+    def rollup(cls, max_hours=24 * 7):
+        """
+        Roll up raw records of all types for the hours after the watermark.
+        Hours which may still get records from the statistic queue are left for later.
+        Returns number of hours rolled up per type
+        """
+        target = floor_hour(datetime.utcnow() - cls.ROLLUP_DELAY)
+
+        oldest_queued = cls.get_oldest_queued_date()
+        if oldest_queued:
+            target = min(target, floor_hour(oldest_queued))
+        result = dict()
+
+        for record_type in cls.types():
+            Model, Rollup = cls.model_classes[record_type], cls.rollup_model_classes[record_type]
+
+            watermark = cls.get_watermark(record_type)
+            if watermark is None:
+                first_date = Model.select(peewee.fn.MIN(Model.event_date)).scalar()
+                watermark = floor_hour(first_date) if first_date else target
+
+            result[record_type] = 0
+
+            while watermark < target:
+                until = min(target, watermark + timedelta(hours=max_hours))
+
+                hour = peewee.fn.DATE_FORMAT(Model.event_date, '%Y-%m-%d %H:00:00')
+                rows = list(Model
+                    .select(
+                        Model.key_id,
+                        hour.alias('hour'),
+                        peewee.fn.COUNT(Model.id).alias('count'),
+                        peewee.fn.SUM(Model.key_value).alias('value_sum')
+                    )
+                    .where(Model.event_date >= watermark, Model.event_date < until)
+                    .group_by(Model.key_id, peewee.SQL('hour'))
+                    .dicts())
+
+                with db.atomic():
+                    Rollup.delete().where(Rollup.hour >= watermark, Rollup.hour < until).execute()
+
+                    for idx in range(0, len(rows), 1000):
+                        Rollup.insert_many(rows[idx:idx + 1000]).execute()
+
+                    StatisticRollupWatermarkModel.insert(record_type=record_type, rolled_up_to=until).upsert().execute()
+
+                result[record_type] += int((until - watermark).total_seconds() / 3600)
+                watermark = until
+
+        return result
+
+    @classmethod
+    def get_watermark(cls, record_type):
+        try:
+            return StatisticRollupWatermarkModel.get(StatisticRollupWatermarkModel.record_type == record_type).rolled_up_to
+        except peewee.DoesNotExist:
+            return None
+
+    @classmethod
+    def _split_range(cls, record_type, date_range_utc):
+        """
+        Split the range into whole hours which are rolled up (start, end), and
+        raw parts before and after them (start, end, end_inclusive)
+        """
+        start, end = date_range_utc if date_range_utc else (None, None)
+        watermark = cls.get_watermark(record_type)
+
+        rollup_start = ceil_hour(start) if start else None
+        rollup_end = min(floor_hour(end), watermark) if end and watermark else watermark
+
+        if rollup_end is None or (rollup_start and rollup_start >= rollup_end):
+            return None, [(start, end, True)]
+
+        raw_ranges = [(rollup_end, end, True)]
+        if start and start < rollup_start:
+            raw_ranges.insert(0, (start, rollup_start, False))
+
+        return (rollup_start, rollup_end), raw_ranges
+
+    @classmethod
+    def _query_rollup(cls, record_type, key_id, rollup_range, *fields):
+        Rollup = cls.rollup_model_classes[record_type]
+
+        query = Rollup.select(*fields).where(Rollup.key_id == key_id, Rollup.hour < rollup_range[1])
+        if rollup_range[0]:
+            query = query.where(Rollup.hour >= rollup_range[0])
+
+        return query
+
+    @classmethod
+    def _query_raw(cls, record_type, key_id, raw_range, *fields):
+        Model = cls.model_classes[record_type]
+        start, end, end_inclusive = raw_range
+
+        query = Model.select(*fields).where(Model.key_id == key_id)
+
+        if start:
+            query = query.where(Model.event_date >= start)
+
+        if end:
+            query = query.where(Model.event_date <= end if end_inclusive else Model.event_date < end)
+
+        return query
+
     @classmethod
     @with_database
     def count(cls, record_type, key_id, date_range_utc=None):
@@ -179,27 +614,88 @@ class StatisticRecord:
         if record_type not in cls.model_classes:
             raise Exception('No such record type')
 
-        Model = cls.model_classes[record_type]
+        rollup_range, raw_ranges = cls._split_range(record_type, date_range_utc)
 
-        query = Model.select().where(Model.key_id == key_id)
+        total = 0
 
-        if date_range_utc and date_range_utc[0]:
-            query = query.where(Model.event_date >= date_range_utc[0].isoformat())
+        if rollup_range:
+            Rollup = cls.rollup_model_classes[record_type]
+            total += cls._query_rollup(record_type, key_id, rollup_range, peewee.fn.SUM(Rollup.count)).scalar() or 0
 
-        if date_range_utc and date_range_utc[1]:
-            query = query.where(Model.event_date <= date_range_utc[1])
+        for raw_range in raw_ranges:
+            total += cls._query_raw(record_type, key_id, raw_range).count()
 
-        return query.count()
+        return int(total)
 
     @classmethod
     @with_database
     def count_per_day(cls, record_type, key_id, date_range_local):
         """
-        Get count of records of specified type
+        Get count of records of specified type per local day
         """
         if record_type not in cls.model_classes:
             raise Exception('No such record type')
 
+        local_offset = date_range_local[0].utcoffset()
+        if not cls._is_hour_offset(local_offset):
+            # Hours don't fit into days of this timezone
+            return cls._count_per_day_raw(record_type, key_id, date_range_local)
+
+        Model, Rollup = cls.model_classes[record_type], cls.rollup_model_classes[record_type]
+
+        date_range_utc = get_utc_datetime(date_range_local[0]), get_utc_datetime(date_range_local[1])
+        rollup_range, raw_ranges = cls._split_range(record_type, date_range_utc)
+
+        counts_per_hour = list()
+
+        if rollup_range:
+            query = cls._query_rollup(record_type, key_id, rollup_range, Rollup.hour, Rollup.count).tuples()
+            counts_per_hour.extend(query)
+
+        hour = peewee.fn.DATE_FORMAT(Model.event_date, '%Y-%m-%d %H:00:00')
+        for raw_range in raw_ranges:
+            query = cls._query_raw(record_type, key_id, raw_range, hour.alias('hour'), peewee.fn.COUNT(Model.id)) \
+                .group_by(peewee.SQL('hour')) \
+                .tuples()
+            counts_per_hour.extend((datetime.strptime(hour_utc, '%Y-%m-%d %H:%M:%S'), count) for hour_utc, count in query)
+
+        return cls._get_days(date_range_local, cls._count_per_local_day(counts_per_hour, local_offset))
+
+    @staticmethod
+    def _is_hour_offset(local_offset):
+        return local_offset.total_seconds() % 3600 == 0
+
+    @staticmethod
+    def _count_per_local_day(counts_per_hour, local_offset):
+        """
+        Sum (UTC hour, count) pairs per local date string. Offset has to be whole hours
+        """
+        counts_dict = dict()
+        for hour_utc, count in counts_per_hour:
+            key = (hour_utc + local_offset).strftime('%Y-%m-%d')
+            counts_dict[key] = counts_dict.get(key, 0) + count
+
+        return counts_dict
+
+    @staticmethod
+    def _get_days(date_range_local, counts_dict):
+        result = list()
+        total = 0
+
+        for day in (date_range_local[0] + timedelta(days=i) for i in range((date_range_local[1] - date_range_local[0]).days + 1)):
+            key = day.strftime('%Y-%m-%d')
+            count = counts_dict[key] if key in counts_dict else 0
+            total += count
+
+            result.append(dict(
+                count=count,
+                date=key
+            ))
+
+        return result, total
+
+    @classmethod
+    def _count_per_day_raw(cls, record_type, key_id, date_range_local):
         Model = cls.model_classes[record_type]
 
         local_offset = date_range_local[0].tzinfo.tzname(date_range_local[0])
@@ -219,20 +715,7 @@ class StatisticRecord:
 
         counts_dict = {item['date_local']: item['count'] for item in query}
 
-        result = list()
-        total = 0
-
-        for date in (date_range_local[0] + timedelta(days=i) for i in range((date_range_local[1] - date_range_local[0]).days + 1)):
-            key = date.strftime('%Y-%m-%d')
-            count = counts_dict[key] if key in counts_dict else 0
-            total += count
-
-            result.append(dict(
-                count=count,
-                date=key
-            ))
-
-        return result, total
+        return cls._get_days(date_range_local, counts_dict)
 
     @classmethod
     @with_database
@@ -243,21 +726,426 @@ class StatisticRecord:
         if record_type not in cls.model_classes:
             raise Exception('No such record type')
 
-        Model = cls.model_classes[record_type]
+        Model, Rollup = cls.model_classes[record_type], cls.rollup_model_classes[record_type]
+        rollup_range, raw_ranges = cls._split_range(record_type, date_range_utc)
 
-        query = Model \
-            .select(peewee.fn.SUM(Model.key_value)) \
-            .where(Model.key_id == key_id)
+        result = 0.0
+
+        if rollup_range:
+            result += float(cls._query_rollup(record_type, key_id, rollup_range, peewee.fn.SUM(Rollup.value_sum)).scalar() or 0)
+
+        for raw_range in raw_ranges:
+            result += float(cls._query_raw(record_type, key_id, raw_range, peewee.fn.SUM(Model.key_value)).scalar() or 0)
+
+        return result
+
+
+# Moves pending counters to the folding hash and tags it with fold ID ARGV[1] (unless a fold is unfinished).
+# Returns the folding hash
+_take_views_script = redis.register_script("""
+if redis.call('exists', KEYS[2]) == 0 then
+    if redis.call('exists', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('rename', KEYS[1], KEYS[2])
+    redis.call('hset', KEYS[2], ARGV[2], ARGV[1])
+end
+return redis.call('hgetall', KEYS[2])
+""")
+
+
+class ProductViews:
+    """
+    Views of products are counted per product and day in the PENDING_KEY redis hash and
+    unique visitors (user ID or IP) are estimated with a HyperLogLog per product and day.
+    fold() adds pending counts to the stat_product_views table, views are the sum of both.
+    Every fold has an ID written together with the counters, so a fold is applied only once
+    """
+
+    PENDING_KEY = 'views:pending'
+    FOLDING_KEY = 'views:folding'
+    FOLD_ID_FIELD = 'fold_id'
+    SINCE_KEY = 'views:since'
+    REBUILT_KEY = 'views:rebuilt'
+
+    # IDs of applied folds are kept for a while to recognize a retried fold
+    FOLD_LOG_DAYS = 7
+
+    # Visitors of last days are kept in redis to estimate unique visitors over several days
+    UNIQUE_VISITORS_DAYS = 7
+
+    @staticmethod
+    @with_database
+    def initialize():
+        db.create_tables([ProductViewsModel, ProductViewsFoldModel], safe=True)
+
+    @staticmethod
+    def get_unique_visitors_key(product_id, day):
+        return 'views:visitors:%d:%s' % (product_id, day.isoformat())
+
+    @staticmethod
+    def record(product_id, user_id=None, ip=None):
+        day = datetime.utcnow().date()
+        visitors_key = ProductViews.get_unique_visitors_key(product_id, day)
+
+        pipe = redis.pipeline(transaction=False)
+        pipe.hincrby(ProductViews.PENDING_KEY, '%d:%s' % (product_id, day.isoformat()), 1)
+        pipe.pfadd(visitors_key, 'user:%d' % user_id if user_id else 'ip:%s' % ip)
+        pipe.expire(visitors_key, (ProductViews.UNIQUE_VISITORS_DAYS + 1) * 86400)
+        # Views recorded before are counted from raw impressions (see rebuild())
+        pipe.setnx(ProductViews.SINCE_KEY, datetime.utcnow().strftime(STATISTIC_DATE_FORMAT))
+
+        try:
+            pipe.execute()
+        except Exception, e:
+            print "Exception while counting product view: %s" % e
+
+        StatisticRecord.record_silent(
+            StatisticRecord.Types.SERVICE_IMPRESSION,
+            product_id,
+            user_id=user_id,
+            ip=ip
+        )
+
+    @staticmethod
+    @with_database
+    def fold(batch_size=500):
+        """
+        Add pending counts to the database. Returns number of (product, day) counters folded
+        """
+        # Counters which failed to fold last time are folded first
+        folding = _take_views_script(
+            keys=[ProductViews.PENDING_KEY, ProductViews.FOLDING_KEY],
+            args=[uuid.uuid4().hex, ProductViews.FOLD_ID_FIELD]
+        )
+        if not folding:
+            return 0
+
+        folding = dict(zip(folding[::2], folding[1::2]))
+        fold_id = folding.pop(ProductViews.FOLD_ID_FIELD)
+
+        # The fold was written, but the folding hash was not deleted
+        if ProductViewsFoldModel.select().where(ProductViewsFoldModel.fold_id == fold_id).exists():
+            redis.delete(ProductViews.FOLDING_KEY)
+            return 0
+
+        counters = list()
+        for field, views in folding.items():
+            product_id, day = field.split(':')
+            counters.append((int(product_id), datetime.strptime(day, '%Y-%m-%d').date(), int(views)))
+
+        pipe = redis.pipeline(transaction=False)
+        for product_id, day, _ in counters:
+            pipe.pfcount(ProductViews.get_unique_visitors_key(product_id, day))
+        unique_visitors = pipe.execute()
+
+        with db.atomic():
+            for idx in range(0, len(counters), batch_size):
+                rows = [counter + (unique,) for counter, unique in zip(counters[idx:idx + batch_size], unique_visitors[idx:idx + batch_size])]
+
+                db.execute_sql(
+                    'INSERT INTO stat_product_views (product_id, day, views, unique_visitors) VALUES %s '
+                    'ON DUPLICATE KEY UPDATE views = views + VALUES(views), unique_visitors = VALUES(unique_visitors)' % ', '.join(['(%s, %s, %s, %s)'] * len(rows)),
+                    [value for row in rows for value in row]
+                )
+
+            ProductViewsFoldModel.create(fold_id=fold_id)
+            ProductViewsFoldModel.delete().where(ProductViewsFoldModel.folded_on < datetime.utcnow() - timedelta(days=ProductViews.FOLD_LOG_DAYS)).execute()
+
+        redis.delete(ProductViews.FOLDING_KEY)
+
+        return len(counters)
+
+    @staticmethod
+    @with_database
+    def get_views(product_ids, date_range_utc=None):
+        """
+        Returns dict product id -> views (optionally within range of dates)
+        """
+        product_ids = list(product_ids)
+        if not product_ids:
+            return dict()
+
+        query = ProductViewsModel \
+            .select(ProductViewsModel.product_id, peewee.fn.SUM(ProductViewsModel.views + ProductViewsModel.rebuilt_views)) \
+            .where(ProductViewsModel.product_id << product_ids) \
+            .group_by(ProductViewsModel.product_id)
 
         if date_range_utc and date_range_utc[0]:
-            query = query.where(Model.event_date >= date_range_utc[0])
+            query = query.where(ProductViewsModel.day >= date_range_utc[0].date())
 
         if date_range_utc and date_range_utc[1]:
-            query = query.where(Model.event_date <= date_range_utc[1])
+            query = query.where(ProductViewsModel.day <= date_range_utc[1].date())
+
+        result = dict((product_id, 0) for product_id in product_ids)
+        result.update((product_id, int(views)) for product_id, views in query.tuples())
+
+        # Counts which are not folded yet
+        pipe = redis.pipeline(transaction=False)
+        pipe.hgetall(ProductViews.FOLDING_KEY)
+        pipe.hgetall(ProductViews.PENDING_KEY)
+
+        for pending in pipe.execute():
+            for field, views in pending.items():
+                if field == ProductViews.FOLD_ID_FIELD:
+                    continue
+
+                product_id, day = field.split(':')
+                product_id = int(product_id)
+
+                if product_id not in result:
+                    continue
+
+                day = datetime.strptime(day, '%Y-%m-%d')
+                if date_range_utc and ((date_range_utc[0] and day.date() < date_range_utc[0].date()) or (date_range_utc[1] and day.date() > date_range_utc[1].date())):
+                    continue
+
+                result[product_id] += int(views)
+
+        return result
+
+    @staticmethod
+    def get_unique_visitors(product_ids, days=UNIQUE_VISITORS_DAYS):
+        """
+        Returns dict product id -> estimated unique visitors in the last days (up to UNIQUE_VISITORS_DAYS)
+        """
+        product_ids = list(product_ids)
+        today = datetime.utcnow().date()
+
+        pipe = redis.pipeline(transaction=False)
+        for product_id in product_ids:
+            pipe.pfcount(*[ProductViews.get_unique_visitors_key(product_id, today - timedelta(days=i)) for i in range(days)])
+
+        return dict(zip(product_ids, pipe.execute()))
+
+    @staticmethod
+    @with_database
+    def rebuild(force=False):
+        """
+        Count views recorded before the counters were enabled from raw impressions
+        into rebuilt_views, so doing that again does not count them twice.
+        Returns False if that has been done already
+        """
+        if redis.exists(ProductViews.REBUILT_KEY) and not force:
+            return False
+
+        since = redis.get(ProductViews.SINCE_KEY)
+        since = datetime.strptime(since, STATISTIC_DATE_FORMAT) if since else datetime.utcnow()
+
+        Model = StatisticRecord.model_classes[StatisticRecord.Types.SERVICE_IMPRESSION]
+        first_date = Model.select(peewee.fn.MIN(Model.event_date)).scalar()
+
+        with db.atomic():
+            # Days of archived raw impressions keep their counts
+            if first_date:
+                ProductViewsModel.update(rebuilt_views=0).where(ProductViewsModel.day >= first_date.date()).execute()
+
+            db.execute_sql(
+                'INSERT INTO stat_product_views (product_id, day, rebuilt_views) '
+                'SELECT key_id, DATE(event_date), COUNT(*) FROM %s WHERE event_date < %%s GROUP BY key_id, DATE(event_date) '
+                'ON DUPLICATE KEY UPDATE rebuilt_views = VALUES(rebuilt_views)' % Model._meta.db_table,
+                [since]
+            )
+
+        redis.set(ProductViews.REBUILT_KEY, 1)
+
+        return True
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    month = dt.month - 1 + months
+    return datetime(dt.year + month / 12, month % 12 + 1, 1)
+
+
+class StatisticPartitions:
+    """
+    Raw statistic tables are partitioned by month of event_date (partitions p<YYYYMM> and pmax).
+    Partitions older than the retention of the record type (STATISTIC_RETENTION_MONTHS config,
+    record type -> months) are exported to gzipped per-column files and dropped by archive().
+    Only partitions which are rolled up already are dropped, so rollups keep their totals
+    """
+
+    MONTHS_AHEAD = 2
+    ARCHIVE_BATCH_SIZE = 10000
+
+    @staticmethod
+    def get_table(record_type):
+        return StatisticRecord.model_classes[record_type]._meta.db_table
+
+    @staticmethod
+    def get_partition_name(month):
+        return 'p%s' % month.strftime('%Y%m')
+
+    @staticmethod
+    def get_partition_definition(month):
+        return "PARTITION %s VALUES LESS THAN (TO_DAYS('%s'))" % (
+            StatisticPartitions.get_partition_name(month),
+            add_months(month, 1).strftime('%Y-%m-%d')
+        )
+
+    @staticmethod
+    def get_partitions(record_type):
+        """
+        Returns list of months of the table partitions (except pmax)
+        """
+        cursor = db.execute_sql(
+            'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL '
+            'ORDER BY PARTITION_ORDINAL_POSITION',
+            [StatisticPartitions.get_table(record_type)]
+        )
+
+        return [datetime.strptime(name, 'p%Y%m') for name, in cursor.fetchall() if name != 'pmax']
+
+    @staticmethod
+    @with_database
+    def partition(record_type):
+        """
+        Partition the existing table by month. Rebuilds the table, so it takes a while for large tables.
+        Returns False if the table is partitioned already
+        """
+        if StatisticPartitions.get_partitions(record_type):
+            return False
+
+        table = StatisticPartitions.get_table(record_type)
+        Model = StatisticRecord.model_classes[record_type]
+
+        first_date = Model.select(peewee.fn.MIN(Model.event_date)).scalar() or datetime.utcnow()
+        last_month = add_months(month_start(datetime.utcnow()), StatisticPartitions.MONTHS_AHEAD)
+
+        months = [month_start(first_date)]
+        while months[-1] < last_month:
+            months.append(add_months(months[-1], 1))
+
+        # Partitioning column has to be a part of the primary key
+        db.execute_sql('ALTER TABLE %s DROP PRIMARY KEY, ADD PRIMARY KEY (id, event_date)' % table)
+        db.execute_sql('ALTER TABLE %s PARTITION BY RANGE (TO_DAYS(event_date)) (%s, PARTITION pmax VALUES LESS THAN MAXVALUE)' % (
+            table,
+            ', '.join(map(StatisticPartitions.get_partition_definition, months))
+        ))
+
+        return True
+
+    @staticmethod
+    @with_database
+    def add_partitions():
+        """
+        Create partitions for the next months of partitioned tables
+        """
+        last_month = add_months(month_start(datetime.utcnow()), StatisticPartitions.MONTHS_AHEAD)
+        result = dict()
+
+        for record_type in StatisticRecord.types():
+            partitions = StatisticPartitions.get_partitions(record_type)
+            if not partitions:
+                continue
+
+            months = list()
+            while (months[-1] if months else partitions[-1]) < last_month:
+                months.append(add_months(months[-1] if months else partitions[-1], 1))
+
+            if months:
+                db.execute_sql('ALTER TABLE %s REORGANIZE PARTITION pmax INTO (%s, PARTITION pmax VALUES LESS THAN MAXVALUE)' % (
+                    StatisticPartitions.get_table(record_type),
+                    ', '.join(map(StatisticPartitions.get_partition_definition, months))
+                ))
+
+            result[record_type] = len(months)
+
+        return result
+
+    @staticmethod
+    def get_expired_partitions(record_type):
+        """
+        Returns months of partitions to be archived: older than retention and rolled up
+        """
+        retention = app.config.get('STATISTIC_RETENTION_MONTHS', dict()).get(record_type)
+        watermark = StatisticRecord.get_watermark(record_type)
+
+        if not retention or not watermark:
+            return []
+
+        expired_before = min(add_months(month_start(datetime.utcnow()), -retention), watermark)
+
+        return [month for month in StatisticPartitions.get_partitions(record_type) if add_months(month, 1) <= expired_before]
+
+    @staticmethod
+    def export_partition(record_type, month, path):
+        """
+        Write rows of the partition into <path>/<table>/<YYYY-MM>/<column>.gz files (JSON value per line)
+        """
+        table = StatisticPartitions.get_table(record_type)
+        partition = StatisticPartitions.get_partition_name(month)
+        columns = ('id', 'key_id', 'key_value', 'event_date', 'data')
+
+        directory = os.path.join(path, table, month.strftime('%Y-%m'))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        files = dict((column, gzip.open(os.path.join(directory, '%s.gz' % column), 'wb')) for column in columns)
+
+        count = 0
+        last_id = 0
+
+        try:
+            while True:
+                rows = db.execute_sql(
+                    'SELECT %s FROM %s PARTITION (%s) WHERE id > %%s ORDER BY id LIMIT %d' % (
+                        ', '.join(columns), table, partition, StatisticPartitions.ARCHIVE_BATCH_SIZE
+                    ),
+                    [last_id]
+                ).fetchall()
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    for column, value in zip(columns, row):
+                        if isinstance(value, datetime):
+                            value = value.strftime(STATISTIC_DATE_FORMAT)
+                        files[column].write(json.dumps(value) + '\n')
+
+                count += len(rows)
+                last_id = rows[-1][0]
+        finally:
+            for f in files.values():
+                f.close()
+
+        with open(os.path.join(directory, 'meta.json'), 'wt') as f:
+            json.dump(dict(record_type=record_type, month=month.strftime('%Y-%m'), columns=columns, rows=count), f)
+
+        return count
+
+    @staticmethod
+    @with_database
+    def archive(path, dry_run=False):
+        """
+        Export and drop expired partitions. Returns list of (record type, month, rows)
+        """
+        result = list()
+
+        for record_type in StatisticRecord.types():
+            for month in StatisticPartitions.get_expired_partitions(record_type):
+                if dry_run:
+                    result.append((record_type, month, None))
+                    continue
+
+                count = StatisticPartitions.export_partition(record_type, month, path)
+
+                db.execute_sql('ALTER TABLE %s DROP PARTITION %s' % (
+                    StatisticPartitions.get_table(record_type),
+                    StatisticPartitions.get_partition_name(month)
+                ))
+
+                result.append((record_type, month, count))
 
-        result = query.scalar()
-        return float(query.scalar()) if result else 0.0
+        return result
 
 
 StatisticRecord.initialize()
 AffiliateImpression.initialize()
+ProductViews.initialize()
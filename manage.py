@@ -71,7 +71,12 @@ def background(shift='0'):
         { 'fn': periodic.check_unread_messages, 'desc': 'Send emails with unread messages', 'period': PERIOD_MINUTE },
         { 'fn': periodic.fake_update_users_time, 'desc': 'Update Last Seen & Response Time with fake data (every 48 hours)', 'period': PERIOD_HOUR },
         { 'fn': periodic.check_product_features, 'desc': 'Remove expired features from products', 'period': PERIOD_HOUR },
-        { 'fn': periodic.check_invites, 'desc': 'Send emails with invites', 'period': PERIOD_MINUTE }
+        { 'fn': periodic.check_invites, 'desc': 'Send emails with invites', 'period': PERIOD_MINUTE },
+        { 'fn': periodic.flush_user_presence, 'desc': 'Write last seen dates of users', 'period': PERIOD_MINUTE },
+        { 'fn': periodic.warm_referer_cache, 'desc': 'Cache ids of affiliates', 'period': PERIOD_DAY },
+        { 'fn': periodic.rollup_statistics, 'desc': 'Roll up statistic records per hour', 'period': PERIOD_MINUTE * 10 },
+        { 'fn': periodic.fold_product_views, 'desc': 'Write product view counters', 'period': PERIOD_MINUTE },
+        { 'fn': periodic.add_statistic_partitions, 'desc': 'Add monthly partitions of statistic tables', 'period': PERIOD_DAY }
     ]
 
     for idx, task in enumerate(tasks, 1):
@@ -133,15 +138,27 @@ def update_exchange_rate():
 
 
 @manager.command
-def rebuild_search_index():
+def init_search_index():
+    """Create the first version of the search index with read/write aliases"""
     from app import search
 
-    if prompt_bool("Drop index and recreate again (only do this if you are sure)?"):
-        print "Dropping index..."
-        search.delete_index()
+    index = search.init_index()
 
-        print "Creating index..."
-        search.create_index()
+    if index:
+        print "Search index {0} is initialized".format(index)
+    else:
+        print "Search index is already initialized"
+
+
+@manager.command
+def rebuild_search_index(batch_size=500, workers=4, resume=False):
+    """
+    Build new version of the search index and switch to it once it is ready.
+    Search keeps working on the current version meanwhile. Use --resume to continue interrupted rebuild
+    """
+    from app import search
+
+    batch_size, workers = int(batch_size), int(workers)
 
     sellers_query = User.query.filter(User.is_deleted != True, User.seller_fee_paid == True)
     products_query = Product.query_active(include_private=True)
@@ -149,21 +166,318 @@ def rebuild_search_index():
     if not prompt_bool("Total count of the sellers/products to be indexed: {0}/{1}.\nPlease confirm operation".format(sellers_query.count(), products_query.count())):
         print "Cancelled"
         return
-    
-    counter = 0
-    for seller in sellers_query:
-        search.add_seller_to_index(seller)
-        counter += 1
+
+    if resume:
+        index = search.get_building_index()
+        if not index:
+            print "There is no search index being built"
+            return
+
+        print "Resuming build of index {0}...".format(index)
+    else:
+        index = search.start_index_build()
+        print "Building index {0}...".format(index)
+
+    counter = search.reindex_sellers(index, batch_size=batch_size, workers=workers, resume=resume)
 
     print "Successfully added to index {0} sellers".format(counter)
-    
-    counter = 0
-    for product in products_query:
-        search.add_product_to_index(product)
-        counter += 1
+
+    counter = search.reindex_products(index, batch_size=batch_size, workers=workers, resume=resume)
 
     print "Successfully added to index {0} products".format(counter)
 
+    counter = search.catch_up_index_build(index)
+
+    print "Reindexed {0} products changed during the build".format(counter)
+
+    search.finish_index_build(index)
+
+    print "Switched search to index {0}".format(index)
+
+
+@manager.command
+def rollback_search_index():
+    """Switch search back to the previous version of the index"""
+    from app import search
+
+    if not prompt_bool("Switch search back to the previous version of the index?"):
+        return
+
+    index = search.rollback_index()
+
+    if index:
+        print "Switched search to index {0}".format(index)
+    else:
+        print "There is no previous version of the index"
+
+
+@manager.command
+def search_queue_worker(batch_size=500, interval=1):
+    """Index documents queued by product/seller updates. To be used with PM2"""
+    import time
+    from app import search
+
+    batch_size, interval = int(batch_size), float(interval)
+
+    raven_client = Client(app.config['SENTRY_DSN']) if 'SENTRY_DSN' in app.config else None
+
+    print "***** Running search queue worker. Queue length: %d" % search.get_search_queue_length()
+
+    while True:
+        count = 0
+
+        try:
+            count = search.process_search_queue(batch_size)
+            if count:
+                print "%s: indexed %d queued documents" % (datetime.now(), count)
+        except Exception, e:
+            if raven_client:
+                raven_client.captureException()
+
+            print "Exception while processing search queue"
+            print e
+        finally:
+            db.session.remove()
+
+        if count < batch_size:
+            time.sleep(interval)
+
+
+@manager.command
+def cache_refresher(interval=10):
+    """Keep hot cached values (category tree etc) fresh in the background. To be used with PM2"""
+    import time
+    from app import cache
+
+    interval = float(interval)
+
+    raven_client = Client(app.config['SENTRY_DSN']) if 'SENTRY_DSN' in app.config else None
+
+    print "***** Running cache refresher. Hot keys: %s" % ', '.join(sorted(cache.hot_keys))
+
+    while True:
+        # Recompute functions may build URLs
+        with app.test_request_context():
+            try:
+                refreshed = cache.refresh_hot_keys()
+                if refreshed:
+                    print "%s: refreshed %s" % (datetime.now(), ', '.join(refreshed))
+            except Exception, e:
+                if raven_client:
+                    raven_client.captureException()
+
+                print "Exception while refreshing hot keys"
+                print e
+            finally:
+                db.session.remove()
+
+        time.sleep(interval)
+
+
+@manager.command
+def redis_latency():
+    """Print average latency of redis commands"""
+    from app import redis
+
+    stats = redis.get_latency_stats()
+
+    for command, item in sorted(stats.items(), key=lambda item: -item[1]['time']):
+        print "%-16s %10d calls %8.2f ms avg %12.0f ms total" % (command, item['count'], item['avg_ms'] or 0, item['time'])
+
+
+@manager.command
+def statistic_queue_worker(batch_size=1000, interval=1):
+    """Write queued statistic records to the statistic database. To be used with PM2"""
+    import time
+    from app.statistic import StatisticRecord
+
+    batch_size, interval = int(batch_size), float(interval)
+
+    raven_client = Client(app.config['SENTRY_DSN']) if 'SENTRY_DSN' in app.config else None
+
+    print "***** Running statistic queue worker. Queue: %(queued)d records, lag %(lag).1f s" % StatisticRecord.get_queue_stats()
+
+    while True:
+        count = 0
+
+        try:
+            count = StatisticRecord.flush_queue(batch_size)
+        except Exception, e:
+            if raven_client:
+                raven_client.captureException()
+
+            print "Exception while writing statistic records"
+            print e
+
+        # Full batches are written right away, otherwise records are collected for interval seconds
+        if count < batch_size:
+            time.sleep(interval)
+
+
+@manager.command
+def statistic_queue_stats():
+    """Print length and lag of the statistic records queue"""
+    from app.statistic import StatisticRecord
+
+    stats = StatisticRecord.get_queue_stats()
+
+    print "Queued: %d" % stats['queued']
+    print "Processing: %d" % stats['processing']
+    print "Dead letter: %d" % stats['dead']
+    print "Lag: %.1f s" % stats['lag']
+
+
+@manager.command
+def partition_statistics():
+    """Partition raw statistic tables by month (rebuilds the tables)"""
+    from app.statistic import StatisticRecord, StatisticPartitions
+
+    for record_type in StatisticRecord.types():
+        print "%s: %s" % (record_type, 'partitioned' if StatisticPartitions.partition(record_type) else 'partitioned already')
+
+
+@manager.command
+def archive_statistics(path='archive/statistic', dry_run=False):
+    """Export statistic partitions older than STATISTIC_RETENTION_MONTHS to files and drop them"""
+    from app.statistic import StatisticPartitions
+
+    archived = StatisticPartitions.archive(path, dry_run=bool(dry_run))
+
+    for record_type, month, count in archived:
+        if dry_run:
+            print "%s %s: to be archived" % (record_type, month.strftime('%Y-%m'))
+        else:
+            print "%s %s: archived %d records" % (record_type, month.strftime('%Y-%m'), count)
+
+    if not archived:
+        print "Nothing to archive"
+
+
+@manager.command
+def rebuild_affiliate_impressions():
+    """Fill redis deduplication data of affiliate impressions from the database"""
+    from app.statistic import AffiliateImpression
+
+    print "Processed %d impressions" % AffiliateImpression.rebuild()
+
+
+@manager.command
+def rebuild_product_views(force=False):
+    """Count product views recorded before view counters were enabled (once)"""
+    from app.statistic import ProductViews
+
+    if ProductViews.rebuild(force=bool(force)):
+        print "Product views have been rebuilt"
+    else:
+        print "Product views have been rebuilt already, use --force to do that again"
+
+
+@manager.command
+def search_cache_stats():
+    """Print hit/miss counters of the search result cache"""
+    from app import search
+
+    stats = search.get_search_cache_stats()
+
+    print "Hits: %d" % stats['hits']
+    print "Misses: %d" % stats['misses']
+
+    if stats['hit_ratio'] is not None:
+        print "Hit ratio: %.1f%%" % (stats['hit_ratio'] * 100)
+
+
+@manager.command
+def cache_stats():
+    """Print hit ratios of the shared objects cache per tier"""
+    from app import cache
+
+    stats = cache.get_cache_stats()
+
+    print "Local (L1) hits: %d" % stats['local_hits']
+    print "Redis hits: %d" % stats['redis_hits']
+    print "Misses: %d" % stats['misses']
+
+    for label, key in (('Local hit ratio', 'local_hit_ratio'), ('Redis hit ratio (of L1 misses)', 'redis_hit_ratio'), ('Total hit ratio', 'hit_ratio')):
+        if stats[key] is not None:
+            print "%s: %.1f%%" % (label, stats[key] * 100)
+
+
+@manager.command
+def benchmark_search(count=100, query=''):
+    """Measure search_products time per sorting (against the configured SEARCH_BACKEND, without cache)"""
+    import time
+    from app import search
+
+    count = int(count)
+
+    app.config['SEARCH_CACHE_ENABLED'] = False
+
+    # Local index is loaded outside of measurements
+    search.get_backend()
+
+    for name, sorting in sorted(vars(search.ProductSorting).items()):
+        if name.startswith('_'):
+            continue
+
+        started = time.time()
+
+        for i in range(count):
+            search.search_products(q=query, sorting=sorting, random_seed=i, start=0, limit=20)
+
+        print "%s: %.2f ms" % (name, (time.time() - started) * 1000 / count)
+
+
+@manager.command
+def benchmark_serializer(count=100, sample=200):
+    """Compare encode/decode time and size of serializers on values cached in redis"""
+    import time
+    import cPickle as pickle
+    from app import redis
+    from app.serializer import Serializer
+
+    count, sample = int(count), int(sample)
+
+    # Real values: shared cache objects (category tree, statistics etc) and sessions
+    values = list()
+    for pattern in ('cache:*', 'session:*'):
+        keys = [key for _, key in zip(range(sample), redis.scan_iter(pattern, count=sample))]
+        for data in redis.mget(keys) if keys else []:
+            if data:
+                values.append(Serializer().loads(data))
+
+    if not values:
+        print "No cached values found"
+        return
+
+    serializers = [
+        ('pickle protocol 0', lambda value: pickle.dumps(value), pickle.loads),
+        ('pickle protocol 2', lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ('serializer', Serializer(compress_threshold=None).dumps, Serializer().loads),
+        ('serializer + zlib', Serializer().dumps, Serializer().loads)
+    ]
+
+    print "Values: %d" % len(values)
+
+    for name, dumps, loads in serializers:
+        encoded = map(dumps, values)
+
+        started = time.time()
+        for i in range(count):
+            map(dumps, values)
+        encode_time = time.time() - started
+
+        started = time.time()
+        for i in range(count):
+            map(loads, encoded)
+        decode_time = time.time() - started
+
+        print "%-20s encode %8.1f us  decode %8.1f us  size %10d bytes" % (
+            name,
+            encode_time * 1000000 / count / len(values),
+            decode_time * 1000000 / count / len(values),
+            sum(map(len, encoded))
+        )
+
 
 @manager.command
 def add_test_users():
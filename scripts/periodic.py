@@ -1,12 +1,13 @@
 from flask import url_for
 from datetime import datetime, timedelta, date
 from sqlalchemy import or_
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, case
 from sqlalchemy.sql.expression import bindparam
 from sqlalchemy.orm import joinedload
 
 from app import app, db, search, messaging, email, cache
 from app.utils import slack
+from app.statistic import StatisticRecord, ProductViews, StatisticPartitions
 from app.models import User, Variable, BitcoinAddress, Transaction, Order, OrderHistory, Category, Product, Dispute, \
     FavoriteSearch, ProductOffer, UserInvitation, isoparse, EnquiryOffer
 
@@ -108,7 +109,7 @@ def check_offers():
     for offer in offers:
         product = offer.get_product()
         product.set_active_offer(offer)
-        search.add_product_to_index(product)
+        search.queue_product_update(product)
 
     products = Product.query.filter(Product.active_offer_id != None) \
                             .filter(ProductOffer.id == Product.active_offer_id) \
@@ -116,7 +117,7 @@ def check_offers():
 
     for product in products:
         product.set_active_offer(None)
-        search.add_product_to_index(product)
+        search.queue_product_update(product)
 
 
 def check_pending_transactions():
@@ -147,13 +148,13 @@ def update_exchange_rate():
         print "Unable to get last exchange rate"
 
         rate = None
-        var = Variable.query.get('exchange_rate')
+        set_on = Variable.get_set_on('exchange_rate')
 
-        if var:
-            delta = datetime.utcnow() - var.set_on
+        if set_on:
+            delta = datetime.utcnow() - set_on
             if delta.seconds < app.config['EXCHANGE_RATE_EXPIRATION']:
                 # Previous rate has not yet expired
-                rate = var.value
+                rate = Variable.get_float('exchange_rate')
 
     # Set exchange rate to None if the site couldn't get the exchange rate
     Variable.set('exchange_rate', unicode(rate) if rate else None)
@@ -279,6 +280,55 @@ def check_invites():
         db.session.commit()
 
 
+def flush_user_presence(batch_size=1000):
+    print "Writing last seen dates of users from presence store"
+
+    watermark, presence = cache.get_presence_to_flush()
+    user_ids = sorted(presence)
+
+    for idx in range(0, len(user_ids), batch_size):
+        batch_ids = user_ids[idx:idx + batch_size]
+        dates = dict((user_id, datetime.utcfromtimestamp(presence[user_id])) for user_id in batch_ids)
+
+        User.query \
+            .filter(User.id.in_(batch_ids)) \
+            .update({User.last_logged_on: case(dates, value=User.id)}, synchronize_session=False)
+
+        db.session.commit()
+
+    cache.set_presence_flushed(watermark)
+
+    print 'Updated %d users' % len(user_ids)
+
+
+def rollup_statistics():
+    print "Rolling up statistic records per hour"
+
+    for record_type, hours in sorted(StatisticRecord.rollup().items()):
+        if hours:
+            print '%s: rolled up %d hours' % (record_type, hours)
+
+
+def add_statistic_partitions():
+    print "Adding monthly partitions of statistic tables"
+
+    for record_type, count in sorted(StatisticPartitions.add_partitions().items()):
+        if count:
+            print '%s: added %d partitions' % (record_type, count)
+
+
+def fold_product_views():
+    print "Writing product view counters"
+
+    print 'Folded %d counters' % ProductViews.fold()
+
+
+def warm_referer_cache():
+    print "Caching ids of affiliates"
+
+    print 'Cached %d affiliates' % User.warm_referer_cache()
+
+
 def fake_update_users_time():
     VARIABLE_NAME = 'fake_users_time_updated'
 
@@ -318,7 +368,7 @@ def check_product_features():
             for feature in product.get_features():
                 if isoparse(feature['end_date']) <= datetime.utcnow():
                     product.remove_feature(feature)
-                    search.add_product_to_index(product)
+                    search.queue_product_update(product)
                     features_modified += 1
 
             if features_modified:
@@ -0,0 +1,246 @@
+import math
+import unittest
+from datetime import datetime
+
+from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+
+from app.search_backends import MemorySearchBackend, BM25_K1, BM25_B
+
+
+PRODUCTS = {
+    1: dict(title='red shoes', description='leather shoes', category_id=1, price=1000, is_private=False, tags=['shoes', 'leather'], published_on=datetime(2017, 5, 1)),
+    2: dict(title='red red hat', description='wool hat', category_id=1, price=2500, is_private=False, tags=['hat'], published_on=datetime(2017, 5, 2)),
+    3: dict(title='blue hat', description='red wool hat for winter', category_id=2, price=4000, is_private=True, tags=['hat', 'winter'], published_on=datetime(2017, 5, 3)),
+    4: dict(title='green scarf', description='wool', category_id=2, price=None, is_private=False, tags=[], published_on=datetime(2017, 5, 4), seller_active=False)
+}
+
+
+def bm25(frequency, length, average_length, count, matching):
+    idf = math.log(1 + (count - matching + 0.5) / (matching + 0.5))
+    return idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+
+
+class MemorySearchBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemorySearchBackend()
+        self.backend.create_index('products_1', {})
+        self.backend.update_aliases([{'add': {'index': 'products_1', 'alias': 'products'}}])
+
+        self.backend.bulk('products', [
+            ('index', {'_type': 'product', '_id': id}, document) for id, document in PRODUCTS.items()
+        ])
+
+    def search(self, body):
+        return self.backend.search('products', 'product', body)
+
+    def get_ids(self, body):
+        return [int(hit['_id']) for hit in self.search(body)['hits']['hits']]
+
+    def aggregate(self, aggs, query=None):
+        body = dict(size=0, aggs=aggs)
+        if query:
+            body['query'] = query
+
+        return self.search(body)['aggregations']
+
+
+class TestMemoryIndex(MemorySearchBackendTestCase):
+    def test_missing_index(self):
+        with self.assertRaises(ElasticHttpNotFoundError):
+            self.backend.search('missing', 'product', {})
+
+    def test_search_through_alias(self):
+        result = self.search({'sort': [{'price': 'desc'}], 'from': 1, 'size': 2})
+
+        self.assertEqual(result['hits']['total'], 4)
+        self.assertEqual([int(hit['_id']) for hit in result['hits']['hits']], [2, 1])
+
+    def test_missing_sort_values_last(self):
+        self.assertEqual(self.get_ids({'sort': [{'price': 'asc'}]}), [1, 2, 3, 4])
+        self.assertEqual(self.get_ids({'sort': [{'price': 'desc'}]}), [3, 2, 1, 4])
+
+    def test_remove(self):
+        self.backend.delete('products', 'product', 2)
+
+        self.assertEqual(self.count({'term': {'tags': 'hat'}}), 1)
+        self.assertEqual(self.get_ids({'query': {'multi_match': {'query': 'red', 'fields': ['title']}}}), [1])
+
+    def test_update(self):
+        self.backend.index('products', 'product', dict(PRODUCTS[1], title='yellow shoes', price=500), 1)
+
+        self.assertEqual(self.get_ids({'query': {'multi_match': {'query': 'red', 'fields': ['title']}}}), [2])
+        self.assertEqual(self.count({'range': {'price': {'lt': 1000}}}), 1)
+
+    def count(self, query):
+        return self.backend.count('products', 'product', {'query': query})['count']
+
+
+class TestMemoryScoring(MemorySearchBackendTestCase):
+    def test_bm25(self):
+        """
+        Score of a single field query is BM25 of the query terms
+        """
+        result = self.search({'query': {'multi_match': {'query': 'red', 'fields': ['title']}}})
+        scores = dict((int(hit['_id']), hit['_score']) for hit in result['hits']['hits'])
+
+        # Title lengths are 2, 3, 2 and 2 tokens, "red" is in two titles of four
+        average_length = 9 / 4.0
+
+        self.assertEqual(sorted(scores), [1, 2])
+        self.assertAlmostEqual(scores[1], bm25(1, 2, average_length, 4, 2))
+        self.assertAlmostEqual(scores[2], bm25(2, 3, average_length, 4, 2))
+
+    def test_term_frequency(self):
+        """
+        More occurrences score higher, in spite of the longer title
+        """
+        self.assertEqual(self.get_ids({'query': {'multi_match': {'query': 'red', 'fields': ['title']}}}), [2, 1])
+
+    def test_rare_terms(self):
+        """
+        Rare terms weigh more than common ones, and matches in shorter fields more than in longer ones
+        """
+        self.assertEqual(self.get_ids({'query': {'multi_match': {'query': 'shoes hat', 'fields': ['title']}}}), [1, 3, 2])
+
+    def test_best_field(self):
+        """
+        Document is scored by its best matching field (multiplied by the boost), not by the sum of fields
+        """
+        query = {'multi_match': {'query': 'red', 'fields': ['title^3', 'description']}}
+        scores = dict((int(hit['_id']), hit['_score']) for hit in self.search({'query': query})['hits']['hits'])
+
+        title_scores = dict((int(hit['_id']), hit['_score']) for hit in self.search({'query': {'multi_match': {'query': 'red', 'fields': ['title']}}})['hits']['hits'])
+        description_scores = dict((int(hit['_id']), hit['_score']) for hit in self.search({'query': {'multi_match': {'query': 'red', 'fields': ['description']}}})['hits']['hits'])
+
+        self.assertEqual(sorted(scores), [1, 2, 3])
+        self.assertAlmostEqual(scores[1], 3 * title_scores[1])
+        self.assertAlmostEqual(scores[2], 3 * title_scores[2])
+        self.assertAlmostEqual(scores[3], description_scores[3])
+
+    def test_filtered_query(self):
+        query = {
+            'filtered': {
+                'query': {'multi_match': {'query': 'hat', 'fields': ['title', 'description']}},
+                'filter': {'bool': {'must': [{'term': {'is_private': False}}]}}
+            }
+        }
+
+        self.assertEqual(self.get_ids({'query': query}), [2])
+
+
+class TestMemoryFilters(MemorySearchBackendTestCase):
+    def filter(self, clause):
+        return sorted(self.get_ids({'query': {'filtered': {'filter': clause}}, 'size': 10}))
+
+    def test_term(self):
+        self.assertEqual(self.filter({'term': {'tags': 'hat'}}), [2, 3])
+        self.assertEqual(self.filter({'term': {'is_private': True}}), [3])
+
+    def test_terms(self):
+        self.assertEqual(self.filter({'terms': {'category_id': [2, 3]}}), [3, 4])
+
+    def test_range(self):
+        self.assertEqual(self.filter({'range': {'price': {'gte': 1000, 'lt': 4000}}}), [1, 2])
+        self.assertEqual(self.filter({'range': {'published_on': {'gt': datetime(2017, 5, 2)}}}), [3, 4])
+
+    def test_must_not_missing_field(self):
+        """
+        Documents without the field are not excluded by must_not term
+        """
+        self.assertEqual(self.filter({'bool': {'must_not': {'term': {'seller_active': False}}}}), [1, 2, 3])
+
+    def test_should(self):
+        self.assertEqual(self.filter({'bool': {'should': [{'term': {'category_id': 2}}, {'term': {'tags': 'shoes'}}]}}), [1, 3, 4])
+
+
+class TestMemoryAggregations(MemorySearchBackendTestCase):
+    def test_terms(self):
+        """
+        Buckets are ordered by count, then by key
+        """
+        result = self.aggregate({'tags': {'terms': {'field': 'tags'}}})['tags']
+
+        self.assertEqual([(bucket['key'], bucket['doc_count']) for bucket in result['buckets']], [
+            ('hat', 2), ('leather', 1), ('shoes', 1), ('winter', 1)
+        ])
+        self.assertEqual(result['sum_other_doc_count'], 0)
+
+    def test_terms_size(self):
+        result = self.aggregate({'tags': {'terms': {'field': 'tags', 'size': 1}}})['tags']
+
+        self.assertEqual([bucket['key'] for bucket in result['buckets']], ['hat'])
+        self.assertEqual(result['sum_other_doc_count'], 3)
+
+    def test_metrics(self):
+        result = self.aggregate({
+            'max': {'max': {'field': 'price'}},
+            'min': {'min': {'field': 'price'}},
+            'avg': {'avg': {'field': 'price'}},
+            'sum': {'sum': {'field': 'price'}},
+            'stats': {'stats': {'field': 'price'}},
+            'categories': {'cardinality': {'field': 'category_id'}}
+        })
+
+        self.assertEqual(result['max']['value'], 4000.0)
+        self.assertEqual(result['min']['value'], 1000.0)
+        self.assertEqual(result['avg']['value'], 2500.0)
+        self.assertEqual(result['sum']['value'], 7500.0)
+        self.assertEqual(result['stats'], dict(count=3, min=1000.0, max=4000.0, avg=2500.0, sum=7500.0))
+        self.assertEqual(result['categories']['value'], 2)
+
+    def test_metrics_without_values(self):
+        result = self.aggregate({
+            'max': {'max': {'field': 'price'}},
+            'sum': {'sum': {'field': 'price'}}
+        }, query={'term': {'category_id': 3}})
+
+        self.assertEqual(result['max']['value'], None)
+        self.assertEqual(result['sum']['value'], 0.0)
+
+    def test_range(self):
+        result = self.aggregate({'prices': {'range': {'field': 'price', 'ranges': [{'to': 2500}, {'from': 2500}]}}})
+
+        self.assertEqual(result['prices']['buckets'], [
+            {'key': '*-2500.0', 'to': 2500, 'doc_count': 1},
+            {'key': '2500.0-*', 'from': 2500, 'doc_count': 2}
+        ])
+
+    def test_histogram(self):
+        result = self.aggregate({'prices': {'histogram': {'field': 'price', 'interval': 1000}}})
+
+        self.assertEqual([(bucket['key'], bucket['doc_count']) for bucket in result['prices']['buckets']], [
+            (1000, 1), (2000, 1), (4000, 1)
+        ])
+
+    def test_histogram_extended_bounds(self):
+        """
+        Empty buckets are returned within extended bounds when min_doc_count is 0
+        """
+        result = self.aggregate({'prices': {'histogram': {
+            'field': 'price',
+            'interval': 1000,
+            'min_doc_count': 0,
+            'extended_bounds': {'min': 0, 'max': 5000}
+        }}})
+
+        self.assertEqual([(bucket['key'], bucket['doc_count']) for bucket in result['prices']['buckets']], [
+            (0, 0), (1000, 1), (2000, 1), (3000, 0), (4000, 1), (5000, 0)
+        ])
+
+    def test_filter_with_subaggregations(self):
+        result = self.aggregate({'public': {
+            'filter': {'term': {'is_private': False}},
+            'aggs': {'categories': {'terms': {'field': 'category_id'}}}
+        }})
+
+        self.assertEqual(result['public']['doc_count'], 3)
+        self.assertEqual([(bucket['key'], bucket['doc_count']) for bucket in result['public']['categories']['buckets']], [
+            (1, 2), (2, 1)
+        ])
+
+    def test_aggregations_of_matching_documents(self):
+        result = self.aggregate({'categories': {'terms': {'field': 'category_id'}}}, query={'term': {'tags': 'hat'}})
+
+        self.assertEqual([(bucket['key'], bucket['doc_count']) for bucket in result['categories']['buckets']], [
+            (1, 1), (2, 1)
+        ])
@@ -0,0 +1,103 @@
+import os
+import unittest
+import cPickle as pickle
+from datetime import datetime
+
+from markupsafe import Markup
+
+from app.serializer import Serializer
+
+
+class TestSerializer(unittest.TestCase):
+    def setUp(self):
+        self.serializer = Serializer()
+
+    def get_header(self, data):
+        return data[:Serializer.HEADER_LENGTH]
+
+    def test_plain_data(self):
+        """
+        Plain data is encoded with marshal
+        """
+        value = {
+            'id': 1,
+            'title': u'T\xedtulo',
+            'key': 'bytes',
+            'price': 12.5,
+            'tags': ['one', 'two'],
+            'bounds': (0, None),
+            'is_private': False
+        }
+
+        data = self.serializer.dumps(value)
+
+        self.assertEqual(self.get_header(data), '\x00\x01m-')
+        self.assertEqual(self.serializer.loads(data), value)
+
+    def test_pickle_fallback(self):
+        """
+        Values marshal doesn't support are pickled
+        """
+        value = dict(created_on=datetime(2017, 5, 1, 10, 30))
+
+        data = self.serializer.dumps(value)
+
+        self.assertEqual(self.get_header(data), '\x00\x01p-')
+        self.assertEqual(self.serializer.loads(data), value)
+
+    def test_string_subclass(self):
+        """
+        Subclasses of builtin types are pickled to keep their type and value
+        """
+        value = dict(title=Markup(u'<b>T\xedtulo</b>'), tags=[Markup('one')])
+
+        data = self.serializer.dumps(value)
+        loaded = self.serializer.loads(data)
+
+        self.assertEqual(self.get_header(data), '\x00\x01p-')
+        self.assertEqual(loaded, value)
+        self.assertIsInstance(loaded['title'], Markup)
+
+    def test_compression(self):
+        value = dict(description=u'lorem ipsum ' * 1000)
+
+        data = self.serializer.dumps(value)
+
+        self.assertEqual(self.get_header(data), '\x00\x01mz')
+        self.assertLess(len(data), 1024)
+        self.assertEqual(self.serializer.loads(data), value)
+
+    def test_incompressible(self):
+        """
+        Payload is stored uncompressed in case compression doesn't make it smaller
+        """
+        value = os.urandom(4096)
+
+        data = self.serializer.dumps(value)
+
+        self.assertEqual(self.get_header(data), '\x00\x01m-')
+        self.assertEqual(self.serializer.loads(data), value)
+
+    def test_compression_disabled(self):
+        serializer = Serializer(compress_threshold=None)
+        value = 'a' * 4096
+
+        data = serializer.dumps(value)
+
+        self.assertEqual(self.get_header(data), '\x00\x01m-')
+        self.assertEqual(serializer.loads(data), value)
+
+    def test_legacy_pickle(self):
+        """
+        Values stored before the header was introduced are plain pickles
+        """
+        value = dict(id=1, created_on=datetime(2017, 5, 1), title=u'T\xedtulo')
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(self.serializer.loads(pickle.dumps(value, protocol)), value)
+
+    def test_unknown_version(self):
+        data = self.serializer.dumps(dict(id=1))
+
+        with self.assertRaises(ValueError):
+            self.serializer.loads(data[0] + '\x02' + data[2:])
@@ -0,0 +1,141 @@
+import unittest
+from datetime import datetime, timedelta
+
+import pytz
+
+from app.statistic import StatisticRecord, floor_hour, ceil_hour
+
+
+def record_class(watermark):
+    """
+    StatisticRecord rolled up to the watermark, without querying the database
+    """
+    class Record(StatisticRecord):
+        @classmethod
+        def get_watermark(cls, record_type):
+            return watermark
+
+    return Record
+
+
+class TestHours(unittest.TestCase):
+    def test_floor_hour(self):
+        self.assertEqual(floor_hour(datetime(2017, 5, 1, 10, 59, 59, 999999)), datetime(2017, 5, 1, 10))
+        self.assertEqual(floor_hour(datetime(2017, 5, 1, 10)), datetime(2017, 5, 1, 10))
+
+    def test_ceil_hour(self):
+        self.assertEqual(ceil_hour(datetime(2017, 5, 1, 10, 0, 0, 1)), datetime(2017, 5, 1, 11))
+        self.assertEqual(ceil_hour(datetime(2017, 5, 1, 10)), datetime(2017, 5, 1, 10))
+        self.assertEqual(ceil_hour(datetime(2017, 12, 31, 23, 30)), datetime(2018, 1, 1))
+
+
+class TestSplitRange(unittest.TestCase):
+    watermark = datetime(2017, 5, 10, 12)
+
+    def split(self, date_range_utc, watermark=watermark):
+        return record_class(watermark)._split_range('service_impression', date_range_utc)
+
+    def test_not_rolled_up(self):
+        """
+        Everything is read from raw records before the first rollup
+        """
+        date_range = (datetime(2017, 5, 1, 10, 30), datetime(2017, 5, 2, 10, 30))
+        self.assertEqual(self.split(date_range, watermark=None), (None, [(date_range[0], date_range[1], True)]))
+        self.assertEqual(self.split(None, watermark=None), (None, [(None, None, True)]))
+
+    def test_whole_history(self):
+        self.assertEqual(self.split(None), ((None, self.watermark), [(self.watermark, None, True)]))
+
+    def test_edges_within_hours(self):
+        """
+        Partial hours at the start and after the watermark are read from raw records
+        """
+        start, end = datetime(2017, 5, 1, 10, 30), datetime(2017, 5, 20, 8, 15)
+        self.assertEqual(self.split((start, end)), (
+            (datetime(2017, 5, 1, 11), self.watermark),
+            [(start, datetime(2017, 5, 1, 11), False), (self.watermark, end, True)]
+        ))
+
+    def test_end_before_watermark(self):
+        start, end = datetime(2017, 5, 1, 10), datetime(2017, 5, 3, 8, 15)
+        self.assertEqual(self.split((start, end)), (
+            (start, datetime(2017, 5, 3, 8)),
+            [(datetime(2017, 5, 3, 8), end, True)]
+        ))
+
+    def test_hour_edges(self):
+        """
+        Range is inclusive, so records at the very end hour are still read from raw records
+        """
+        start, end = datetime(2017, 5, 1, 10), datetime(2017, 5, 3, 8)
+        self.assertEqual(self.split((start, end)), ((start, end), [(end, end, True)]))
+
+    def test_end_at_watermark(self):
+        start = datetime(2017, 5, 1, 10)
+        self.assertEqual(self.split((start, self.watermark)), ((start, self.watermark), [(self.watermark, self.watermark, True)]))
+
+    def test_within_hour(self):
+        start, end = datetime(2017, 5, 1, 10, 15), datetime(2017, 5, 1, 10, 45)
+        self.assertEqual(self.split((start, end)), (None, [(start, end, True)]))
+
+    def test_after_watermark(self):
+        start, end = datetime(2017, 5, 11, 10), datetime(2017, 5, 12, 10)
+        self.assertEqual(self.split((start, end)), (None, [(start, end, True)]))
+
+    def test_open_start(self):
+        end = datetime(2017, 5, 3, 8, 15)
+        self.assertEqual(self.split((None, end)), (
+            (None, datetime(2017, 5, 3, 8)),
+            [(datetime(2017, 5, 3, 8), end, True)]
+        ))
+
+
+class TestCountPerDay(unittest.TestCase):
+    counts_per_hour = [
+        (datetime(2017, 5, 1, 0), 1),
+        (datetime(2017, 5, 1, 3), 2),
+        (datetime(2017, 5, 1, 5), 4),
+        (datetime(2017, 5, 1, 21), 8),
+        (datetime(2017, 5, 1, 23), 16)
+    ]
+
+    def count(self, offset):
+        return StatisticRecord._count_per_local_day(self.counts_per_hour, offset)
+
+    def test_utc(self):
+        self.assertEqual(self.count(timedelta(0)), {'2017-05-01': 31})
+
+    def test_positive_offset(self):
+        self.assertEqual(self.count(timedelta(hours=3)), {'2017-05-01': 7, '2017-05-02': 24})
+
+    def test_negative_offset(self):
+        """
+        Hours before the local midnight belong to the previous day
+        """
+        self.assertEqual(self.count(timedelta(hours=-5)), {'2017-04-30': 3, '2017-05-01': 28})
+
+    def test_hour_offsets(self):
+        """
+        Rolled up hours are used only for timezones with whole hour offsets
+        """
+        self.assertTrue(StatisticRecord._is_hour_offset(timedelta(hours=-5)))
+        self.assertTrue(StatisticRecord._is_hour_offset(timedelta(hours=14)))
+        self.assertFalse(StatisticRecord._is_hour_offset(timedelta(hours=5, minutes=30)))
+        self.assertFalse(StatisticRecord._is_hour_offset(timedelta(hours=-3, minutes=-30)))
+        self.assertFalse(StatisticRecord._is_hour_offset(timedelta(hours=5, minutes=45)))
+
+    def test_days(self):
+        """
+        Days without records are included with zero count
+        """
+        tz = pytz.timezone('America/New_York')
+        date_range_local = (tz.localize(datetime(2017, 4, 30)), tz.localize(datetime(2017, 5, 2, 23, 59, 59)))
+
+        days, total = StatisticRecord._get_days(date_range_local, self.count(date_range_local[0].utcoffset()))
+
+        self.assertEqual(days, [
+            dict(date='2017-04-30', count=3),
+            dict(date='2017-05-01', count=28),
+            dict(date='2017-05-02', count=0)
+        ])
+        self.assertEqual(total, 31)